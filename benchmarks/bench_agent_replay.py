@@ -0,0 +1,50 @@
+"""Benchmark the ToolAgent loop offline by replaying recorded LLM calls.
+
+First record a cassette with API keys available:
+
+    python -m benchmarks.bench_agent_replay --record --cassette runs/caffeine.jsonl --question "What is the molecular weight of caffeine?"
+
+Then replay it without network access to the LLM providers, so that the measured time is the framework overhead 
+plus the tool time only:
+
+    python -m benchmarks.bench_agent_replay --cassette runs/caffeine.jsonl --question "What is the molecular weight of caffeine?"
+"""
+
+import argparse
+import statistics
+import time
+
+from chemagent import ChemAgent
+from chemagent.llms import use_cassette
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cassette', required=True)
+    parser.add_argument('--question', required=True)
+    parser.add_argument('--model', default='gpt-4o-2024-08-06')
+    parser.add_argument('--include-tools', nargs='*', default=None)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--record', action='store_true')
+    args = parser.parse_args()
+
+    api_keys = {}
+    if args.record:
+        from api_keys import api_keys
+
+    mode = 'record' if args.record else 'replay'
+    with use_cassette(args.cassette, mode=mode):
+        agent = ChemAgent(model=args.model, api_keys=api_keys, include_tools=args.include_tools)
+        timings = []
+        for _ in range(1 if args.record else args.repeats):
+            start = time.perf_counter()
+            final_answer, tool_use_chain, _, _ = agent.run(args.question, verbose=False)
+            timings.append(time.perf_counter() - start)
+
+    print('Answer: %s' % final_answer)
+    print('Steps: %d' % len(tool_use_chain))
+    print('Wall time per run: mean %.3f s, min %.3f s, max %.3f s over %d runs' % (statistics.mean(timings), min(timings), max(timings), len(timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Benchmark the per-step cost of preparing the provider payload for a growing ToolAgent conversation.
+
+Compares the old deepcopy-based preparation with `prepare_messages` on a synthetic 40-step run with large tool 
+observations (similar to full PubChem pages). Run from the project root:
+
+    python -m benchmarks.bench_conversation
+"""
+
+import argparse
+import time
+from copy import deepcopy
+
+from chemagent.llms.requester import prepare_messages
+
+
+def make_conversation(num_steps, observation_size):
+    conversation = [
+        {'role': 'system', 'content': 'You are an expert chemist. ' * 400},
+        {'role': 'user', 'content': 'Question: What is the molecular weight of caffeine?\n\n'},
+    ]
+    observation = ('# 1 Names and Identifiers\nSection Description: Chemical names, synonyms, identifiers. ' * (observation_size // 80 + 1))[:observation_size]
+    for idx in range(num_steps):
+        conversation.append({'role': 'assistant', 'content': 'Thought: Step %d.\nTool: PubchemSearchQA\nTool Input: Name: caffeine Question: weight?\n<END_INPUT>' % idx})
+        conversation.append({'role': 'user', 'content': 'Tool Output: ' + observation})
+    return conversation
+
+
+def prepare_with_deepcopy(conversation, prefix=None, merge_system=False):
+    conversation = deepcopy(conversation)
+    if prefix is not None:
+        conversation.append({'role': 'assistant', 'content': prefix.rstrip()})
+    system_prompt = None
+    if conversation[0]['role'] == 'system':
+        system_prompt = conversation[0]['content']
+        conversation = conversation[1:]
+    if system_prompt is not None and merge_system:
+        conversation[0]['content'] = system_prompt + '\n\n' + conversation[0]['content']
+        system_prompt = None
+    return system_prompt, conversation, prefix
+
+
+def prepare_with_views(conversation, prefix=None, merge_system=False):
+    return prepare_messages(conversation, prefix=prefix, split_system=True, merge_system=merge_system)
+
+
+def run_agent_loop(prepare, full_conversation, repeats, merge_system):
+    # Replay the run step by step: the payload is prepared from a conversation that grows by two messages per step
+    num_static = 2
+    num_steps = (len(full_conversation) - num_static) // 2
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for step in range(num_steps + 1):
+            conversation = full_conversation[:num_static + 2 * step]
+            prepare(conversation, merge_system=merge_system)
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=40)
+    parser.add_argument('--observation-size', type=int, default=30000)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    conversation = make_conversation(args.steps, args.observation_size)
+    total_bytes = sum(len(item['content']) for item in conversation)
+    print('Synthetic run: %d steps, %d messages, %.1f KB in the final conversation' % (args.steps, len(conversation), total_bytes / 1024))
+
+    for merge_system in (False, True):
+        t_copy = run_agent_loop(prepare_with_deepcopy, conversation, args.repeats, merge_system)
+        t_view = run_agent_loop(prepare_with_views, conversation, args.repeats, merge_system)
+        print('merge_system=%s: deepcopy %.2f ms/run, views %.2f ms/run (%.1fx)' % (merge_system, t_copy * 1000, t_view * 1000, t_copy / t_view))
+
+
+if __name__ == '__main__':
+    main()
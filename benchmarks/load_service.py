@@ -0,0 +1,141 @@
+"""Load test the ChemAgent HTTP service (chemagent/service.py), and report its throughput and latency percentiles.
+
+Without a live LLM provider, start the mock LLM and the service with a mock model first:
+
+    cd python_server && python mock_llm.py --port 8900 --latency-mean 1.0 &
+    python -m chemagent.service --model mock-gpt-4o --include-tools SMILES2Weight --workers 32 &
+
+Then send questions at a fixed arrival rate (open loop), or with a fixed number of clients (closed loop):
+
+    python -m benchmarks.load_service --rate 20 --num-requests 500 --tenants 4
+    python -m benchmarks.load_service --concurrency 64 --num-requests 500 --tenants 4
+
+Each question is posted, and its events are followed until the final answer, so that the end-to-end latency, the
+queue time, and the time to the first step are measured as a client sees them.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from chemagent.service import latency_stats
+
+
+class SSEParser(object):
+    """Collect the Server-Sent Events of a streamed response as (event, data) pairs."""
+
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self.buffer = ''
+
+    def feed(self, chunk):
+        self.buffer += chunk.decode('utf-8')
+        while '\n\n' in self.buffer:
+            block, self.buffer = self.buffer.split('\n\n', 1)
+            event, data = 'message', []
+            for line in block.split('\n'):
+                if line.startswith('event:'):
+                    event = line[len('event:'):].strip()
+                elif line.startswith('data:'):
+                    data.append(line[len('data:'):].strip())
+            if len(data) > 0:
+                self.on_event(event, json.loads('\n'.join(data)))
+
+
+async def run_question(client, url, tenant, question, timeout):
+    """Post a question and follow its events. Returns the measurements of the request."""
+    headers = {'Content-Type': 'application/json', 'X-Tenant-ID': tenant}
+    start = time.perf_counter()
+    response = await client.fetch(
+        HTTPRequest(url + '/v1/runs', method='POST', headers=headers, body=json.dumps({'question': question}), request_timeout=timeout),
+        raise_error=False,
+    )
+    if response.code != 202:
+        return {'outcome': str(response.code), 'latency': time.perf_counter() - start}
+
+    result = {'outcome': 'no_answer'}
+
+    def on_event(event, data):
+        now = time.perf_counter() - start
+        if event == 'started':
+            result['queue_time'] = data['queue_time']
+        elif event == 'step' and 'first_step' not in result:
+            result['first_step'] = now
+        elif event == 'final':
+            result['outcome'] = 'ok'
+        elif event == 'error':
+            result['outcome'] = 'failed'
+
+    parser = SSEParser(on_event)
+    events_url = url + json.loads(response.body)['events_url']
+    response = await client.fetch(
+        HTTPRequest(events_url, headers=headers, streaming_callback=parser.feed, request_timeout=timeout),
+        raise_error=False,
+    )
+    if response.code != 200:
+        result['outcome'] = 'events_%d' % response.code
+    result['latency'] = time.perf_counter() - start
+    return result
+
+
+async def main(args):
+    AsyncHTTPClient.configure(None, max_clients=max(args.concurrency or 0, 10000))
+    client = AsyncHTTPClient()
+    tenants = ['tenant-%d' % k for k in range(args.tenants)]
+    results = []
+
+    async def one(k):
+        results.append(await run_question(client, args.url, tenants[k % len(tenants)], args.question, args.timeout))
+
+    start = time.perf_counter()
+    if args.rate is not None:
+        # Open loop: Poisson arrivals, regardless of how fast the service answers
+        tasks = []
+        for k in range(args.num_requests):
+            tasks.append(asyncio.ensure_future(one(k)))
+            await asyncio.sleep(random.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+    else:
+        # Closed loop: each client sends its next question once the previous one is answered
+        counter = iter(range(args.num_requests))
+
+        async def worker():
+            for k in counter:
+                await one(k)
+
+        await asyncio.gather(*[worker() for _ in range(args.concurrency)])
+    duration = time.perf_counter() - start
+
+    outcomes = Counter(result['outcome'] for result in results)
+    ok = [result for result in results if result['outcome'] == 'ok']
+    print('Sent %d questions in %.1f s from %d tenants' % (len(results), duration, len(tenants)))
+    print('Outcomes: %s' % ', '.join('%s %d' % item for item in sorted(outcomes.items())))
+    print('Throughput: %.2f answered questions/s' % (len(ok) / duration))
+    for name, values in (
+        ('End-to-end latency', [result['latency'] for result in ok]),
+        ('Queue time', [result['queue_time'] for result in ok if 'queue_time' in result]),
+        ('Time to first step', [result['first_step'] for result in ok if 'first_step' in result]),
+    ):
+        stats = latency_stats(values)
+        if stats['count'] == 0:
+            continue
+        print('%s (s): mean %.3f, p50 %.3f, p90 %.3f, p95 %.3f, p99 %.3f, max %.3f' % (
+            name, stats['mean'], stats['p50'], stats['p90'], stats['p95'], stats['p99'], stats['max']
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:8920')
+    parser.add_argument('--question', default='What is the molecular weight of ethanol?')
+    parser.add_argument('--num-requests', type=int, default=200)
+    parser.add_argument('--tenants', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=None, help='Questions per second (open loop).')
+    parser.add_argument('--concurrency', type=int, default=32, help='Concurrent clients (closed loop), if --rate is not given.')
+    parser.add_argument('--timeout', type=float, default=600)
+    asyncio.run(main(parser.parse_args()))
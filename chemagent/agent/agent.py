@@ -1,6 +1,7 @@
 import logging
 
 from .tool_agent import ToolAgent
+from .code_tool_agent import CodeToolAgent
 from .rephrasing_agent import RephrasingAgent
 
 
@@ -21,6 +22,19 @@ class ChemAgent(object):
         init_tools=False,
         include_tools=None,
         exclude_tools=None,
+        stream=False,
+        llm_cache=None,
+        context_budget=None,
+        context_compaction='truncate',
+        memoize_tools=True,
+        tool_cache=None,
+        parallel_tools=False,
+        code_agent=False,
+        tool_router=None,
+        tool_timeout=None,
+        tool_timeouts=None,
+        run_timeout=None,
+        tool_server_url=None,
     ):
         if tool_agent_model is None:
             tool_agent_model = model
@@ -35,37 +49,123 @@ class ChemAgent(object):
         """Initialize ChemAgent."""
         self.max_iterations = max_iterations
 
-        self.tool_agent = ToolAgent(
-            tools=tools,
-            model=tool_agent_model,
-            tools_model=tools_model,
-            api_keys=api_keys,
-            max_iterations=max_iterations,
-            init_tools=init_tools,
-            include_tools=include_tools,
-            exclude_tools=exclude_tools,
-        )
+        if code_agent:
+            # The tools are called from the code written by the LLM, with `tools` being code-interface tools
+            assert include_tools is None and exclude_tools is None, "include_tools and exclude_tools are not supported by the code agent. Please pass the code tools instead."
+            if tool_router is not None:
+                raise ValueError("tool_router is not supported by the code agent, whose only tool is the Python shell.")
+            self.tool_agent = CodeToolAgent(
+                code_tools=tools,
+                model=tool_agent_model,
+                tools_model=tools_model,
+                api_keys=api_keys,
+                max_iterations=max_iterations,
+                init_tools=init_tools,
+                stream=stream,
+                llm_cache=llm_cache,
+                context_budget=context_budget,
+                context_compaction=context_compaction,
+                memoize_tools=memoize_tools,
+                tool_cache=tool_cache,
+                parallel_tools=parallel_tools,
+                tool_timeout=tool_timeout,
+                tool_timeouts=tool_timeouts,
+                run_timeout=run_timeout,
+                tool_server_url=tool_server_url,
+            )
+        else:
+            self.tool_agent = ToolAgent(
+                tools=tools,
+                model=tool_agent_model,
+                tools_model=tools_model,
+                api_keys=api_keys,
+                max_iterations=max_iterations,
+                init_tools=init_tools,
+                include_tools=include_tools,
+                exclude_tools=exclude_tools,
+                stream=stream,
+                llm_cache=llm_cache,
+                context_budget=context_budget,
+                context_compaction=context_compaction,
+                memoize_tools=memoize_tools,
+                tool_cache=tool_cache,
+                parallel_tools=parallel_tools,
+                tool_router=tool_router,
+                tool_timeout=tool_timeout,
+                tool_timeouts=tool_timeouts,
+                run_timeout=run_timeout,
+                tool_server_url=tool_server_url,
+            )
 
         self.rephrasing_agent = RephrasingAgent(
             model=rephrasing_agent_model,
             api_keys=api_keys,
+            llm_cache=llm_cache,
         )
 
-    def run(self, request, do_rephrasing=False, format=None, demonstration=None, verbose=True, conv_id=None):
+    def run(self, request, do_rephrasing=False, format=None, demonstration=None, verbose=True, conv_id=None, answer_callback=None, return_summary=False, format_check=None, step_callback=None):
+        """Returns (final_answer, tool_use_chain, conversation, conversation_with_icl). With `return_summary`, the token, 
+        latency and per-tool statistics of the run are appended as a fifth item.
+
+        `do_rephrasing` is False (the ToolAgent answer is final), True (the answer is rewritten by RephrasingAgent 
+        following `format`), or 'fused': `format` is given to ToolAgent with the question, and RephrasingAgent is only 
+        called if the answer is empty or `format_check(answer)` returns False.
+
+        `step_callback` gets each tool use chain entry as soon as its step is done (see `ToolAgent.run`).
+        """
         request = request.strip()
 
-        tool_use_chain, conversation, conversation_with_icl = self.tool_agent.run(request, demonstration=demonstration, verbose=verbose, conv_id=conv_id)
+        result = self.tool_agent.run(request, demonstration=demonstration, verbose=verbose, conv_id=conv_id, answer_callback=answer_callback, return_summary=return_summary, answer_format=format if do_rephrasing == 'fused' else None, step_callback=step_callback)
+        tool_use_chain, conversation, conversation_with_icl = result[:3]
         
         assert tool_use_chain[-1]['tool'] == 'Answer', f"Last tool in tool_use_chain is not 'Answer'. It is {tool_use_chain[-1]['tool']}."
-        answer_output = tool_use_chain[-1]['output']
-        direct_answer = answer_output
-            
-        if do_rephrasing is False:
-            final_answer = direct_answer
-        else:
-            final_answer = self.rephrasing_agent.run(request, format, conversation=conversation)
+        final_answer, rephrased = self._final_answer(request, tool_use_chain[-1]['output'], conversation, do_rephrasing, format, format_check)
 
         if verbose:
             print_logger.info('Final Answer: %s' % final_answer)
 
+        if return_summary:
+            summary = result[3]
+            summary['rephrased'] = rephrased
+            if verbose:
+                print_logger.info('Summary: %d steps, %d LLM calls, %d input tokens (%d cached), %d output tokens, %.1f s LLM time, %.1f s tool time, %.1f s total.' % (
+                    summary['num_steps'], summary['num_llm_calls'], summary['input_tokens'], summary['cached_input_tokens'], 
+                    summary['output_tokens'], summary['llm_time'], summary['tool_time'], summary['wall_time']
+                ))
+            return final_answer, tool_use_chain, conversation, conversation_with_icl, summary
         return final_answer, tool_use_chain, conversation, conversation_with_icl
+
+    def run_batch(self, requests, do_rephrasing=False, format=None, demonstration=None, verbose=False, conv_ids=None, max_workers=8, return_summary=False, format_check=None):
+        """Run multiple questions with ToolAgent.run_batch. Returns a list with one item per question: the same tuple as 
+        `run`, or the exception that stopped that question."""
+        requests = [request.strip() for request in requests]
+
+        results = self.tool_agent.run_batch(requests, demonstration=demonstration, verbose=verbose, conv_ids=conv_ids, max_workers=max_workers, return_summary=return_summary, answer_format=format if do_rephrasing == 'fused' else None)
+
+        outputs = []
+        for request, result in zip(requests, results):
+            if isinstance(result, Exception):
+                outputs.append(result)
+                continue
+            tool_use_chain, conversation, conversation_with_icl = result[:3]
+            final_answer, rephrased = self._final_answer(request, tool_use_chain[-1]['output'], conversation, do_rephrasing, format, format_check)
+
+            if verbose:
+                print_logger.info('Final Answer: %s' % final_answer)
+
+            if return_summary:
+                result[3]['rephrased'] = rephrased
+            outputs.append((final_answer, tool_use_chain, conversation, conversation_with_icl) + tuple(result[3:]))
+
+        return outputs
+
+    def _final_answer(self, request, direct_answer, conversation, do_rephrasing, format, format_check):
+        """Returns the final answer and whether RephrasingAgent was called for it."""
+        assert do_rephrasing in (False, True, 'fused'), "do_rephrasing must be False, True, or 'fused'."
+        if do_rephrasing is False:
+            return direct_answer, False
+        if do_rephrasing == 'fused':
+            if direct_answer is not None and direct_answer.strip() != '' and (format_check is None or format_check(direct_answer)):
+                return direct_answer, False
+            logger.info('The answer does not pass the format check. Rephrasing it.')
+        return self.rephrasing_agent.run(request, format, conversation=conversation), True
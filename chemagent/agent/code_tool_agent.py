@@ -0,0 +1,234 @@
+import json
+import logging
+import secrets
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from uuid import uuid4
+
+from chemagent.utils.error import *
+from chemagent.utils.deadline import call_with_timeout
+from chemagent.agent.tools import make_code_tools, generate_code_tools_description, set_tool_cache, PythonShell
+from chemagent.agent.tool_agent import ToolAgent
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds a kernel waits for a tool function without a tool timeout
+DEFAULT_CALLBACK_TIMEOUT = 600
+# Seconds the kernel waits beyond the tool timeout, for the reply of a timed-out tool
+CALLBACK_GRACE_TIME = 5
+
+
+KERNEL_PREAMBLE = '''import json as _chemagent_json
+import urllib.request as _chemagent_request
+
+
+class ChemAgentToolError(Exception):
+    pass
+
+
+def _call_chemagent_tool(func_name, args):
+    request = _chemagent_request.Request(
+        {url!r} + func_name,
+        data=_chemagent_json.dumps({{'args': args}}).encode('utf-8'),
+        headers={{'Content-Type': 'application/json', 'X-ChemAgent-Token': {token!r}}},
+    )
+    with _chemagent_request.urlopen(request, timeout={timeout!r}) as response:
+        data = _chemagent_json.loads(response.read().decode('utf-8'))
+    if 'error' in data:
+        raise ChemAgentToolError(data['error'])
+    return data['result']
+'''
+
+KERNEL_FUNCTION = '''
+
+def {func_name}({params}) -> {return_type}:
+    {doc!r}
+    return _call_chemagent_tool({func_name!r}, [{arg_names}])
+'''
+
+CODE_TOOLS_PROMPT = """The following functions are already defined in the Python shell, and can be called directly in your code without importing anything:
+
+{functions}
+
+Prefer writing one piece of code that calls these functions for all the molecules or items you need (e.g., in a loop) and prints the results, instead of calling the tools one by one. A function raises ChemAgentToolError if the tool fails. Always print the values you need to see."""
+
+
+def _func_params(tool):
+    """Returns the parameter names and the parameter list of a code tool, from its `func_doc`."""
+    params = [item.strip() for item in ', '.join(tool.func_doc[:-1]).split(',') if item.strip() != '']
+    return [item.split(':')[0].strip() for item in params], ', '.join(params)
+
+
+def make_kernel_preamble(tools, url, token, timeout=600):
+    """Python code defining, in a kernel, one function per code tool that calls the tool through a ToolCallbackServer."""
+    code = KERNEL_PREAMBLE.format(url=url, token=token, timeout=timeout)
+    for tool in tools:
+        arg_names, params = _func_params(tool)
+        code += KERNEL_FUNCTION.format(
+            func_name=tool.func_name,
+            params=params,
+            return_type=tool.func_doc[-1],
+            doc=tool.func_description,
+            arg_names=', '.join(arg_names),
+        )
+    return code
+
+
+class _ToolCallbackHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server.callback_server
+        if not secrets.compare_digest(self.headers.get('X-ChemAgent-Token', ''), server.token):
+            self._reply(403, {'error': 'Invalid token.'})
+            return
+        func_name = self.path.strip('/').split('/')[-1]
+        tool = server.tool_dict.get(func_name)
+        if tool is None:
+            self._reply(404, {'error': '"%s" is not a valid tool function.' % func_name})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            args = json.loads(self.rfile.read(length).decode('utf-8'))['args']
+        except (ValueError, KeyError) as e:
+            self._reply(400, {'error': 'Invalid request: %s' % e})
+            return
+        self._reply(200, server.call(tool, args))
+
+    def _reply(self, status, data):
+        try:
+            body = json.dumps(data, ensure_ascii=False)
+        except (TypeError, ValueError):
+            body = json.dumps({'result': str(data['result'])}, ensure_ascii=False)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Tool callback: ' + format % args)
+
+
+class ToolCallbackServer(object):
+    """A local HTTP server through which code running in the Jupyter kernels calls the code-interface tools of this
+    process, so that the tools keep their initialized models, caches and API keys. Requests must carry a random token,
+    which is only given to the kernels in the preamble. Tool calls are cancelled after `timeout` seconds, and the 
+    function in the kernel raises ChemAgentToolError with the timeout message."""
+
+    def __init__(self, tools, host='127.0.0.1', port=0, timeout=None):
+        self.tool_dict = {tool.func_name: tool for tool in tools}
+        self.timeout = timeout
+        self.token = secrets.token_hex(16)
+        self.num_calls = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _ToolCallbackHandler)
+        self._server.daemon_threads = True
+        self._server.callback_server = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d/call/' % (host, port)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever, name='tool-callback', daemon=True)
+            self._thread.start()
+            logger.info('Tool callback server listening at %s' % self.url)
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+
+    def call(self, tool, args):
+        with self._lock:
+            self.num_calls += 1
+        try:
+            return {'result': call_with_timeout(lambda: tool(*args), self.timeout, name=tool.name)}
+        except ChemAgentGeneralError as e:
+            return {'error': str(e)}
+        except Exception as e:
+            logger.exception('Tool %s failed when called from code.' % tool.name)
+            return {'error': '%s: %s' % (e.__class__.__name__, e)}
+
+    def make_preamble(self):
+        timeout = DEFAULT_CALLBACK_TIMEOUT if self.timeout is None else self.timeout + CALLBACK_GRACE_TIME
+        return make_kernel_preamble(self.tool_dict.values(), self.url, self.token, timeout=timeout)
+
+
+class CodeToolAgent(ToolAgent):
+    """A ToolAgent whose only tool is the Python shell, in which the code-interface tools (see `make_code_tools`) are
+    preloaded as functions. The LLM can then call many tools for many inputs in one code cell, instead of one tool
+    call per step.
+
+    The functions run the tools in this process through a ToolCallbackServer on `callback_host`, which must be
+    reachable from the Jupyter kernels behind `python_url`. Each run gets its own kernel (`conv_id`), and the functions
+    are defined once when the kernel is created. Other arguments are the same as ToolAgent's.
+
+    The functions are cancelled after `tool_timeout` seconds. A code cell is interrupted after the PythonREPL timeout 
+    (`tool_timeouts['PythonREPL']`, or `tool_timeout`), or after as long as a function may wait without them.
+    """
+
+    def __init__(
+        self,
+        code_tools=None,
+        model="gpt-4-0613",
+        tools_model="gpt-3.5-turbo-0613",
+        api_keys={},
+        init_tools=True,
+        llm_cache=None,
+        tool_cache=None,
+        python_url='http://localhost:8888/execute',
+        callback_host='127.0.0.1',
+        callback_port=0,
+        tool_server_url=None,
+        **kwargs
+    ):
+        if code_tools is None:
+            code_tools = make_code_tools(tools_model, api_keys=api_keys, init=init_tools, llm_cache=llm_cache, tool_cache=tool_cache, tool_server_url=tool_server_url)
+        else:
+            set_tool_cache(code_tools, tool_cache)
+        # The code runs in the shell itself
+        self.code_tools = [tool for tool in code_tools if tool.name != PythonShell.name]
+
+        tool_timeout = kwargs.get('tool_timeout')
+        cell_timeout = (kwargs.get('tool_timeouts') or {}).get(PythonShell.name, tool_timeout)
+        self.tool_server = ToolCallbackServer(self.code_tools, host=callback_host, port=callback_port, timeout=tool_timeout).start()
+        if cell_timeout is None:
+            cell_timeout = DEFAULT_CALLBACK_TIMEOUT if tool_timeout is None else tool_timeout + CALLBACK_GRACE_TIME
+        python_shell = PythonShell(init=init_tools, url=python_url, setup_code=[self.tool_server.make_preamble()], timeout=cell_timeout)
+
+        super().__init__(
+            tools=[python_shell],
+            model=model,
+            tools_model=tools_model,
+            api_keys=api_keys,
+            init_tools=init_tools,
+            llm_cache=llm_cache,
+            **kwargs
+        )
+
+    def _verify_tools(self, tools):
+        pass
+
+    def _make_tool_strings(self, tools):
+        descriptions = generate_code_tools_description(self.code_tools)
+        functions = '\n\n'.join(
+            '%s\n    %s' % (func_definition, func_description)
+            for func_definition, func_description in descriptions.values()
+        )
+        return super()._make_tool_strings(tools) + '\n\n' + CODE_TOOLS_PROMPT.format(functions=functions)
+
+    def _start_run(self, request, demonstration=None, conv_id=None, answer_format=None):
+        # A kernel of its own, so that the variables of other runs are not visible
+        if conv_id is None:
+            conv_id = str(uuid4())
+        return super()._start_run(request, demonstration=demonstration, conv_id=conv_id, answer_format=answer_format)
+
+    def close(self):
+        self.tool_server.stop()
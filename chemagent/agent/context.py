@@ -0,0 +1,95 @@
+import hashlib
+import logging
+import threading
+
+from chemagent.llms.rate_limit import estimate_tokens
+
+
+logger = logging.getLogger(__name__)
+
+
+SUMMARY_PROMPT = 'You are assisting an agent that answers chemistry questions with tools. Summarize the following tool output concisely for the question below. Keep every name, identifier, SMILES, number, and unit that may be relevant to the question, and drop the rest.\n\nQuestion: {question}\n\nTool Call:\n{tool_call}\n\nTool Output:\n{output}'
+
+
+class ContextBudget(object):
+    """Keep the conversation of a ToolAgent run within `max_tokens` (estimated at 4 characters per token).
+
+    When the conversation exceeds the budget, the oldest tool observations, except the latest `keep_recent` ones,
+    are compacted until the conversation fits: with `method='truncate'`, an observation is cut to its first
+    `head_chars` and last `tail_chars` characters; with `method='summarize'`, it is replaced by a summary written by
+    `llm`. Compacted observations stay compacted, so that the conversation prefix (and the provider's prompt cache)
+    only changes when the budget is exceeded again. The system prompt, demonstrations and question are never
+    compacted, and the full observations remain in `tool_use_chain`.
+    """
+
+    def __init__(self, max_tokens, method='truncate', keep_recent=2, head_chars=1000, tail_chars=500, llm=None):
+        assert method in ('truncate', 'summarize'), "Compaction method '%s' is not supported. Please use 'truncate' or 'summarize'." % method
+        if method == 'summarize':
+            assert llm is not None, "An LLM is required to summarize tool outputs."
+        self.max_tokens = max_tokens
+        self.method = method
+        self.keep_recent = keep_recent
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.llm = llm
+        self._summaries = {}
+        self._lock = threading.Lock()
+
+    def compact(self, conversation, first_index, question, observation_prefix, compacted):
+        """Compact the observations in `conversation[first_index:]` in place, skipping and updating the set of already 
+        `compacted` message indices. Returns the number of observations compacted."""
+        if estimate_tokens(conversation) <= self.max_tokens:
+            return 0
+
+        observation_indices = [
+            idx for idx in range(first_index, len(conversation))
+            if conversation[idx]['role'] == 'user' and conversation[idx]['content'].startswith(observation_prefix)
+        ]
+        if self.keep_recent > 0:
+            observation_indices = observation_indices[:-self.keep_recent]
+
+        num_compacted = 0
+        for idx in observation_indices:
+            if idx in compacted:
+                continue
+            compacted.add(idx)
+            output = conversation[idx]['content'][len(observation_prefix):].strip()
+            compacted_output = self._compact_output(output, conversation[idx - 1]['content'], question)
+            if len(compacted_output) >= len(output):
+                continue
+            conversation[idx] = {'role': 'user', 'content': '%s %s' % (observation_prefix, compacted_output)}
+            num_compacted += 1
+            if estimate_tokens(conversation) <= self.max_tokens:
+                break
+
+        if num_compacted > 0:
+            logger.info('Compacted %d tool outputs. The conversation now has about %d tokens (budget %d).' % (num_compacted, estimate_tokens(conversation), self.max_tokens))
+        return num_compacted
+
+    def _compact_output(self, output, tool_call, question):
+        if self.method == 'summarize':
+            try:
+                return self._summarize(output, tool_call, question)
+            except Exception as e:
+                logger.warning('Failed to summarize a tool output (%s: %s). Truncating it instead.' % (e.__class__.__name__, e))
+        return self._truncate(output)
+
+    def _truncate(self, output):
+        if len(output) <= self.head_chars + self.tail_chars:
+            return output
+        num_omitted = len(output) - self.head_chars - self.tail_chars
+        tail = output[-self.tail_chars:] if self.tail_chars > 0 else ''
+        return '%s\n[... %d characters omitted ...]\n%s' % (output[:self.head_chars], num_omitted, tail)
+
+    def _summarize(self, output, tool_call, question):
+        key = hashlib.sha256(('%s\n%s' % (question, output)).encode('utf-8')).hexdigest()
+        with self._lock:
+            if key in self._summaries:
+                return self._summaries[key]
+        conv = [
+            {'role': 'user', 'content': SUMMARY_PROMPT.format(tool_call=tool_call, question=question, output=output)},
+        ]
+        summary = '[Summarized] ' + self.llm.request(conv)[0].strip()
+        with self._lock:
+            self._summaries[key] = summary
+        return summary
@@ -24,8 +24,9 @@ class RephrasingAgent(object):
         self,
         model="gpt-4-0613",
         api_keys={},
+        llm_cache=None,
     ):
-        self.llm = make_llm(model, api_keys)
+        self.llm = make_llm(model, api_keys, cache=llm_cache)
 
     def run(self, request, format=None, conversation=None, draft=None, verbose=True):
         if conversation is not None:
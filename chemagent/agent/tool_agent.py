@@ -1,9 +1,18 @@
+import re
 import logging
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from chemagent.utils.error import *
 from chemagent.llms import make_llm
-from chemagent.agent.tools import make_tools, verify_tools, PythonShell, AiExpert
+from chemagent.agent.tools import make_tools, verify_tools, set_tool_cache, PythonShell, AiExpert
+from chemagent.agent.context import ContextBudget
+from chemagent.agent.tool_router import ToolRouter
+from chemagent.llms.rate_limit import estimate_tokens
+from chemagent.utils import canonicalize_molecule_smiles
+from chemagent.utils.deadline import call_with_timeout, check_deadline
+from chemagent.utils.circuit_breaker import circuit_breaker_metrics
 
 
 print_logger = logging.getLogger('chemagent_print')
@@ -22,6 +31,9 @@ ACTION_INPUT_TITLE_SC = ACTION_INPUT_TITLE + ':'
 OBSERVATION_TITLE_SC = OBSERVATION_TITLE + ':'
 ANSWER_TITLE_SC = ANSWER_TITLE + ':'
 
+END_INPUT = '<END_INPUT>'
+END_TOOLS = '<END_TOOLS>'
+
 
 PREFIX = """You are an expert chemist. Your task is to use the provided tools and respond to the input question to the best of your ability.
 
@@ -55,10 +67,45 @@ Use the above tools to respond to the user's question.
 """.format(thought_title=THOUGHT_TITLE, action_title=ACTION_TITLE, action_input_title=ACTION_INPUT_TITLE, answer_title=ANSWER_TITLE, llm_tool_name=AiExpert.name, tool_names='{{{tool_names}}}', tool_strings='{tool_strings}')
 
 
+PARALLEL_FORMAT_INSTRUCTIONS = """You must respond in one of two specific formats in every step:
+
+1. When calling tools:
+    {thought_title}: [Your reasoning for the next step]
+    {action_title}: [Exact name of the tool to use, must be one from the provided list: {tool_names}]
+    {action_input_title}: [Specific input for the selected tool. You must add "<END_INPUT>" at the end of the input to indicate the end position.]
+    ... (the {action_title}/{action_input_title} pair can repeat to call several tools at once)
+    <END_TOOLS>
+   Then you will be provided with the outputs of all the called tools, in order.
+2. When providing the final answer after obtaining all necessary information with tools:
+    {thought_title}: [Conclusion of the gathered information and reasoning for the final answer]
+    {answer_title}: [Your conclusion based on gathered information and comprehensive response to the original question]
+
+Guidelines:
+- You should call tools to solve the problem, especially when you are not sure about certain things and when tools can help.
+- If no other tools are suitable, use the {llm_tool_name} tool to ask questions and obtain analysis.
+- Only provide the final answer after you have gathered all necessary information using tools.
+- Always use the exact format specified, including the colons after "{thought_title}", "{action_title}", "{action_input_title}", and "{answer_title}". Do not use any other format or include any additional text outside these structures.
+- You can call several tools in one step when their inputs do not depend on each other's outputs, e.g., looking up different properties of the same molecule. Calls that need the output of another call must wait for the next step. Once you have output all "{action_title}" and "{action_input_title}" pairs of the step, output "<END_TOOLS>", stop generating text and wait for the tool outputs.
+
+
+The provided tools:
+
+{tool_strings}
+
+
+Use the above tools to respond to the user's question.
+""".format(thought_title=THOUGHT_TITLE, action_title=ACTION_TITLE, action_input_title=ACTION_INPUT_TITLE, answer_title=ANSWER_TITLE, llm_tool_name=AiExpert.name, tool_names='{{{tool_names}}}', tool_strings='{tool_strings}')
+
+
 QUESTION_PROMPT = """Question: {input}
 
 """
 
+ANSWER_FORMAT_PROMPT = """Format requirement for the "{answer_title}": {answer_format}
+Your "{answer_title}" will be used as the final response to the question, so make sure it is complete, includes the necessary information and reasoning from the tool outputs, and follows the format requirement.
+
+""".format(answer_title=ANSWER_TITLE, answer_format='{answer_format}')
+
 
 def extract_tool_command(text):
     thought_pos = text.find(THOUGHT_TITLE_SC)
@@ -116,6 +163,97 @@ def extract_command(text):
         return thought, None, final_answer
 
 
+def extract_commands(text):
+    """Parse an output of the parallel protocol. Returns (thought, [(tool, tool_input), ...]), or (thought, None, answer)
+    for a final answer as `extract_command` does."""
+    text = text.replace(END_TOOLS, '')
+    if ACTION_TITLE_SC not in text:
+        return extract_command(text.replace(END_INPUT, ''))
+
+    num_action = text.count(ACTION_TITLE_SC)
+    num_action_input = text.count(ACTION_INPUT_TITLE_SC)
+    if num_action != num_action_input:
+        raise ChemAgentOutputError("The output contains different number of \"%s\" and \"%s\": %s" % (ACTION_TITLE_SC, ACTION_INPUT_TITLE_SC, text))
+
+    action_pos = text.find(ACTION_TITLE_SC)
+    thought = text[:action_pos].strip()
+    if thought.startswith(THOUGHT_TITLE_SC):
+        thought = thought[len(THOUGHT_TITLE_SC):].strip()
+    if thought == '':
+        thought = None
+
+    commands = []
+    for block in text[action_pos:].split(ACTION_TITLE_SC)[1:]:
+        if ACTION_INPUT_TITLE_SC not in block:
+            raise ChemAgentOutputError("The output contains \"%s\" but does not contain \"%s\": %s" % (ACTION_TITLE_SC, ACTION_INPUT_TITLE_SC, text))
+        input_pos = block.find(ACTION_INPUT_TITLE_SC)
+        action = block[:input_pos].strip()
+        action_input = block[input_pos + len(ACTION_INPUT_TITLE_SC):]
+        action_input = action_input.split(END_INPUT)[0].strip()
+        commands.append((action, action_input))
+    return thought, commands
+
+
+class StreamingCommandParser(object):
+    """Incrementally parse a streamed LLM output.
+
+    Feed the chunks in order with `feed`, which returns True as soon as the `end_marker` (the end of the tool 
+    input, or of all tool inputs in the parallel protocol) arrives, so that the caller can cut the stream. Text 
+    following the answer marker is forwarded to `answer_callback` as it streams in.
+    """
+
+    def __init__(self, answer_callback=None, end_marker=END_INPUT):
+        self.answer_callback = answer_callback
+        self.end_marker = end_marker
+        self.text = ''
+        self.finished = False
+        self._answer_start = None
+        self._answer_emitted = 0
+
+    def feed(self, chunk):
+        if self.finished:
+            return True
+        self.text += chunk
+        end_pos = self.text.find(self.end_marker)
+        if end_pos != -1:
+            self.text = self.text[:end_pos]
+            self.finished = True
+        self._emit_answer(final=self.finished)
+        return self.finished
+
+    def close(self):
+        self.finished = True
+        self._emit_answer(final=True)
+        return self.text.rstrip()
+
+    def result(self):
+        return extract_command(self.text.rstrip())
+
+    def _emit_answer(self, final=False):
+        if self.answer_callback is None:
+            return
+        if self._answer_start is None:
+            if ACTION_TITLE_SC in self.text:
+                return
+            answer_pos = self.text.find(ANSWER_TITLE_SC)
+            if answer_pos == -1:
+                return
+            self._answer_start = answer_pos + len(ANSWER_TITLE_SC)
+            self._answer_emitted = self._answer_start
+        # Hold back a possibly incomplete end-of-input marker until more text arrives
+        end = len(self.text) if final else max(self._answer_emitted, len(self.text) - len(self.end_marker) + 1)
+        if end <= self._answer_emitted:
+            return
+        new_text = self.text[self._answer_emitted: end]
+        if self._answer_emitted == self._answer_start:
+            new_text = new_text.lstrip()
+            if new_text == '':
+                return
+            self._answer_start = self._answer_emitted = end - len(new_text)
+        self._answer_emitted = end
+        self.answer_callback(new_text)
+
+
 def construct_tool_example_string(tool):
     examples = tool.__class__.examples
     example_strings = []
@@ -125,6 +263,133 @@ def construct_tool_example_string(tool):
     return '\n'.join(example_strings)
 
 
+# Tools whose output depends on state beyond their input, and therefore are never memoized
+NON_MEMOIZED_TOOLS = (PythonShell.name,)
+
+TOOL_TIMEOUT_OBSERVATION = 'Error: Timeout. The tool "{tool_name}" did not finish within {timeout:g} seconds and was cancelled. Please try another tool or a different input.'
+
+MEMO_HIT_NOTE = '\n(Note: This is the result of an identical earlier tool call.)'
+
+# The `func_doc` parameters that take SMILES, including the dot-separated reactants of reaction tools
+SMILES_PARAMS = re.compile(r'^(smiles\d*|reactants|product)$')
+
+
+def tool_params(tool):
+    """The parameter names in the `func_doc` of a tool, e.g., ['smiles1', 'smiles2'] for ("smiles1: str, smiles2: str", 
+    "str"), or None if the tool has no `func_doc`."""
+    func_doc = getattr(tool, 'func_doc', None)
+    if not func_doc:
+        return None
+    return [param.split(':')[0].strip() for param in ','.join(func_doc[:-1]).split(',') if param.strip() != '']
+
+
+def normalize_tool_input(tool, tool_input):
+    """Normalize a tool input for memoization. The SMILES fields (see SMILES_PARAMS) are canonicalized: the whole input 
+    of a tool with one field, or the fields separated by ';' of a tool with several. Fields that are not valid SMILES, 
+    inputs that do not match the fields, and tools without `func_doc` keep the raw input."""
+    if not isinstance(tool_input, str):
+        return tool_input
+    tool_input = tool_input.strip()
+    params = tool_params(tool)
+    if not params or not any(SMILES_PARAMS.match(param) for param in params):
+        return tool_input
+    values = [tool_input] if len(params) == 1 else [value.strip() for value in tool_input.split(';')]
+    if len(values) != len(params):
+        return tool_input
+    for k, param in enumerate(params):
+        if SMILES_PARAMS.match(param):
+            smiles = canonicalize_molecule_smiles(values[k])
+            if smiles is not None:
+                values[k] = smiles
+    return ';'.join(values)
+
+
+def run_in_lanes(executor, func, items, lane_keys):
+    """Call `func` on each item with `executor`, and return the results in the order of `items`. Items with the 
+    same lane key run one after another in their order, and items whose key is None run concurrently."""
+    lanes = []
+    lane_index = {}
+    for k, key in enumerate(lane_keys):
+        if key is None:
+            lanes.append([k])
+        elif key in lane_index:
+            lanes[lane_index[key]].append(k)
+        else:
+            lane_index[key] = len(lanes)
+            lanes.append([k])
+
+    results = [None] * len(items)
+
+    def run_lane(lane):
+        for k in lane:
+            results[k] = func(items[k])
+
+    list(executor.map(run_lane, lanes))
+    return results
+
+
+class ToolAgentRun(object):
+    """The state of one question being solved by ToolAgent."""
+
+    def __init__(self, request, conversation, len_demonstration, conv_id=None, tool_names=None):
+        self.request = request
+        self.conversation = conversation
+        self.len_demonstration = len_demonstration
+        self.conv_id = conv_id
+        # The tools described in the system prompt
+        self.tool_names = tool_names
+        self.tool_use_chain = []
+        self.idx = 1
+        self.error_iterations = 0
+        self.enable_print = True
+        self.finished = False
+        self.llm_calls = []
+        self.compacted = set()
+        self.tool_memo = {}
+        self.start_time = time.perf_counter()
+
+    def summary(self):
+        """Token, latency and tool statistics of the run, aggregated over all LLM calls (including the ones whose 
+        output could not be parsed) and all tool calls."""
+        summary = {
+            'wall_time': time.perf_counter() - self.start_time,
+            'system_prompt_tokens': estimate_tokens(self.conversation[:1]),
+            'prompt_tools': list(self.tool_names) if self.tool_names is not None else None,
+            'num_steps': len(self.tool_use_chain),
+            'num_llm_calls': len(self.llm_calls),
+            'llm_time': sum(call['latency'] for call in self.llm_calls if call['latency'] is not None),
+            'tool_time': 0.0,
+            'memo_hits': 0,
+            'tool_timeouts': 0,
+            'input_tokens': 0,
+            'output_tokens': 0,
+            'cached_input_tokens': 0,
+            'cache_creation_input_tokens': 0,
+            'stop_reasons': {},
+            'tools': {},
+            # Process-wide state of the external services at the end of the run
+            'circuit_breakers': circuit_breaker_metrics(),
+        }
+        for call in self.llm_calls:
+            if call['usage'] is not None:
+                for key in ('input_tokens', 'output_tokens', 'cached_input_tokens', 'cache_creation_input_tokens'):
+                    summary[key] += call['usage'][key]
+            summary['stop_reasons'][call['stop_reason']] = summary['stop_reasons'].get(call['stop_reason'], 0) + 1
+        for item in self.tool_use_chain:
+            if item['tool'] == 'Answer':
+                continue
+            tool_summary = summary['tools'].setdefault(item['tool'], {'calls': 0, 'failures': 0, 'memo_hits': 0, 'timeouts': 0, 'time': 0.0})
+            tool_summary['calls'] += 1
+            tool_summary['failures'] += 0 if item['success'] else 1
+            tool_summary['memo_hits'] += 1 if item['memo_hit'] else 0
+            summary['memo_hits'] += 1 if item['memo_hit'] else 0
+            tool_summary['timeouts'] += 1 if item['timed_out'] else 0
+            summary['tool_timeouts'] += 1 if item['timed_out'] else 0
+            tool_summary['time'] += item['tool_latency']
+            summary['tool_time'] += item['tool_latency']
+        return summary
+
+
 class ToolAgent(object):
     def __init__(
         self,
@@ -137,16 +402,93 @@ class ToolAgent(object):
         init_tools=True,
         include_tools=None,
         exclude_tools=None,
+        stream=False,
+        llm_cache=None,
+        context_budget=None,
+        context_compaction='truncate',
+        memoize_tools=True,
+        annotate_memo_hits=True,
+        tool_cache=None,
+        parallel_tools=False,
+        max_parallel_tools=8,
+        tool_router=None,
+        tool_timeout=None,
+        tool_timeouts=None,
+        run_timeout=None,
+        tool_server_url=None,
     ):
-        """Initialize ChemAgent."""
+        """Initialize ChemAgent.
+        
+        `context_budget` is the approximate token budget of the conversation (or a ContextBudget). Older tool outputs 
+        are truncated or summarized by the LLM (`context_compaction` of 'truncate' or 'summarize') when it is exceeded.
+
+        With `memoize_tools`, a successful tool call is not repeated within a run for the same (normalized) input, and 
+        the earlier result is returned, with a note if `annotate_memo_hits`. `tool_cache` caches tool results across 
+        runs (see `set_tool_cache`).
+
+        With `parallel_tools`, the LLM may call several tools in one step, which are run concurrently with up to 
+        `max_parallel_tools` threads. Their outputs are returned in one message. Calls of stateful tools (e.g., 
+        PythonREPL, which shares one kernel per run) and of tools that are not `thread_safe` still run one after 
+        another in the order they were given.
+
+        `tool_router` (the number of tools, or a ToolRouter) selects the tools relevant to each question, and only 
+        those are described in the system prompt of its run. All tools can still be called.
+
+        Tool calls are cancelled after `tool_timeout` seconds, or `tool_timeouts[tool_name]` for specific tools, and 
+        the LLM gets a timeout observation. A run stops with ChemAgentTimeoutError once it takes longer than 
+        `run_timeout` seconds, and its tool calls are limited to the time left.
+
+        With `tool_server_url`, the tools hosted by a ToolServer are called remotely (see `make_tools`).
+        """
         self.max_iterations = max_iterations
         self.max_error_iterations = max_error_iterations
-
-        self.llm = make_llm(model, api_keys)
+        self.stream = stream
+        self.memoize_tools = memoize_tools
+        self.annotate_memo_hits = annotate_memo_hits
+        self.parallel_tools = parallel_tools
+        self.max_parallel_tools = max_parallel_tools
+        self.tool_timeout = tool_timeout
+        self.tool_timeouts = {} if tool_timeouts is None else dict(tool_timeouts)
+        self.run_timeout = run_timeout
+
+        self.llm = make_llm(model, api_keys, cache=llm_cache)
+
+        if context_budget is not None and not isinstance(context_budget, ContextBudget):
+            context_budget = ContextBudget(context_budget, method=context_compaction, llm=self.llm)
+        self.context_budget = context_budget
         
         if tools is None:
-            tools = make_tools(tools_model, api_keys=api_keys, init=init_tools, include_tools=include_tools, exclude_tools=exclude_tools)
+            tools = make_tools(tools_model, api_keys=api_keys, init=init_tools, include_tools=include_tools, exclude_tools=exclude_tools, llm_cache=llm_cache, tool_cache=tool_cache, tool_server_url=tool_server_url)
+        else:
+            set_tool_cache(tools, tool_cache)
         
+        self._verify_tools(tools)
+
+        self.tools = tools
+        self.tool_dict = {}
+        for tool in self.tools:
+            name = tool.name
+            self.tool_dict[name] = tool
+
+        self.format_instructions = PARALLEL_FORMAT_INSTRUCTIONS if parallel_tools else FORMAT_INSTRUCTIONS
+        if AiExpert.name not in self.tool_dict or (AiExpert.name in self.tool_dict and len(self.tools) == 1):
+            self.format_instructions = self.format_instructions.replace(
+                '- If no other tools are suitable, use the {llm_tool_name} tool to ask questions and obtain analysis.'.format(llm_tool_name=AiExpert.name) + '\n',
+                ''
+            )
+
+        self.tool_names = tuple([tool.name for tool in self.tools])
+        self.tool_strings = self._make_tool_strings(self.tools)
+        # Built once so that the prompt prefix stays byte-identical across steps and runs, which lets providers cache it
+        self.system_prompt = self._make_system_prompt(self.tools)
+
+        if tool_router is not None and not isinstance(tool_router, ToolRouter):
+            tool_router = ToolRouter(self.tools, top_k=tool_router)
+        self.tool_router = tool_router
+        # Keyed by the selected tool names, so that questions with the same tools share a cacheable prefix
+        self._routed_system_prompts = {}
+
+    def _verify_tools(self, tools):
         missing_tools, extra_tools, duplicate_tools = verify_tools(tools)
         abnormal = False
         if len(missing_tools) > 0:
@@ -164,123 +506,415 @@ class ToolAgent(object):
             if c.lower() != 'y':
                 sys.exit(0)
 
-        self.tools = tools
-        self.tool_dict = {}
-        for tool in self.tools:
-            name = tool.name
-            self.tool_dict[name] = tool
-
-        self.format_instructions = FORMAT_INSTRUCTIONS
-        if AiExpert.name not in self.tool_dict or (AiExpert.name in self.tool_dict and len(self.tools) == 1):
-            self.format_instructions = self.format_instructions.replace(
-                '- If no other tools are suitable, use the {llm_tool_name} tool to ask questions and obtain analysis.'.format(llm_tool_name=AiExpert.name) + '\n',
-                ''
-            )
-
-        self.tool_names = tuple([tool.name for tool in self.tools])
-        self.tool_strings = '\n\n'.join(
+    def _make_tool_strings(self, tools):
+        return '\n\n'.join(
             [
                 '{name}: {description}'.format(name=tool.name, description=tool.description) # construct_tool_example_string(tool))
-                for tool in self.tools
+                for tool in tools
             ]
         )
 
-    def run(self, request, demonstration=None, verbose=True, conv_id=None):
-        tool_names = ', '.join(self.tool_names)
-        tool_strings = self.tool_strings
-
-        tool_use_chain = []
-
+    def _make_system_prompt(self, tools):
+        return PREFIX + self.format_instructions.format(tool_names=', '.join([tool.name for tool in tools]), tool_strings=self._make_tool_strings(tools))
+
+    def _route_tools(self, request):
+        """Returns the tool names and the system prompt for a question."""
+        if self.tool_router is None:
+            return self.tool_names, self.system_prompt
+        tools = self.tool_router.select(request)
+        tool_names = tuple([tool.name for tool in tools])
+        if tool_names not in self._routed_system_prompts:
+            self._routed_system_prompts[tool_names] = self._make_system_prompt(tools)
+        system_prompt = self._routed_system_prompts[tool_names]
+        logger.info('Selected %d of %d tools. System prompt: about %d tokens (%d with all tools).' % (len(tool_names), len(self.tool_names), estimate_tokens([{'content': system_prompt}]), estimate_tokens([{'content': self.system_prompt}])))
+        return tool_names, system_prompt
+
+    def prompt_size_report(self, requests):
+        """Estimated system prompt tokens for `requests` with and without the tool router."""
+        full_tokens = estimate_tokens([{'content': self.system_prompt}])
+        tokens, num_tools = [], []
+        for request in requests:
+            tool_names, system_prompt = self._route_tools(request)
+            tokens.append(estimate_tokens([{'content': system_prompt}]))
+            num_tools.append(len(tool_names))
+        return {
+            'num_requests': len(requests),
+            'full_tokens': full_tokens,
+            'full_num_tools': len(self.tool_names),
+            'mean_tokens': sum(tokens) / max(len(tokens), 1),
+            'max_tokens': max(tokens, default=0),
+            'mean_num_tools': sum(num_tools) / max(len(num_tools), 1),
+            'reduction': 1 - sum(tokens) / max(len(tokens), 1) / full_tokens,
+        }
+
+    def run(self, request, demonstration=None, verbose=True, conv_id=None, answer_callback=None, return_summary=False, answer_format=None, step_callback=None):
+        """Returns (tool_use_chain, conversation, conversation_with_icl), followed by the run summary (see 
+        `ToolAgentRun.summary`) if `return_summary` is True. An `answer_format` requirement is added to the question, 
+        so that the final answer can be used without rephrasing. `step_callback` is called with each new entry of the 
+        tool use chain (a tool call with its output, or the final answer) as soon as its step is done."""
+        state = self._start_run(request, demonstration=demonstration, conv_id=conv_id, answer_format=answer_format)
+        num_reported = 0
+        while not state.finished:
+            self._check_iterations(state)
+            self._compact_context(state)
+            start_time = time.perf_counter()
+            llm_output, usage, stop_reason = self._request_llm(state.conversation, cache_prefix_len=1 + state.len_demonstration, answer_callback=answer_callback, timeout=self._run_remaining(state))
+            llm_call = {'usage': usage, 'latency': time.perf_counter() - start_time, 'stop_reason': stop_reason}
+            tool_calls = self._handle_llm_output(state, llm_output, llm_call, verbose=verbose)
+            if len(tool_calls) > 0:
+                tool_results = self._call_tools(state, tool_calls)
+                self._handle_tool_outputs(state, tool_calls, tool_results, verbose=verbose)
+            if step_callback is not None:
+                for item in state.tool_use_chain[num_reported:]:
+                    step_callback(item)
+                num_reported = len(state.tool_use_chain)
+        return self._finish_run(state, return_summary=return_summary)
+
+    def run_batch(self, requests, demonstration=None, verbose=False, conv_ids=None, max_workers=8, return_summary=False, answer_format=None):
+        """Run independent questions in lockstep over the provider's batch API.
+
+        At each step, the pending LLM calls of all unfinished questions are submitted as one batch job, and the 
+        resulting tool calls are run in parallel with up to `max_workers` threads. The questions left without an output 
+        by the batch job (or by a failed batch request) are requested one by one. Returns a list with one item per 
+        question: the same tuple as `run`, or the exception that stopped that question.
+        """
+        if not hasattr(self.llm, 'batch_request'):
+            raise NotImplementedError("Batch requests are not supported by %s." % self.llm.__class__.__name__)
+        if conv_ids is None:
+            conv_ids = [None] * len(requests)
+        assert len(conv_ids) == len(requests)
+
+        states = [
+            self._start_run(request, demonstration=demonstration, conv_id=conv_id, answer_format=answer_format)
+            for request, conv_id in zip(requests, conv_ids)
+        ]
+        errors = {}
+        step = 0
+        while True:
+            active = [idx for idx, state in enumerate(states) if not state.finished and idx not in errors]
+            if len(active) == 0:
+                break
+            step += 1
+            logger.info('Batch step %d: %d of %d questions unfinished.' % (step, len(active), len(states)))
+
+            self.llm.clear_request()
+            for idx in list(active):
+                try:
+                    self._check_iterations(states[idx])
+                except (RuntimeError, ChemAgentTimeoutError) as e:
+                    errors[idx] = e
+                    active.remove(idx)
+                    continue
+                self._compact_context(states[idx])
+                self.llm.add_request(states[idx].conversation, str(idx), stop_sequences=self._stop_sequences(), cache_prefix_len=1 + states[idx].len_demonstration)
+            if len(active) == 0:
+                break
+            start_time = time.perf_counter()
+            try:
+                outputs, _ = self.llm.batch_request()
+                usages = self.llm.batch_usage
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                logger.warning('Batch request failed (%s: %s).' % (e.__class__.__name__, e))
+                outputs, usages = {}, {}
+            finally:
+                self.llm.clear_request()
+            batch_latency = time.perf_counter() - start_time
+
+            llm_results = {}
+            for idx in active:
+                if str(idx) in outputs:
+                    llm_results[idx] = (outputs[str(idx)][1][0], {'usage': usages.get(str(idx)), 'latency': batch_latency, 'stop_reason': None})
+
+            def request_llm(idx):
+                # The questions without a batch output are requested one by one, and an exception stops only that question
+                start_time = time.perf_counter()
+                try:
+                    llm_output, usage, stop_reason = self._request_llm(states[idx].conversation, cache_prefix_len=1 + states[idx].len_demonstration, timeout=self._run_remaining(states[idx]))
+                except Exception as e:
+                    return e
+                return llm_output, {'usage': usage, 'latency': time.perf_counter() - start_time, 'stop_reason': stop_reason}
+
+            fallback = [idx for idx in active if idx not in llm_results]
+            if len(fallback) > 0:
+                logger.info('Requesting %d questions without a batch output one by one.' % len(fallback))
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    for idx, result in zip(fallback, executor.map(request_llm, fallback)):
+                        if isinstance(result, Exception):
+                            errors[idx] = result
+                        else:
+                            llm_results[idx] = result
+
+            tool_calls = []
+            for idx in active:
+                state = states[idx]
+                if idx not in llm_results:
+                    continue
+                llm_output, llm_call = llm_results[idx]
+                try:
+                    step_tool_calls = self._handle_llm_output(state, llm_output, llm_call, verbose=verbose)
+                except ChemAgentOutputError as e:
+                    errors[idx] = e
+                    continue
+                if len(step_tool_calls) > 0:
+                    tool_calls.append((idx, step_tool_calls))
+
+            def call_tool(item):
+                # An exception stops only the question of the call
+                try:
+                    return self._timed_call_tool(states[item[0]], item[1])
+                except Exception as e:
+                    return e
+
+            flat_tool_calls = [(idx, tool_call) for idx, step_tool_calls in tool_calls for tool_call in step_tool_calls]
+            # The stateful tool calls of a question share its state (e.g., its Python kernel), so they run in order
+            lane_keys = [self._tool_lane(tool_call['tool'], idx) for idx, tool_call in flat_tool_calls]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                flat_tool_results = iter(run_in_lanes(executor, call_tool, flat_tool_calls, lane_keys))
+            for idx, step_tool_calls in tool_calls:
+                step_tool_results = [next(flat_tool_results) for _ in step_tool_calls]
+                step_errors = [result for result in step_tool_results if isinstance(result, Exception)]
+                if len(step_errors) > 0:
+                    errors[idx] = step_errors[0]
+                    continue
+                self._handle_tool_outputs(states[idx], step_tool_calls, step_tool_results, verbose=verbose)
+
+        return [errors[idx] if idx in errors else self._finish_run(state, return_summary=return_summary) for idx, state in enumerate(states)]
+
+    def _start_run(self, request, demonstration=None, conv_id=None, answer_format=None):
+        tool_names, system_prompt = self._route_tools(request)
         conversation = [
-            {'role': 'system', 'content': PREFIX + self.format_instructions.format(tool_names=tool_names, tool_strings=tool_strings)},
+            {'role': 'system', 'content': system_prompt},
         ]
 
         if demonstration is not None:
             len_demonstration = len(demonstration)
             assert len_demonstration >= 2
 
+            new_demonstration = []
             for item in demonstration:
-                if item['role'] == 'assistant' and 'Tool Input' in item['content']:
-                    item['content'] = item['content'].rstrip()+'\n<END_INPUT>'
+                if item['role'] == 'assistant' and 'Tool Input' in item['content'] and not item['content'].rstrip().endswith(END_INPUT):
+                    item = {'role': item['role'], 'content': item['content'].rstrip() + '\n' + END_INPUT}
+                new_demonstration.append(item)
 
-            conversation = conversation + demonstration
+            conversation = conversation + new_demonstration
         else:
             len_demonstration = 0
 
         conversation.append(
             {
                 'role': 'user', 
-                'content': QUESTION_PROMPT.format(input=request),
+                'content': QUESTION_PROMPT.format(input=request) + ('' if answer_format is None else ANSWER_FORMAT_PROMPT.format(answer_format=answer_format)),
             }
         )
 
-        enable_print = True
-        idx = 1
-        error_iterations = 0
-        while True:
-            if idx > self.max_iterations:
-                raise RuntimeError("Running exceeds the max iteration limit (%d)." % self.max_iterations)
-
-            llm_output = self.llm.request(conversation, prefix=None, stop_sequences=['<END_INPUT>'])[0]
-            if verbose and enable_print:
-                print_logger.info('--- Step %d ---' % idx)
-                
-            try:
-                thought, action, action_input = self._extract_command(llm_output)
-            except (ChemAgentOutputError, AssertionError):
-                enable_print = False
-                error_iterations += 1
-                if error_iterations >= self.max_error_iterations:
-                    raise ChemAgentOutputError("Failed to extract command from the output after %d iterations.\n%sn" % (self.max_error_iterations, llm_output))
-                logger.debug('Failed to extract command from:\n' + llm_output + '\n\n')
-                continue
+        return ToolAgentRun(request, conversation, len_demonstration, conv_id=conv_id, tool_names=tool_names)
+
+    def _compact_context(self, state):
+        if self.context_budget is None:
+            return
+        # Everything up to the question is static
+        self.context_budget.compact(state.conversation, 2 + state.len_demonstration, state.request, OBSERVATION_TITLE_SC, state.compacted)
+
+    def _check_iterations(self, state):
+        if state.idx > self.max_iterations:
+            raise RuntimeError("Running exceeds the max iteration limit (%d)." % self.max_iterations)
+        if self.run_timeout is not None and time.perf_counter() - state.start_time > self.run_timeout:
+            raise ChemAgentTimeoutError("Running exceeds the time limit (%g seconds)." % self.run_timeout)
+
+    def _handle_llm_output(self, state, llm_output, llm_call, verbose=True):
+        """Record an LLM output and its call statistics (usage, latency and stop reason) in the run. Returns the list 
+        of tool calls to make in this step, which is empty for a final answer or an output that cannot be parsed."""
+        state.llm_calls.append(llm_call)
+        if verbose and state.enable_print:
+            print_logger.info('--- Step %d ---' % state.idx)
+            
+        try:
+            commands = None
+            if self.parallel_tools:
+                command = extract_commands(llm_output)
+                if len(command) == 2:
+                    thought, commands = command
+                else:
+                    thought, _, answer = command
             else:
-                enable_print = True
+                thought, action, action_input = self._extract_command(llm_output)
+                if action is None:
+                    answer = action_input
+                else:
+                    commands = [(action, action_input)]
+        except (ChemAgentOutputError, AssertionError):
+            state.enable_print = False
+            state.error_iterations += 1
+            if state.error_iterations >= self.max_error_iterations:
+                raise ChemAgentOutputError("Failed to extract command from the output after %d iterations.\n%sn" % (self.max_error_iterations, llm_output))
+            logger.debug('Failed to extract command from:\n' + llm_output + '\n\n')
+            return []
+        else:
+            state.enable_print = True
 
-            if action is None:
-                new_line = {
-                    'role': 'assistant', 
-                    'content': llm_output,
-                }
-                conversation.append(new_line)
-                tool_use_chain.append(
-                    {'thought': thought, 'tool': 'Answer', 'input': None, 'output': action_input, 'success': True, 'raw_output': llm_output}
-                )
+        if commands is None:
+            new_line = {
+                'role': 'assistant', 
+                'content': llm_output,
+            }
+            state.conversation.append(new_line)
+            state.tool_use_chain.append(
+                {'thought': thought, 'tool': 'Answer', 'input': None, 'output': answer, 'success': True, 'raw_output': llm_output, 'usage': llm_call['usage'], 'llm_latency': llm_call['latency'], 'stop_reason': llm_call['stop_reason'], 'tool_latency': None, 'memo_hit': False, 'timed_out': False}
+            )
 
-                if verbose:
-                    print_logger.info(llm_output + '\n\n')
+            if verbose:
+                print_logger.info(llm_output + '\n\n')
 
-                break
-            else:
-                new_line = {
-                    'role': 'assistant',
-                    'content': llm_output.rstrip() + '\n<END_INPUT>' if ACTION_INPUT_TITLE_SC in llm_output else llm_output,
-                }
-                conversation.append(new_line)
-
-                if verbose:
-                    print_logger.info(llm_output)
-                
-                success, tool_result = self._call_tool(action, action_input, conv_id=conv_id)
-                new_line = {
-                    'role': 'user',
-                    'content': '%s ' % OBSERVATION_TITLE_SC + str(tool_result),
-                }
-                conversation.append(new_line)
-                tool_use_chain.append(
-                    {'thought': thought, 'tool': action, 'input': action_input, 'output': str(tool_result), 'success': success, 'raw_output': llm_output}
-                )
-
-                if verbose:
-                    print_logger.info('%s %s\n\n' % (OBSERVATION_TITLE_SC, str(tool_result)))
-
-                idx += 1
-        
-        original_conversation = conversation
-        if demonstration is not None:
-            conversation = conversation[:1] + conversation[1 + len_demonstration:]
+            state.finished = True
+            return []
+
+        if self.parallel_tools:
+            content = llm_output.replace(END_TOOLS, '').rstrip() + '\n' + END_TOOLS
+        else:
+            content = llm_output.rstrip() + '\n<END_INPUT>' if ACTION_INPUT_TITLE_SC in llm_output else llm_output
+        new_line = {
+            'role': 'assistant',
+            'content': content,
+        }
+        state.conversation.append(new_line)
+
+        if verbose:
+            print_logger.info(llm_output)
+
+        return [
+            {'thought': thought, 'tool': action, 'input': action_input, 'raw_output': llm_output, 'llm_call': llm_call}
+            for action, action_input in commands
+        ]
+
+    def _call_tools(self, state, tool_calls):
+        """Run the tool calls of one step, concurrently if there are more than one, except that the calls of stateful 
+        tools and of tools that are not thread safe run one after another in their order (see `_tool_lane`). Returns 
+        (success, result, latency) for each call."""
+        if len(tool_calls) == 1:
+            return [self._timed_call_tool(state, tool_calls[0])]
+        lane_keys = [self._tool_lane(tool_call['tool'], state.conv_id) for tool_call in tool_calls]
+        with ThreadPoolExecutor(max_workers=min(self.max_parallel_tools, len(tool_calls))) as executor:
+            return run_in_lanes(executor, lambda tool_call: self._timed_call_tool(state, tool_call), tool_calls, lane_keys)
+
+    def _is_stateful_tool(self, tool_name):
+        """Whether the output of the tool depends on the earlier calls of the run, e.g., PythonREPL."""
+        return tool_name in NON_MEMOIZED_TOOLS or not getattr(self.tool_dict.get(tool_name), 'single_flight', True)
+
+    def _tool_lane(self, tool_name, run_key):
+        """The lane key of a tool call for `run_in_lanes`: the calls of stateful tools run in order within a run, the
+        calls of tools that are not thread safe run in order across runs, and the others run concurrently."""
+        if self._is_stateful_tool(tool_name):
+            return ('run', run_key)
+        if not getattr(self.tool_dict.get(tool_name), 'thread_safe', True):
+            return ('tool', tool_name)
+        return None
+
+    def _timed_call_tool(self, state, tool_call):
+        start_time = time.perf_counter()
+        memo_key = self._memo_key(tool_call['tool'], tool_call['input'])
+        if memo_key is not None and memo_key in state.tool_memo:
+            logger.debug('Reusing the result of an identical %s call.' % tool_call['tool'])
+            tool_call['memo_hit'] = True
+            tool_result = state.tool_memo[memo_key]
+            if self.annotate_memo_hits:
+                tool_result = str(tool_result) + MEMO_HIT_NOTE
+            return True, tool_result, time.perf_counter() - start_time
+
+        timeout = self._tool_timeout(state, tool_call['tool'])
+        tool_call['timed_out'] = False
+        try:
+            success, tool_result = call_with_timeout(lambda: self._call_tool(tool_call['tool'], tool_call['input'], conv_id=state.conv_id), timeout, name=tool_call['tool'])
+        except ChemAgentTimeoutError as e:
+            logger.warning('Tool %s timed out: %s' % (tool_call['tool'], e))
+            tool_call['timed_out'] = True
+            success, tool_result = False, TOOL_TIMEOUT_OBSERVATION.format(tool_name=tool_call['tool'], timeout=timeout)
+        if success and memo_key is not None:
+            state.tool_memo[memo_key] = tool_result
+        return success, tool_result, time.perf_counter() - start_time
+
+    def _tool_timeout(self, state, tool_name):
+        """The time limit of a tool call in seconds, or None."""
+        timeout = self.tool_timeouts.get(tool_name, self.tool_timeout)
+        run_remaining = self._run_remaining(state)
+        if run_remaining is not None:
+            timeout = run_remaining if timeout is None else min(timeout, run_remaining)
+        return timeout
+
+    def _run_remaining(self, state):
+        """Seconds left before `run_timeout`, or None without it."""
+        if self.run_timeout is None:
+            return None
+        return max(self.run_timeout - (time.perf_counter() - state.start_time), 0)
+
+    def _memo_key(self, tool_name, tool_input):
+        if not self.memoize_tools or tool_name not in self.tool_dict or tool_name in NON_MEMOIZED_TOOLS:
+            return None
+        return tool_name, normalize_tool_input(self.tool_dict[tool_name], tool_input)
+
+    def _handle_tool_outputs(self, state, tool_calls, tool_results, verbose=True):
+        """Record the tool outputs of one step: one message in the conversation, and one chain entry per call."""
+        if len(tool_calls) == 1:
+            content = '%s ' % OBSERVATION_TITLE_SC + str(tool_results[0][1])
+        else:
+            content = '\n\n'.join(
+                '%s (%d) %s:\n%s' % (OBSERVATION_TITLE_SC, k + 1, tool_call['tool'], str(tool_result))
+                for k, (tool_call, (_, tool_result, _)) in enumerate(zip(tool_calls, tool_results))
+            )
+        new_line = {
+            'role': 'user',
+            'content': content,
+        }
+        state.conversation.append(new_line)
+        for tool_call, (success, tool_result, tool_latency) in zip(tool_calls, tool_results):
+            llm_call = tool_call['llm_call']
+            state.tool_use_chain.append(
+                {'thought': tool_call['thought'], 'tool': tool_call['tool'], 'input': tool_call['input'], 'output': str(tool_result), 'success': success, 'raw_output': tool_call['raw_output'], 'usage': llm_call['usage'], 'llm_latency': llm_call['latency'], 'stop_reason': llm_call['stop_reason'], 'tool_latency': tool_latency, 'memo_hit': tool_call.get('memo_hit', False), 'timed_out': tool_call.get('timed_out', False)}
+            )
+
+        if verbose:
+            print_logger.info('%s\n\n' % content)
 
-        return tool_use_chain, conversation, original_conversation
+        state.idx += 1
+
+    def _finish_run(self, state, return_summary=False):
+        conversation = state.conversation
+        original_conversation = conversation
+        if state.len_demonstration > 0:
+            conversation = conversation[:1] + conversation[1 + state.len_demonstration:]
+
+        if return_summary:
+            return state.tool_use_chain, conversation, original_conversation, state.summary()
+        return state.tool_use_chain, conversation, original_conversation
+
+    def _stop_sequences(self):
+        if self.parallel_tools:
+            return [END_TOOLS, OBSERVATION_TITLE_SC]
+        return [END_INPUT]
+
+    def _request_llm(self, conversation, cache_prefix_len=None, answer_callback=None, timeout=None):
+        """Request the next LLM output within `timeout` seconds (the time left to the run), including the retries and
+        rate limiting of the requester. Returns (output, usage, stop_reason)."""
+        def request():
+            if not self.stream:
+                output = self.llm.request(conversation, prefix=None, stop_sequences=self._stop_sequences(), cache_prefix_len=cache_prefix_len)[0]
+                return output, self.llm.last_usage, self.llm.last_stop_reason
+
+            parser = StreamingCommandParser(answer_callback=answer_callback, end_marker=END_TOOLS if self.parallel_tools else END_INPUT)
+            stream = self.llm.request_stream(conversation, prefix=None, stop_sequences=self._stop_sequences(), cache_prefix_len=cache_prefix_len)
+            try:
+                for chunk in stream:
+                    check_deadline()
+                    if parser.feed(chunk):
+                        logger.debug('End of tool input detected. Cutting the stream.')
+                        break
+            finally:
+                stream.close()
+            return parser.close(), self.llm.last_usage, self.llm.last_stop_reason
+
+        # The usage is read in the thread of the request, since requesters keep it per thread
+        return call_with_timeout(request, timeout, name='The LLM request')
 
     def _extract_command(self, text):
         return extract_command(text)
@@ -300,6 +934,8 @@ class ToolAgent(object):
                 elif r_strip.startswith('<Figure size') and len(r_strip) > 200:
                     raise ChemAgentOutputError('[Figure not shown]')
                 
+        except ChemAgentTimeoutError:
+            raise
         except ChemAgentGeneralError as e:
             logger.debug("Tool that raised error: " + tool_name)
             return False, 'Error: ' + str(e)
@@ -0,0 +1,71 @@
+import logging
+import math
+import re
+from collections import Counter
+
+from chemagent.tools import AiExpert, Name2SMILES
+
+
+logger = logging.getLogger(__name__)
+
+STOP_WORDS = frozenset(
+    'a an and are as at be by can could do does for from given how i if in input is it its of on or should that the '
+    'their them there these this to use used what when where which who will with would you your'.split()
+)
+
+
+def tokenize(text):
+    """Lowercased words of `text` without stop words, with CamelCase and snake_case names split into their parts."""
+    text = re.sub(r'([a-z0-9])([A-Z])', r'\1 \2', text)
+    text = re.sub(r'([A-Z]+)([A-Z][a-z])', r'\1 \2', text)
+    return [word for word in re.findall(r'[a-z0-9]+', text.lower()) if word not in STOP_WORDS]
+
+
+class ToolRouter(object):
+    """Select the tools relevant to a question with a BM25 index over the tool names and descriptions, so that the
+    system prompt only describes those. The `top_k` best matching tools are selected, plus the tools in
+    `always_include`: by default AiExpert, the fallback for anything the others do not cover, and Name2SMILES, since
+    most tools take SMILES while questions usually name the molecules. If no tool matches, all tools are selected."""
+
+    def __init__(self, tools, top_k=8, always_include=(AiExpert.name, Name2SMILES.name), k1=1.5, b=0.75):
+        self.tools = list(tools)
+        self.top_k = top_k
+        self.always_include = set(always_include)
+        self.k1 = k1
+        self.b = b
+
+        self._docs = [Counter(tokenize('%s %s' % (tool.name, tool.description))) for tool in self.tools]
+        self._doc_lens = [sum(doc.values()) for doc in self._docs]
+        self._avg_doc_len = sum(self._doc_lens) / max(len(self._docs), 1)
+        doc_freqs = Counter(term for doc in self._docs for term in doc)
+        num_docs = len(self._docs)
+        self._idf = {
+            term: math.log(1 + (num_docs - freq + 0.5) / (freq + 0.5))
+            for term, freq in doc_freqs.items()
+        }
+
+    def scores(self, question):
+        terms = tokenize(question)
+        scores = []
+        for doc, doc_len in zip(self._docs, self._doc_lens):
+            score = 0.0
+            for term in terms:
+                freq = doc.get(term, 0)
+                if freq == 0:
+                    continue
+                score += self._idf[term] * freq * (self.k1 + 1) / (freq + self.k1 * (1 - self.b + self.b * doc_len / self._avg_doc_len))
+            scores.append(score)
+        return scores
+
+    def select(self, question):
+        """Returns the selected tools, in their original order."""
+        scores = self.scores(question)
+        ranked = sorted(range(len(self.tools)), key=lambda idx: -scores[idx])
+        selected = set(idx for idx in ranked[:self.top_k] if scores[idx] > 0)
+        if len(selected) == 0:
+            logger.debug('No tool matches the question. Selecting all tools.')
+            return list(self.tools)
+        selected.update(idx for idx, tool in enumerate(self.tools) if tool.name in self.always_include)
+        tools = [tool for idx, tool in enumerate(self.tools) if idx in selected]
+        logger.debug('Selected tools: %s' % ', '.join(tool.name for tool in tools))
+        return tools
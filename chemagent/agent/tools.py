@@ -1,8 +1,12 @@
 import os
+import logging
 
 from chemagent.tools import *
 
 
+logger = logging.getLogger(__name__)
+
+
 ALL_TOOL_NAMES = {
     'PubchemSearchQA',
     'IUPAC2SMILES',
@@ -36,7 +40,9 @@ ALL_TOOL_NAMES = {
 }
 
 
-def make_tools(llm, api_keys: dict = {}, init=True, include_tools=None, exclude_tools=None):
+def make_tools(llm, api_keys: dict = {}, init=True, include_tools=None, exclude_tools=None, llm_cache=None, tool_cache=None, tool_server_url=None):
+    """With `tool_server_url`, the tools hosted by that ToolServer (see chemagent/tools/tool_server.py) are used 
+    through RemoteTool proxies, and only the others are initialized in this process."""
     tavily_api_key = api_keys.get("TAVILY_API_KEY") or os.getenv("TAVILY_API_KEY")
     rxn4chem_api_key = api_keys.get("RXN4CHEM_API_KEY") or os.getenv("RXN4CHEM_API_KEY")
     openai_api_key = api_keys.get("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
@@ -45,67 +51,92 @@ def make_tools(llm, api_keys: dict = {}, init=True, include_tools=None, exclude_
         "CHEMSPACE_API_KEY"
     )
 
-    all_tools = []
-
-    all_tools += [
-        PubchemSearchQA(api_keys={'OPENAI_API_KEY': openai_api_key, 'ANTHROPIC_API_KEY': anthropic_api_key}, init=init),
-        IUPAC2SMILES(chemspace_api_key, init=init),
-        SMILES2IUPAC(init=init),
-        Name2SMILES(init=init),
-        SMILES2SELFIES(init=init),
-        SELFIES2SMILES(init=init),
-        SMILES2Formula(init=init),
-        PatentCheck(init=init),
-        CanonicalizeSMILES(init=init),
-        CompareSMILES(init=init),
-        CountMolAtoms(init=init),
-        MolSimilarity(init=init),
-        SMILES2Weight(init=init),
-        FuncGroups(init=init),
-        GetMoleculePrice(chemspace_api_key, init=init),
-        Wikipedia(init=init),
-        PropertyPredictorESOL(init=init),
-        PropertyPredictorLIPO(init=init),
-        PropertyPredictorBBBP(init=init),
-        PropertyPredictorClinTox(init=init),
-        PropertyPredictorHIV(init=init),
-        PropertyPredictorSIDER(init=init),
-        PythonShell(init=init),
-        MoleculeCaptioner(init=init),
-        MoleculeGenerator(init=init),
+    llm_api_keys = {'OPENAI_API_KEY': openai_api_key, 'ANTHROPIC_API_KEY': anthropic_api_key}
+    # (tool class, args, kwargs), so that only the selected tools are created and initialized
+    tool_specs = [
+        (PubchemSearchQA, (), {'api_keys': llm_api_keys, 'llm_model': llm, 'llm_cache': llm_cache}),
+        (IUPAC2SMILES, (chemspace_api_key,), {}),
+        (SMILES2IUPAC, (), {}),
+        (Name2SMILES, (), {}),
+        (SMILES2SELFIES, (), {}),
+        (SELFIES2SMILES, (), {}),
+        (SMILES2Formula, (), {}),
+        (PatentCheck, (), {}),
+        (CanonicalizeSMILES, (), {}),
+        (CompareSMILES, (), {}),
+        (CountMolAtoms, (), {}),
+        (MolSimilarity, (), {}),
+        (SMILES2Weight, (), {}),
+        (FuncGroups, (), {}),
+        (GetMoleculePrice, (chemspace_api_key,), {}),
+        (Wikipedia, (), {}),
+        (PropertyPredictorESOL, (), {}),
+        (PropertyPredictorLIPO, (), {}),
+        (PropertyPredictorBBBP, (), {}),
+        (PropertyPredictorClinTox, (), {}),
+        (PropertyPredictorHIV, (), {}),
+        (PropertyPredictorSIDER, (), {}),
+        (PythonShell, (), {}),
+        (MoleculeCaptioner, (), {}),
+        (MoleculeGenerator, (), {}),
     ]
     if rxn4chem_api_key:
-        all_tools += [
-            ForwardSynthesis(rxn4chem_api_key, init=init),
-            Retrosynthesis(rxn4chem_api_key, init=init),
+        tool_specs += [
+            (ForwardSynthesis, (rxn4chem_api_key,), {}),
+            (Retrosynthesis, (rxn4chem_api_key,), {}),
         ]
     if tavily_api_key:
-        all_tools += [WebSearch(tavily_api_key, init=init)]
-    all_tools += [
-        AiExpert(api_keys={'OPENAI_API_KEY': openai_api_key, 'ANTHROPIC_API_KEY': anthropic_api_key}, model=llm, init=init)
+        tool_specs += [(WebSearch, (tavily_api_key,), {})]
+    tool_specs += [
+        (AiExpert, (), {'api_keys': llm_api_keys, 'model': llm, 'llm_cache': llm_cache}),
     ]
 
-    final_tools = []
     if include_tools is not None:
         include_tools = set(include_tools)
         assert exclude_tools is None
-
-        for tool in all_tools:
-            if tool.name in include_tools:
-                final_tools.append(tool)
+        tool_specs = [spec for spec in tool_specs if spec[0].name in include_tools]
     elif exclude_tools is not None:
         exclude_tools = set(exclude_tools)
         assert include_tools is None
+        tool_specs = [spec for spec in tool_specs if spec[0].name not in exclude_tools]
 
-        for tool in all_tools:
-            if tool.name not in exclude_tools:
-                final_tools.append(tool)
+    if tool_server_url is None:
+        final_tools = [tool_class(*args, init=init, **kwargs) for tool_class, args, kwargs in tool_specs]
     else:
-        final_tools = all_tools
+        final_tools = use_remote_tools(tool_specs, tool_server_url, init=init)
+
+    set_tool_cache(final_tools, tool_cache)
 
     return final_tools
 
 
+def set_tool_cache(tools, tool_cache):
+    """Let the tools cache their results in `tool_cache` (a ToolCache, 'memory', or a SQLite or '.lmdb' path), 
+    following each tool's cache policy."""
+    tool_cache = get_tool_cache(tool_cache)
+    if tool_cache is None:
+        return
+    for tool in tools:
+        tool.cache = tool_cache
+
+
+def use_remote_tools(tool_specs, tool_server_url, interface='text', init=True):
+    """Make the tools of `tool_specs` ((tool class, args, kwargs) tuples), as RemoteTool proxies if they are hosted by 
+    the ToolServer at `tool_server_url`. Only the others are created in this process, and initialized if `init`."""
+    from chemagent.tools.tool_server import make_remote_tools
+
+    tool_names = {tool_class.name for tool_class, _, _ in tool_specs}
+    remote_tools = {tool.name: tool for tool in make_remote_tools(tool_server_url, interface=interface, include_tools=tool_names)}
+    logger.info('Using %d tools from the tool server at %s: %s' % (len(remote_tools), tool_server_url, ', '.join(sorted(remote_tools))))
+    tools = []
+    for tool_class, args, kwargs in tool_specs:
+        if tool_class.name in remote_tools:
+            tools.append(remote_tools[tool_class.name])
+        else:
+            tools.append(tool_class(*args, init=init, **kwargs))
+    return tools
+
+
 def verify_tools(tools):
     # Referring to ALL_TOOL_NAMES, check if all tools are included in the list of tools
     # The tool name can be obtained with tool.name
@@ -123,7 +154,7 @@ def verify_tools(tools):
     return missing_tools, extra_tools, duplicate_tools
 
 
-def make_code_tools(llm, api_keys: dict = {}, init=True):
+def make_code_tools(llm, api_keys: dict = {}, init=True, llm_cache=None, tool_cache=None, tool_server_url=None):
     tavily_api_key = api_keys.get("TAVILY_API_KEY") or os.getenv("TAVILY_API_KEY")
     rxn4chem_api_key = api_keys.get("RXN4CHEM_API_KEY") or os.getenv("RXN4CHEM_API_KEY")
     openai_api_key = api_keys.get("OPENAI_API_KEY") or os.getenv("OPENAI_API_KEY")
@@ -132,40 +163,47 @@ def make_code_tools(llm, api_keys: dict = {}, init=True):
         "CHEMSPACE_API_KEY"
     )
 
-    all_tools = []
-
-    all_tools += [
-        PubchemSearchQA(api_keys={'OPENAI_API_KEY': openai_api_key, 'ANTHROPIC_API_KEY': anthropic_api_key}, init=init, interface='code'),
-        IUPAC2SMILES(chemspace_api_key, init=init, interface='code'),
-        SMILES2IUPAC(init=init, interface='code'),
-        SMILES2SELFIES(init=init, interface='code'),
-        SELFIES2SMILES(init=init, interface='code'),
-        SMILES2Formula(init=init, interface='code'),
-        PatentCheck(init=init, interface='code'),
-        CanonicalizeSMILES(init=init, interface='code'),
-        CompareSMILES(init=init, interface='code'),
-        CountMolAtoms(init=init, interface='code'),
-        MolSimilarity(init=init, interface='code'),
-        SMILES2Weight(init=init, interface='code'),
-        FuncGroups(init=init, interface='code'),
-        GetMoleculePrice(chemspace_api_key, init=init, interface='code'),
-        Wikipedia(init=init, interface='code'),
-        PythonShell(init=init, interface='code'),
-        MoleculeCaptioner(init=init, interface='code'),
-        MoleculeGenerator(init=init, interface='code'),
+    llm_api_keys = {'OPENAI_API_KEY': openai_api_key, 'ANTHROPIC_API_KEY': anthropic_api_key}
+    tool_specs = [
+        (PubchemSearchQA, (), {'api_keys': llm_api_keys, 'llm_model': llm, 'llm_cache': llm_cache}),
+        (IUPAC2SMILES, (chemspace_api_key,), {}),
+        (SMILES2IUPAC, (), {}),
+        (SMILES2SELFIES, (), {}),
+        (SELFIES2SMILES, (), {}),
+        (SMILES2Formula, (), {}),
+        (PatentCheck, (), {}),
+        (CanonicalizeSMILES, (), {}),
+        (CompareSMILES, (), {}),
+        (CountMolAtoms, (), {}),
+        (MolSimilarity, (), {}),
+        (SMILES2Weight, (), {}),
+        (FuncGroups, (), {}),
+        (GetMoleculePrice, (chemspace_api_key,), {}),
+        (Wikipedia, (), {}),
+        (PythonShell, (), {}),
+        (MoleculeCaptioner, (), {}),
+        (MoleculeGenerator, (), {}),
     ]
     if rxn4chem_api_key:
-        all_tools += [
-            ForwardSynthesis(rxn4chem_api_key, init=init, interface='code'),
-            Retrosynthesis(rxn4chem_api_key, init=init, interface='code'),
-            # RXNRetrosynthesis(rxn4chem_api_key, openai_api_key, init=init),
+        tool_specs += [
+            (ForwardSynthesis, (rxn4chem_api_key,), {}),
+            (Retrosynthesis, (rxn4chem_api_key,), {}),
+            # (RXNRetrosynthesis, (rxn4chem_api_key, openai_api_key), {}),
         ]
     if tavily_api_key:
-        all_tools += [WebSearch(tavily_api_key, init=init, interface='code')]
+        tool_specs += [(WebSearch, (tavily_api_key,), {})]
     if openai_api_key:
-        all_tools += [
-            AiExpert(api_keys={'OPENAI_API_KEY': openai_api_key, 'ANTHROPIC_API_KEY': anthropic_api_key}, model=llm, init=init, interface='code')
+        tool_specs += [
+            (AiExpert, (), {'api_keys': llm_api_keys, 'model': llm, 'llm_cache': llm_cache}),
         ]
+    tool_specs = [(tool_class, args, dict(kwargs, interface='code')) for tool_class, args, kwargs in tool_specs]
+
+    if tool_server_url is None:
+        all_tools = [tool_class(*args, init=init, **kwargs) for tool_class, args, kwargs in tool_specs]
+    else:
+        all_tools = use_remote_tools(tool_specs, tool_server_url, interface='code', init=init)
+
+    set_tool_cache(all_tools, tool_cache)
 
     return all_tools
 
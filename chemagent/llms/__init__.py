@@ -1,17 +1,52 @@
+import os
+
 import openai
 from .openai_llm import GptRequester, NewGptRequester
 from .anthropic_llm import ClaudeRequester
+from .clients import get_client, configure_clients, close_clients
+from .rate_limit import configure_rate_limit
+from .cache import ResponseCache, get_response_cache
+from .cassette import Cassette, use_cassette, set_active_cassette, get_active_cassette
+from .hedge import HedgedRequester
+
+
+MOCK_LLM_BASE_URL = 'http://localhost:8900'
 
 
-def make_llm(model, api_keys, **kwargs):
-    if model.startswith("gpt") or model.startswith('o1'):
-        api_key = api_keys['OPENAI_API_KEY']
+def _get_api_key(api_keys, name, cassette=None):
+    api_key = api_keys.get(name) or os.getenv(name)
+    if api_key is None:
+        cassette = cassette if cassette is not None else get_active_cassette()
+        if cassette is not None and cassette.replaying:
+            # Nothing is sent to the provider when replaying, so the key is never used
+            api_key = 'replay'
+    return api_key
+
+
+def make_llm(model, api_keys, cache_ttl=None, cache_max_entries=None, **kwargs):
+    """`cache` is a ResponseCache or the path of one, whose entries expire after `cache_ttl` seconds, and which keeps 
+    at most `cache_max_entries` entries. The other arguments are passed to the requester."""
+    if kwargs.get('cache') is not None:
+        kwargs['cache'] = get_response_cache(kwargs['cache'], ttl=cache_ttl, max_entries=cache_max_entries)
+    if model.startswith("hedge:"):
+        # Hedged requests, e.g., "hedge:claude-3-5-sonnet-20240620|gpt-4o-2024-08-06"
+        primary_model, secondary_model = model[len("hedge:"):].split('|')
+        return HedgedRequester(make_llm(primary_model, api_keys, **kwargs), make_llm(secondary_model, api_keys, **kwargs))
+    if model.startswith("mock-"):
+        # The local mock server (python_server/mock_llm.py), e.g., "mock-gpt-4o" or "mock-claude-3-5-sonnet"
+        base_url = (api_keys.get('MOCK_LLM_BASE_URL') or os.getenv('MOCK_LLM_BASE_URL') or MOCK_LLM_BASE_URL).rstrip('/')
+        if model.startswith("mock-claude"):
+            llm = ClaudeRequester(api_code='mock', model_name=model, base_url=base_url, **kwargs)
+        else:
+            llm = NewGptRequester(api_code='mock', model_name=model, base_url=base_url + '/v1', **kwargs)
+    elif model.startswith("gpt") or model.startswith('o1'):
+        api_key = _get_api_key(api_keys, 'OPENAI_API_KEY', cassette=kwargs.get('cassette'))
         if openai.__version__.startswith('0.'):
             llm = GptRequester(api_code=api_key, model_name=model, **kwargs)
         else:
             llm = NewGptRequester(api_code=api_key, model_name=model, **kwargs)
     elif model.startswith("claude"):
-        api_key = api_keys['ANTHROPIC_API_KEY']
+        api_key = _get_api_key(api_keys, 'ANTHROPIC_API_KEY', cassette=kwargs.get('cassette'))
         llm = ClaudeRequester(api_code=api_key, model_name=model, **kwargs)
     else:
         raise NotImplementedError(f"Support for model {model} not implemented.")
@@ -1,83 +1,210 @@
-from anthropic import Anthropic
-import time
 import warnings
-from copy import deepcopy
 import logging
 
-from .requester import LLMRequester
+import anthropic
+
+from .requester import LLMRequester, make_usage, prepare_messages
+from .batch import BatchRequester
+from .rate_limit import estimate_tokens
+from .clients import get_client
 
 
 logger = logging.getLogger(__name__)
 
 
-class ClaudeRequester(LLMRequester):
-    def __init__(self, api_code, model_name='claude-3-opus-20240229', trial_time=1, sleep_time=5, use_user_prompt_for_system_prompt=False):
-        super().__init__(api_code, model_name, trial_time, sleep_time)
-        self.client = Anthropic(api_key=self.api_code)
+PROMPT_CACHING_BETA = 'prompt-caching-2024-07-31'
+
+
+def _cacheable(message):
+    content = message['content']
+    if isinstance(content, str):
+        content = [{'type': 'text', 'text': content}]
+    else:
+        content = [dict(block) for block in content]
+    content[-1]['cache_control'] = {'type': 'ephemeral'}
+    return {'role': message['role'], 'content': content}
+
+
+def _parse_usage(usage):
+    if usage is None:
+        return None
+    cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+    cache_creation = getattr(usage, 'cache_creation_input_tokens', None) or 0
+    return make_usage(
+        input_tokens=(usage.input_tokens or 0) + cache_read + cache_creation,
+        output_tokens=usage.output_tokens or 0,
+        cached_input_tokens=cache_read,
+        cache_creation_input_tokens=cache_creation,
+    )
+
+
+class ClaudeRequester(BatchRequester, LLMRequester):
+    max_batch_requests = 100000
+    max_batch_bytes = 250 * 1024 * 1024
+
+    def __init__(self, api_code, model_name='claude-3-opus-20240229', trial_time=5, sleep_time=5, use_user_prompt_for_system_prompt=False, base_url=None, cache=None, cassette=None):
+        super().__init__(api_code, model_name, trial_time, sleep_time, cache=cache, cassette=cassette)
+        self.client = get_client('anthropic', self.api_code, base_url=base_url)
+        self._batched_request = []
+        self.custom_ids = set()
         self.use_user_prompt_for_system_prompt = use_user_prompt_for_system_prompt
 
-    def request(self, conversation, num_return=1, max_tokens=2048, prefix=None, stop_sequences=None):
-        conversation = deepcopy(conversation)
-        if prefix is not None:
-            assert conversation[-1]['role'] == 'user'
-            prefix = prefix.rstrip()
-            conversation.append({'role': 'assistant', 'content': prefix})
+    def _prepare_conversation(self, conversation, prefix=None, cache_prefix_len=None):
+        has_system = conversation[0]['role'] == 'system'
+        system_prompt, conversation, prefix = prepare_messages(
+            conversation, prefix=prefix, split_system=True, merge_system=self.use_user_prompt_for_system_prompt
+        )
+        if cache_prefix_len is not None and has_system:
+            cache_prefix_len -= 1
+            if self.use_user_prompt_for_system_prompt:
+                cache_prefix_len = max(cache_prefix_len, 1)
+
+        # Mark the end of the static part of the prompt (system prompt and demonstrations) as cacheable
+        if cache_prefix_len is not None:
+            if system_prompt is not None:
+                system_prompt = [{'type': 'text', 'text': system_prompt, 'cache_control': {'type': 'ephemeral'}}]
+            if cache_prefix_len > 0:
+                conversation[cache_prefix_len - 1] = _cacheable(conversation[cache_prefix_len - 1])
+
+        return system_prompt, conversation, prefix
+
+    def _make_kwargs(self, system_prompt, stop_sequences, cache_prefix_len):
+        kwargs = {}
+        if system_prompt is not None:
+            kwargs['system'] = system_prompt
+        if stop_sequences is not None:
+            kwargs['stop_sequences'] = stop_sequences
+        if cache_prefix_len is not None:
+            kwargs['extra_headers'] = {'anthropic-beta': PROMPT_CACHING_BETA}
+        return kwargs
 
+    def request(self, conversation, num_return=1, max_tokens=2048, prefix=None, stop_sequences=None, cache_prefix_len=None):
+        """`cache_prefix_len` is the number of leading messages (including the system prompt) that are static across requests, and will be cached."""
         if num_return > 1:
             warnings.warn(
                 "Claude API does not support num_return > 1. Using num_return = 1."
             )
 
-        system_prompt = None
-        if conversation[0]['role'] == 'system':
-            system_prompt = conversation[0]['content']
-            conversation = conversation[1:]
-        
-        if system_prompt is not None and self.use_user_prompt_for_system_prompt:
-            assert conversation[0]['role'] == 'user'
-            conversation[0]['content'] = system_prompt + '\n\n' + conversation[0]['content']
-
-        k = 0
-        while True:
-            try:
-                if system_prompt is not None:
-                    if self.use_user_prompt_for_system_prompt:
-                        r = self.client.messages.create(
-                            max_tokens=max_tokens,
-                            messages=conversation,
-                            model=self.model_name,
-                            stop_sequences=stop_sequences,
-                        )
-                    else:
-                        r = self.client.messages.create(
-                            max_tokens=max_tokens,
-                            system=system_prompt,
-                            messages=conversation,
-                            model=self.model_name,
-                            stop_sequences=stop_sequences,
-                        )
-                else:
-                    r = self.client.messages.create(
-                        max_tokens=max_tokens,
-                        messages=conversation,
-                        model=self.model_name,
-                        stop_sequences=stop_sequences,
-                    )
-            except KeyboardInterrupt:
-                raise
-            except:
-                if k >= self.trial_time:
-                    raise
-                k += 1
-                time.sleep(self.sleep_time)
-                continue
-            else:
-                if r.stop_reason == 'stop_sequence':
-                    logger.info('Stop sequence detected.')
-                break
+        response_key = self._response_key(conversation, prefix=prefix, stop_sequences=stop_sequences, max_tokens=max_tokens)
+        output_list = self._lookup_response(response_key, conversation=conversation)
+        if output_list is not None:
+            return output_list
+        original_conversation = conversation
+
+        system_prompt, conversation, prefix = self._prepare_conversation(conversation, prefix=prefix, cache_prefix_len=cache_prefix_len)
+        kwargs = self._make_kwargs(system_prompt, stop_sequences, cache_prefix_len)
+
+        r = self._call_with_retry(
+            lambda: self.client.messages.with_raw_response.create(
+                max_tokens=max_tokens,
+                messages=conversation,
+                model=self.model_name,
+                **kwargs,
+                **self._timeout_kwargs(),
+            ),
+            num_tokens=estimate_tokens(conversation),
+        )
+        if r.stop_reason == 'stop_sequence':
+            logger.info('Stop sequence detected.')
+
+        self._record_usage(_parse_usage(r.usage), stop_reason=r.stop_reason)
 
         output_list = []
         response = r.content[0].text.rstrip()
         output_list.append((prefix + response) if prefix is not None else response)
+
+        self._store_response(response_key, output_list, conversation=original_conversation)
         
         return output_list
+
+    def request_stream(self, conversation, max_tokens=2048, prefix=None, stop_sequences=None, cache_prefix_len=None):
+        response_key = self._response_key(conversation, prefix=prefix, stop_sequences=stop_sequences, max_tokens=max_tokens)
+        output_list = self._lookup_response(response_key, conversation=conversation)
+        if output_list is not None:
+            yield output_list[0]
+            return
+        original_conversation = conversation
+
+        system_prompt, conversation, prefix = self._prepare_conversation(conversation, prefix=prefix, cache_prefix_len=cache_prefix_len)
+        kwargs = self._make_kwargs(system_prompt, stop_sequences, cache_prefix_len)
+
+        stream = self._call_with_retry(
+            lambda: self.client.messages.with_raw_response.create(
+                max_tokens=max_tokens,
+                messages=conversation,
+                model=self.model_name,
+                stream=True,
+                **kwargs,
+                **self._timeout_kwargs(),
+            ),
+            num_tokens=estimate_tokens(conversation),
+        )
+        self._stream_opened(stream)
+
+        self._record_usage(None)
+        usage = None
+        chunks = []
+        try:
+            if prefix is not None:
+                yield prefix
+            for event in stream:
+                if event.type == 'message_start':
+                    usage = event.message.usage
+                    self._record_usage(_parse_usage(usage))
+                elif event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                    chunks.append(event.delta.text)
+                    yield event.delta.text
+                elif event.type == 'message_delta':
+                    if usage is not None:
+                        usage.output_tokens = event.usage.output_tokens
+                    self._record_usage(_parse_usage(usage), stop_reason=event.delta.stop_reason)
+                    if event.delta.stop_reason == 'stop_sequence':
+                        logger.info('Stop sequence detected.')
+        finally:
+            stream.close()
+
+        # Only complete streams are cached
+        response = ''.join(chunks).rstrip()
+        self._store_response(response_key, [(prefix + response) if prefix is not None else response], conversation=original_conversation)
+
+    def _is_retryable(self, e):
+        if isinstance(e, (anthropic.APITimeoutError, anthropic.APIConnectionError, anthropic.RateLimitError, anthropic.InternalServerError)):
+            return True
+        return super()._is_retryable(e)
+
+    def _make_batch_item(self, conversation, custom_id, kwargs):
+        """`kwargs` of `add_request` may contain `max_tokens`, `prefix`, `stop_sequences` and `cache_prefix_len`."""
+        cache_prefix_len = kwargs.get('cache_prefix_len')
+        system_prompt, messages, _ = self._prepare_conversation(conversation, prefix=kwargs.get('prefix'), cache_prefix_len=cache_prefix_len)
+        params = {
+            'model': self.model_name,
+            'max_tokens': kwargs.get('max_tokens', 2048),
+            'messages': messages,
+        }
+        if system_prompt is not None:
+            params['system'] = system_prompt
+        if kwargs.get('stop_sequences') is not None:
+            params['stop_sequences'] = kwargs['stop_sequences']
+        return {'custom_id': custom_id, 'params': params}
+
+    def _submit_batch(self, items):
+        return self.client.messages.batches.create(requests=items).id
+
+    def _retrieve_batch(self, batch_id):
+        batch_object = self.client.messages.batches.retrieve(batch_id)
+        if batch_object.processing_status != 'ended':
+            return batch_object.processing_status
+        request_counts = batch_object.request_counts
+        if request_counts.canceled > 0:
+            return 'cancelled'
+        if request_counts.expired > 0:
+            return 'expired'
+        return 'completed'
+
+    def _iter_batch_results(self, batch_id):
+        for item in self.client.messages.batches.results(batch_id):
+            if item.result.type != 'succeeded':
+                yield item.custom_id, None, None
+                continue
+            message = item.result.message
+            yield item.custom_id, [message.content[0].text.rstrip()], _parse_usage(message.usage)
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+
+def fingerprint_requests(requests):
+    """A stable hash of the (custom_id, item) pairs sent by a `batch_request` call."""
+    text = json.dumps(requests, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class BatchManifest(object):
+    """The batch jobs submitted for one `batch_request` call, persisted to a JSON file so that the call can be resumed
+    after the process restarts. Without a path, the manifest is kept in memory only.
+
+    The file is resumed only if it was saved for the same requests (`fingerprint`), and it is removed once the call
+    is finished, so that a later call never reads the outputs or the submission rounds of other requests."""
+
+    def __init__(self, path=None, fingerprint=None):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.batches = []
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('fingerprint') != fingerprint:
+                logger.warning('Batch manifest %s was saved for other requests. Starting over.' % path)
+            else:
+                self.batches = data['batches']
+                logger.info('Resuming %d batches from %s.' % (len(self.batches), path))
+
+    @property
+    def attempt(self):
+        """The latest submission round, or -1 if nothing is submitted yet."""
+        return max([item['attempt'] for item in self.batches], default=-1)
+
+    def add_batch(self, batch_id, custom_ids, attempt):
+        self.batches.append({'id': batch_id, 'custom_ids': custom_ids, 'attempt': attempt, 'status': 'in_progress'})
+        self.save()
+
+    def set_status(self, batch_id, status):
+        for item in self.batches:
+            if item['id'] == batch_id:
+                item['status'] = status
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        dir_name = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(dir_name, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': self.fingerprint, 'batches': self.batches}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        self.batches = []
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def chunk_batch_items(items, max_requests, max_bytes):
+    """Split (custom_id, item) pairs into chunks of at most `max_requests` items and `max_bytes` bytes of JSON Lines."""
+    chunk, chunk_bytes = [], 0
+    for custom_id, item in items:
+        num_bytes = len(json.dumps(item).encode('utf-8')) + 1
+        if len(chunk) > 0 and (len(chunk) >= max_requests or chunk_bytes + num_bytes > max_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append((custom_id, item))
+        chunk_bytes += num_bytes
+    if len(chunk) > 0:
+        yield chunk
+
+
+class BatchRequester(object):
+    """Mixin implementing `add_request`/`batch_request` on top of a provider batch API.
+
+    Subclasses set `self._batched_request = []` and `self.custom_ids = set()` and implement `_make_batch_item`,
+    `_submit_batch`, `_retrieve_batch` and `_iter_batch_results`.
+
+    `batch_request` submits the queued requests in chunks within the provider limits, polls the jobs, and resubmits
+    the requests that failed, expired or were cancelled, up to `batch_trial_time` rounds. With a `manifest` path, the
+    batch ids are saved as soon as they are created, and calling `batch_request` again with the same requests and
+    manifest picks up the submitted jobs instead of submitting them again. The manifest is removed once the call
+    returns. The token usage of each output of the latest call is kept in `batch_usage`, by custom_id.
+    """
+
+    max_batch_requests = 50000
+    max_batch_bytes = 190 * 1024 * 1024
+    batch_trial_time = 3
+    poll_interval = 5
+    max_poll_interval = 60
+
+    def add_request(self, conversation, custom_id, num_return=1, *args, **kwargs):
+        if num_return != 1:
+            raise NotImplementedError("num_return must be 1 for batch_request. Whether more than 1 is supported is not checked yet.")
+        if custom_id in self.custom_ids:
+            raise ValueError("custom_id already exists.")
+        if custom_id is not None:
+            self.custom_ids.add(custom_id)
+        self._batched_request.append((conversation, custom_id, args, kwargs))
+
+    @property
+    def batch_usage(self):
+        return getattr(self, '_batch_usage', {})
+
+    def clear_request(self):
+        self._batched_request.clear()
+        self.custom_ids.clear()
+
+    def get_batched_request(self):
+        requests = []
+        conversations = {}
+        other_info = {}
+        for idx, (conv, custom_id, args, kwargs) in enumerate(self._batched_request):
+            if custom_id is None:
+                custom_id = str(idx)
+            requests.append((custom_id, self._make_batch_item(conv, custom_id, kwargs)))
+            conversations[custom_id] = conv
+            other_info[custom_id] = (args, kwargs)
+        return requests, conversations, other_info
+
+    def batch_request(self, manifest=None):
+        """Run the queued requests. Returns (outputs, failed_samples), where `outputs` maps each successful custom_id
+        to (conversation, output_list, (args, kwargs)) and `failed_samples` lists the custom_ids without an output."""
+        if self._batched_request is None or len(self._batched_request) == 0:
+            return {}, []
+        requests, conversations, other_info = self.get_batched_request()
+        manifest = BatchManifest(manifest, fingerprint=fingerprint_requests(requests))
+
+        outputs = {}
+        self._batch_usage = {}
+        collected = set()
+        while True:
+            self._wait_batches(manifest)
+            for item in manifest.batches:
+                if item['id'] in collected:
+                    continue
+                for custom_id, output, usage in self._iter_batch_results(item['id']):
+                    if output is None or custom_id not in conversations:
+                        continue
+                    prefix = other_info[custom_id][1].get('prefix')
+                    output = [(prefix.rstrip() + response) if prefix is not None else response for response in output]
+                    outputs[custom_id] = (conversations[custom_id], output, other_info[custom_id])
+                    self._batch_usage[custom_id] = usage
+                collected.add(item['id'])
+
+            remaining = [(custom_id, request) for custom_id, request in requests if custom_id not in outputs]
+            attempt = manifest.attempt + 1
+            if len(remaining) == 0 or attempt >= self.batch_trial_time:
+                break
+            if attempt > 0:
+                logger.info('Resubmitting %d failed requests (round %d).' % (len(remaining), attempt + 1))
+            for chunk in chunk_batch_items(remaining, self.max_batch_requests, self.max_batch_bytes):
+                batch_id = self._submit_batch([request for _, request in chunk])
+                manifest.add_batch(batch_id, [custom_id for custom_id, _ in chunk], attempt)
+                logger.info('Submitted batch %s with %d requests.' % (batch_id, len(chunk)))
+
+        manifest.clear()
+        failed_samples = [custom_id for custom_id, _ in requests if custom_id not in outputs]
+        if len(failed_samples) > 0:
+            logger.warning('%d of %d batched requests failed.' % (len(failed_samples), len(requests)))
+        return outputs, failed_samples
+
+    def _wait_batches(self, manifest):
+        interval = self.poll_interval
+        try:
+            while True:
+                pending = [item for item in manifest.batches if item['status'] not in TERMINAL_STATUSES]
+                for item in pending:
+                    status = self._retrieve_batch(item['id'])
+                    if status != item['status']:
+                        logger.info('Batch %s is %s.' % (item['id'], status))
+                        manifest.set_status(item['id'], status)
+                if all(item['status'] in TERMINAL_STATUSES for item in pending):
+                    return
+                time.sleep(interval)
+                interval = min(interval * 1.5, self.max_poll_interval)
+        except KeyboardInterrupt:
+            if manifest.path is not None:
+                logger.info('Interrupted. Call batch_request with manifest %s to resume.' % manifest.path)
+            raise
+
+    def _make_batch_item(self, conversation, custom_id, kwargs):
+        """Return the provider request for one queued conversation."""
+        raise NotImplementedError
+
+    def _submit_batch(self, items):
+        """Submit a list of provider requests as one batch job and return its id."""
+        raise NotImplementedError
+
+    def _retrieve_batch(self, batch_id):
+        """Return the status of a batch, which is one of TERMINAL_STATUSES once the batch is finished."""
+        raise NotImplementedError
+
+    def _iter_batch_results(self, batch_id):
+        """Yield (custom_id, output_list, usage) for each request of a finished batch, with None as the output of failed
+        ones. `usage` is given by `make_usage` (chemagent/llms/requester.py), or None if not reported."""
+        raise NotImplementedError
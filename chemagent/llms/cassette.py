@@ -0,0 +1,93 @@
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from chemagent.utils.error import ChemAgentReplayMissError
+
+
+logger = logging.getLogger(__name__)
+
+
+class Cassette(object):
+    """Record LLM request/response pairs to a JSON Lines file, or replay them without network access.
+
+    In 'record' mode, every response obtained from the provider or the response cache is appended to the file 
+    together with its request. In 'replay' mode, requests are answered from the file only, and a request that was 
+    not recorded raises ChemAgentReplayMissError. Identical requests recorded several times are replayed in the recorded order, and 
+    the last response is repeated once they are used up, so a replayed run is fully deterministic.
+    """
+
+    def __init__(self, path, mode='replay'):
+        assert mode in ('record', 'replay'), "Cassette mode '%s' is not supported. Please use 'record' or 'replay'." % mode
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._responses = defaultdict(list)
+        self._next_index = defaultdict(int)
+        if mode == 'replay':
+            self._load()
+        else:
+            dir_name = os.path.dirname(os.path.abspath(path))
+            os.makedirs(dir_name, exist_ok=True)
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                item = json.loads(line)
+                self._responses[item['key']].append(item['response'])
+        logger.info('Loaded %d recorded requests from %s.' % (len(self._responses), self.path))
+
+    def replay(self, key, model=None):
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                raise ChemAgentReplayMissError("Request to %s (key %s) is not recorded in cassette %s." % (model, key, self.path))
+            index = self._next_index[key]
+            self._next_index[key] = index + 1
+            return responses[min(index, len(responses) - 1)]
+
+    def record(self, key, response, model=None, request=None):
+        item = {'key': key, 'model': model, 'request': request, 'response': response}
+        line = json.dumps(item, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+
+_active_cassette = None
+
+
+def get_active_cassette():
+    return _active_cassette
+
+
+def set_active_cassette(cassette):
+    """Use `cassette` for every requester that was not given its own. Pass None to stop."""
+    global _active_cassette
+    _active_cassette = cassette
+
+
+@contextmanager
+def use_cassette(path, mode='replay'):
+    """Record or replay all LLM calls made in the block, e.g.
+
+        with use_cassette('runs/caffeine.jsonl', mode='replay'):
+            agent = ChemAgent(model='gpt-4o-2024-08-06', api_keys={})
+            agent.run(query)
+    """
+    previous = get_active_cassette()
+    cassette = Cassette(path, mode=mode)
+    set_active_cassette(cassette)
+    try:
+        yield cassette
+    finally:
+        set_active_cassette(previous)
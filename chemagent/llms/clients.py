@@ -0,0 +1,75 @@
+import threading
+import logging
+
+import httpx
+
+
+logger = logging.getLogger(__name__)
+
+
+HTTP_CONFIG = {
+    'max_connections': 100,
+    'max_keepalive_connections': 20,
+    'keepalive_expiry': 30.0,
+    'timeout': 600.0,
+    'connect_timeout': 10.0,
+}
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def configure_clients(**kwargs):
+    """Set the HTTP connection pool size, keep-alive and timeouts of clients created afterwards.
+
+    Accepted keys are those of HTTP_CONFIG. Call it before building the agents, or call `close_clients` first 
+    to have the existing clients rebuilt with the new settings.
+    """
+    for key, value in kwargs.items():
+        if key not in HTTP_CONFIG:
+            raise KeyError("Unknown HTTP client option: %s. Available options: %s" % (key, ', '.join(HTTP_CONFIG)))
+        HTTP_CONFIG[key] = value
+
+
+def _make_http_client():
+    limits = httpx.Limits(
+        max_connections=HTTP_CONFIG['max_connections'],
+        max_keepalive_connections=HTTP_CONFIG['max_keepalive_connections'],
+        keepalive_expiry=HTTP_CONFIG['keepalive_expiry'],
+    )
+    timeout = httpx.Timeout(HTTP_CONFIG['timeout'], connect=HTTP_CONFIG['connect_timeout'])
+    return httpx.Client(limits=limits, timeout=timeout, follow_redirects=True)
+
+
+def _make_client(provider, api_key, base_url=None):
+    # Retries are handled by LLMRequester, which shares the backoff with the rate limiter
+    if provider == 'openai':
+        import openai
+        return openai.OpenAI(api_key=api_key, base_url=base_url, http_client=_make_http_client(), max_retries=0)
+    elif provider == 'anthropic':
+        from anthropic import Anthropic
+        return Anthropic(api_key=api_key, base_url=base_url, http_client=_make_http_client(), max_retries=0)
+    raise NotImplementedError("Provider %s is not supported." % provider)
+
+
+def get_client(provider, api_key, base_url=None):
+    """Return the process-wide client of `provider` for (api_key, base_url), creating it on first use.
+
+    All requesters share these clients, and thus their HTTP connection pools.
+    """
+    key = (provider, api_key, base_url)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            logger.debug('Creating %s client (base_url=%s).' % (provider, base_url))
+            client = _make_client(provider, api_key, base_url=base_url)
+            _clients[key] = client
+    return client
+
+
+def close_clients():
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
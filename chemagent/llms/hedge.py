@@ -0,0 +1,163 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .requester import LLMRequester
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Leg(object):
+    """One of the two requests of a hedged request. `cancel` closes its provider stream from another thread, which 
+    closes the underlying HTTP response, so the provider stops generating even while the leg waits for a chunk."""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self._stream = None
+        self._lock = threading.Lock()
+
+    def stream_opened(self, stream):
+        with self._lock:
+            self._stream = stream
+            cancelled = self.cancelled.is_set()
+        if cancelled:
+            stream.close()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled.set()
+            stream = self._stream
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception as e:
+                logger.debug('Failed to close a cancelled stream: %s' % e)
+
+
+def _run_leg(llm, conversation, leg, kwargs):
+    """Stream one completion from `llm` until it finishes or `leg` is cancelled. Returns (output, usage, stop_reason),
+    or None if cancelled."""
+    llm._local.on_stream_open = leg.stream_opened
+    stream = llm.request_stream(conversation, **kwargs)
+    chunks = []
+    try:
+        for chunk in stream:
+            if leg.cancelled.is_set():
+                return None
+            chunks.append(chunk)
+    except Exception:
+        # Reading a stream closed by `cancel` fails
+        if leg.cancelled.is_set():
+            return None
+        raise
+    finally:
+        llm._local.on_stream_open = None
+        stream.close()
+    return ''.join(chunks).rstrip(), llm.last_usage, llm.last_stop_reason
+
+
+class HedgedRequester(LLMRequester):
+    """Send each request to a primary requester, and send a hedge request to a secondary requester if the primary has
+    not finished within a latency threshold. Whichever finishes first is returned, and the other is cancelled.
+
+    The threshold is the `percentile` of the latest `window` primary latencies, or `initial_threshold` seconds until
+    `min_samples` latencies are observed. Counts of hedges and wins are kept in `metrics`.
+    """
+
+    def __init__(self, primary, secondary, percentile=95, window=200, min_samples=20, initial_threshold=10.0, min_threshold=1.0, max_workers=16):
+        super().__init__(None, '%s|%s' % (primary.model_name, secondary.model_name))
+        self.primary = primary
+        self.secondary = secondary
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_threshold = initial_threshold
+        self.min_threshold = min_threshold
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hedge')
+        self.metrics = {
+            'requests': 0,
+            'hedged': 0,
+            'primary_wins': 0,
+            'secondary_wins': 0,
+            'primary_errors': 0,
+            'secondary_errors': 0,
+        }
+
+    @property
+    def threshold(self):
+        """The primary latency in seconds after which a hedge request is sent."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return self.initial_threshold
+            latencies = sorted(self._latencies)
+        index = max(0, math.ceil(self.percentile / 100 * len(latencies)) - 1)
+        return max(self.min_threshold, latencies[index])
+
+    @property
+    def hedge_rate(self):
+        with self._lock:
+            return self.metrics['hedged'] / self.metrics['requests'] if self.metrics['requests'] > 0 else 0.0
+
+    def _count(self, name):
+        with self._lock:
+            self.metrics[name] += 1
+
+    def request(self, conversation, num_return=1, prefix=None, stop_sequences=None, cache_prefix_len=None):
+        if num_return != 1:
+            return self.primary.request(conversation, num_return=num_return, prefix=prefix, stop_sequences=stop_sequences, cache_prefix_len=cache_prefix_len)
+
+        self._count('requests')
+        kwargs = {'prefix': prefix, 'stop_sequences': stop_sequences, 'cache_prefix_len': cache_prefix_len}
+        legs = {'primary': _Leg(), 'secondary': _Leg()}
+
+        start_time = time.time()
+        primary_future = self._executor.submit(_run_leg, self.primary, conversation, legs['primary'], kwargs)
+        futures = {primary_future: 'primary'}
+        done, _ = wait(futures, timeout=self.threshold)
+        if len(done) == 0 or next(iter(done)).exception() is not None:
+            self._count('hedged')
+            logger.info('%s did not finish in %.1f s. Sending a hedge request to %s.' % (self.primary.model_name, time.time() - start_time, self.secondary.model_name))
+            futures[self._executor.submit(_run_leg, self.secondary, conversation, legs['secondary'], kwargs)] = 'secondary'
+
+        errors = {}
+        pending = set(futures)
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                if future.exception() is not None:
+                    errors[name] = future.exception()
+                    self._count('%s_errors' % name)
+                    logger.warning('%s request failed: %s' % (name.capitalize(), future.exception()))
+                    continue
+
+                for other_name, leg in legs.items():
+                    if other_name != name:
+                        leg.cancel()
+                # A primary cancelled for the secondary is known to take at least the elapsed time, which is kept as a
+                # lower bound, so that slow primaries keep the threshold up. A failed primary gives no latency.
+                primary_failed = primary_future.done() and primary_future.exception() is not None
+                if name == 'primary' or not primary_failed:
+                    with self._lock:
+                        self._latencies.append(time.time() - start_time)
+                self._count('%s_wins' % name)
+                output, usage, stop_reason = future.result()
+                self._record_usage(usage, stop_reason=stop_reason)
+                return [output]
+
+        raise errors.get('primary', errors.get('secondary'))
+
+    def request_stream(self, conversation, prefix=None, stop_sequences=None, cache_prefix_len=None):
+        """Streamed requests are not hedged, since the output is already consumed before the winner is known."""
+        stream = self.primary.request_stream(conversation, prefix=prefix, stop_sequences=stop_sequences, cache_prefix_len=cache_prefix_len)
+        try:
+            for chunk in stream:
+                yield chunk
+        finally:
+            stream.close()
+            self._record_usage(self.primary.last_usage, stop_reason=self.primary.last_stop_reason)
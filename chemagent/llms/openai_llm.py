@@ -1,149 +1,205 @@
 import openai
 import time
 import json
-from copy import deepcopy
+import logging
+
+from .requester import LLMRequester, make_usage, prepare_messages
+from .batch import BatchRequester
+from .rate_limit import estimate_tokens
+from .clients import get_client
+
+
+logger = logging.getLogger(__name__)
+
+
+def _parse_usage(usage):
+    if usage is None:
+        return None
+    prompt_tokens_details = getattr(usage, 'prompt_tokens_details', None)
+    if isinstance(prompt_tokens_details, dict):
+        cached_tokens = prompt_tokens_details.get('cached_tokens')
+    else:
+        cached_tokens = getattr(prompt_tokens_details, 'cached_tokens', None)
+    return make_usage(
+        input_tokens=usage.prompt_tokens or 0,
+        output_tokens=usage.completion_tokens or 0,
+        cached_input_tokens=cached_tokens or 0,
+    )
 
-from .requester import LLMRequester
 
 class GptRequester(LLMRequester):
-    def __init__(self, api_code, model_name='gpt-4', trial_time=1, sleep_time=5):
-        super().__init__(api_code, model_name, trial_time, sleep_time)
+    def __init__(self, api_code, model_name='gpt-4', trial_time=5, sleep_time=5, cache=None, cassette=None):
+        super().__init__(api_code, model_name, trial_time, sleep_time, cache=cache, cassette=cassette)
         openai.api_key = self.api_code
 
-    def request(self, conversation, num_return=1, prefix=None, stop_sequences=None):
+    def request(self, conversation, num_return=1, prefix=None, stop_sequences=None, cache_prefix_len=None):
         if stop_sequences is not None:
             raise NotImplementedError("stop_sequences is not supported for GPT.")
-        conversation = deepcopy(conversation)
-        if prefix is not None:
-            assert conversation[-1]['role'] == 'user'
-            prefix = prefix.rstrip()
-            conversation.append({'role': 'assistant', 'content': prefix})
-
-        k = 0
-        while True:
-            try:
-                r = openai.ChatCompletion.create(
-                    model=self.model_name,
-                    messages=conversation,
-                    n=num_return,
-                )
-            except openai.error.Timeout:
-                if k >= self.trial_time:
-                    raise
-                k += 1
-                time.sleep(self.sleep_time)
-                continue
-            else:
-                break
+        response_key = self._response_key(conversation, prefix=prefix, num_return=num_return)
+        output_list = self._lookup_response(response_key, conversation=conversation)
+        if output_list is not None:
+            return output_list
+        original_conversation = conversation
+
+        _, conversation, prefix = prepare_messages(conversation, prefix=prefix)
+
+        r = self._call_with_retry(
+            lambda: openai.ChatCompletion.create(
+                model=self.model_name,
+                messages=conversation,
+                n=num_return,
+                **self._timeout_kwargs('request_timeout'),
+            ),
+            num_tokens=estimate_tokens(conversation),
+        )
+
+        usage = r.get('usage')
+        if usage is not None:
+            usage = make_usage(input_tokens=usage['prompt_tokens'], output_tokens=usage['completion_tokens'])
+        self._record_usage(usage, stop_reason=r['choices'][0].get('finish_reason'))
         
         output_list = []
         for item in r['choices']:
             response = item['message']['content'].rstrip()
             output_list.append((prefix + response) if prefix is not None else response)
+
+        self._store_response(response_key, output_list, conversation=original_conversation)
         
         return output_list
+
+    def _is_retryable(self, e):
+        if isinstance(e, (openai.error.Timeout, openai.error.RateLimitError, openai.error.APIConnectionError, openai.error.ServiceUnavailableError)):
+            return True
+        return super()._is_retryable(e)
     
-class NewGptRequester(LLMRequester):
-    def __init__(self, api_code, model_name='gpt-4', trial_time=1, sleep_time=5, use_user_prompt_for_system_prompt=False):
-        super().__init__(api_code, model_name, trial_time, sleep_time)
-        self.client = openai.OpenAI(api_key=self.api_code)
+class NewGptRequester(BatchRequester, LLMRequester):
+    def __init__(self, api_code, model_name='gpt-4', trial_time=5, sleep_time=5, use_user_prompt_for_system_prompt=False, base_url=None, cache=None, cassette=None):
+        super().__init__(api_code, model_name, trial_time, sleep_time, cache=cache, cassette=cassette)
+        self.client = get_client('openai', self.api_code, base_url=base_url)
         self._batched_request = []
         self.custom_ids = set()
         self.use_user_prompt_for_system_prompt = use_user_prompt_for_system_prompt
 
-    def request(self, conversation, num_return=1, prefix=None, stop_sequences=None):
-        conversation = deepcopy(conversation)
-        if prefix is not None:
-            assert conversation[-1]['role'] == 'user'
-            prefix = prefix.rstrip()
-            conversation.append({'role': 'assistant', 'content': prefix})
+    def _prepare_conversation(self, conversation, prefix=None):
+        _, conversation, prefix = prepare_messages(conversation, prefix=prefix, merge_system=self.use_user_prompt_for_system_prompt)
+        return conversation, prefix
 
-        system_prompt = None
-        if conversation[0]['role'] == 'system':
-            system_prompt = conversation[0]['content']
-        
-        if system_prompt is not None and self.use_user_prompt_for_system_prompt:
-            conversation = conversation[1:]
-            assert conversation[0]['role'] == 'user'
-            conversation[0]['content'] = system_prompt + '\n\n' + conversation[0]['content']
-
-        k = 0
-        while True:
-            try:
-                if stop_sequences is None:
-                    r = self.client.chat.completions.create(
-                        model=self.model_name,
-                        messages=conversation,
-                        n=num_return,
-                    )
-                else:
-                    r = self.client.chat.completions.create(
-                        model=self.model_name,
-                        messages=conversation,
-                        n=num_return,
-                        stop=stop_sequences,
-                    )
-            except openai.APITimeoutError:
-                if k >= self.trial_time:
-                    raise
-                k += 1
-                time.sleep(self.sleep_time)
-                continue
-            else:
-                break
+    def request(self, conversation, num_return=1, prefix=None, stop_sequences=None, cache_prefix_len=None):
+        """`cache_prefix_len` is accepted for interface compatibility. OpenAI caches identical prompt prefixes automatically."""
+        response_key = self._response_key(conversation, prefix=prefix, stop_sequences=stop_sequences, num_return=num_return)
+        output_list = self._lookup_response(response_key, conversation=conversation)
+        if output_list is not None:
+            return output_list
+        original_conversation = conversation
+
+        conversation, prefix = self._prepare_conversation(conversation, prefix=prefix)
+
+        kwargs = {}
+        if stop_sequences is not None:
+            kwargs['stop'] = stop_sequences
+
+        r = self._call_with_retry(
+            lambda: self.client.chat.completions.with_raw_response.create(
+                model=self.model_name,
+                messages=conversation,
+                n=num_return,
+                **kwargs,
+                **self._timeout_kwargs(),
+            ),
+            num_tokens=estimate_tokens(conversation),
+        )
+
+        self._record_usage(_parse_usage(r.usage), stop_reason=r.choices[0].finish_reason)
         
         # TODO: Add log when model stopped due to stop_sequences
         output_list = []
         for item in r.choices:
             response = item.message.content.rstrip()
             output_list.append((prefix + response) if prefix is not None else response)
+
+        self._store_response(response_key, output_list, conversation=original_conversation)
         
         return output_list
+
+    def request_stream(self, conversation, prefix=None, stop_sequences=None, cache_prefix_len=None):
+        response_key = self._response_key(conversation, prefix=prefix, stop_sequences=stop_sequences, num_return=1)
+        output_list = self._lookup_response(response_key, conversation=conversation)
+        if output_list is not None:
+            yield output_list[0]
+            return
+        original_conversation = conversation
+
+        conversation, prefix = self._prepare_conversation(conversation, prefix=prefix)
+
+        kwargs = {}
+        if stop_sequences is not None:
+            kwargs['stop'] = stop_sequences
+
+        stream = self._call_with_retry(
+            lambda: self.client.chat.completions.with_raw_response.create(
+                model=self.model_name,
+                messages=conversation,
+                stream=True,
+                stream_options={'include_usage': True},
+                **kwargs,
+                **self._timeout_kwargs(),
+            ),
+            num_tokens=estimate_tokens(conversation),
+        )
+        self._stream_opened(stream)
+
+        self._record_usage(None)
+        stop_reason = None
+        chunks = []
+        try:
+            if prefix is not None:
+                yield prefix
+            for chunk in stream:
+                if chunk.usage is not None:
+                    self._record_usage(_parse_usage(chunk.usage), stop_reason=stop_reason)
+                if len(chunk.choices) == 0:
+                    continue
+                if chunk.choices[0].finish_reason is not None:
+                    stop_reason = chunk.choices[0].finish_reason
+                    self._record_usage(self.last_usage, stop_reason=stop_reason)
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    chunks.append(delta)
+                    yield delta
+        finally:
+            stream.close()
+
+        # Only complete streams are cached
+        response = ''.join(chunks).rstrip()
+        self._store_response(response_key, [(prefix + response) if prefix is not None else response], conversation=original_conversation)
+
+    def _is_retryable(self, e):
+        if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+            return True
+        return super()._is_retryable(e)
     
-    def add_request(self, conversation, custom_id, num_return=1, *args, **kwargs):
-        if num_return != 1:
-            raise NotImplementedError("num_return must be 1 for batch_request. Whether more than 1 is supported is not checked yet.")
-        if custom_id in self.custom_ids:
-            raise ValueError("custom_id already exists.")
-        self._batched_request.append((conversation, custom_id, args, kwargs))
-
-    def clear_request(self):
-        self._batched_request.clear()
-
-    def get_batched_request(self):
-        requests = []
-        conversations = {}
-        other_info = {}
-        for idx, (conv, custom_id, args, kwargs) in enumerate(self._batched_request):
-            if custom_id is None:
-                custom_id = str(idx)
-            request_item = {
-                'custom_id': custom_id,
-                'method': "POST",
-                'url': "/v1/chat/completions",
-                'body': {
-                    'model': self.model_name,
-                    'messages': conv,
-                    # 'n': num_return,
-                }
+    def _make_batch_item(self, conversation, custom_id, kwargs):
+        messages, _ = self._prepare_conversation(conversation, prefix=kwargs.get('prefix'))
+        request_item = {
+            'custom_id': custom_id,
+            'method': "POST",
+            'url': "/v1/chat/completions",
+            'body': {
+                'model': self.model_name,
+                'messages': messages,
             }
-            requests.append(request_item)
-            conversations[custom_id] = conv
-            other_info[custom_id] = (args, kwargs)
-        return requests, conversations, other_info
-    
-    def batch_request(self):
-        if self._batched_request is None or len(self._batched_request) == 0:
-            return {}
-        requests, conversations, other_info = self.get_batched_request()
-        num_requests = len(requests)
-        requests_jsonl_str = '\n'.join([json.dumps(item) for item in requests])
-        requests_jsonl_str_bytes = requests_jsonl_str.encode('utf-8')
+        }
+        if kwargs.get('stop_sequences') is not None:
+            request_item['body']['stop'] = kwargs['stop_sequences']
+        return request_item
+
+    def _submit_batch(self, items):
+        requests_jsonl_str = '\n'.join([json.dumps(item) for item in items])
         batch_input_file = self.client.files.create(
-            file=requests_jsonl_str_bytes,
+            file=requests_jsonl_str.encode('utf-8'),
             purpose='batch'
         )
-        tmp = self.client.batches.create(
+        batch_object = self.client.batches.create(
             input_file_id=batch_input_file.id,
             endpoint='/v1/chat/completions',
             completion_window='24h',
@@ -151,38 +207,33 @@ class NewGptRequester(LLMRequester):
                 'description': 'Batch request for chat completions.',
             }
         )
-        batch_id = tmp.id
-        print('Batch ID:', batch_id)
-        print('Running batch request for %d requests ...' % num_requests)
-        time.sleep(1 * num_requests)
-        try:
-            while True:
-                batch_object = self.client.batches.retrieve(batch_id)
-                if batch_object.status == 'completed':
-                    break
-                elif batch_object.status == 'failed':
-                    raise RuntimeError("Batch request failed: %s" % batch_object.errors.message)
-                time.sleep(5)
-        except KeyboardInterrupt:
-            print('Current batch_output:', batch_object)
-            raise
-        output_file_id = batch_object.output_file_id
-        content = self.client.files.content(output_file_id)
-        lines = content.content.decode('utf-8').split('\n')
-        outputs = {}
-        failed_samples = []
-        for line in lines:
-            if line.strip() == '':
-                continue
-            item = json.loads(line)
-            
-            try:
-                output = []
-                for choice in item['response']['body']['choices']:
-                    response = choice['message']['content'].strip()
-                    output.append(response)
-                outputs[item['custom_id']] = (conversations[item['custom_id']], output, other_info[item['custom_id']])
-            except KeyError:
-                failed_samples.append(item['custom_id'])
-            
-        return outputs, failed_samples
+        return batch_object.id
+
+    def _retrieve_batch(self, batch_id):
+        batch_object = self.client.batches.retrieve(batch_id)
+        if batch_object.status == 'failed' and batch_object.errors is not None:
+            logger.warning('Batch %s failed: %s' % (batch_id, '; '.join(str(e.message) for e in batch_object.errors.data or [])))
+        return batch_object.status
+
+    def _iter_batch_results(self, batch_id):
+        from openai.types import CompletionUsage
+
+        batch_object = self.client.batches.retrieve(batch_id)
+        if batch_object.output_file_id is None:
+            return
+        with self.client.files.with_streaming_response.content(batch_object.output_file_id) as response:
+            for line in response.iter_lines():
+                if line.strip() == '':
+                    continue
+                item = json.loads(line)
+                try:
+                    body = item['response']['body']
+                    output = []
+                    for choice in body['choices']:
+                        response_text = choice['message']['content'].strip()
+                        output.append(response_text)
+                except (KeyError, TypeError):
+                    yield item['custom_id'], None, None
+                    continue
+                usage = body.get('usage')
+                yield item['custom_id'], output, _parse_usage(CompletionUsage(**usage) if usage is not None else None)
@@ -0,0 +1,191 @@
+import re
+import threading
+import time
+import logging
+
+from chemagent.utils.deadline import sleep
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket refilled continuously at `rate_per_minute`, holding at most one minute of budget."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """Take `amount` tokens, going into debt if needed. Returns the number of seconds to wait before proceeding."""
+        amount = min(float(amount), self.capacity)
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def sync(self, remaining):
+        """Set the budget to the `remaining` count reported by the provider, which also accounts for other clients 
+        of the same API key."""
+        with self.lock:
+            self.tokens = min(self.capacity, float(remaining))
+            self.updated = time.monotonic()
+
+
+class RateLimiter(object):
+    """Requests-per-minute and tokens-per-minute limits shared by all requesters of a model.
+
+    Besides the buckets, the limiter holds a pause window set when the provider answers with 429, so that all 
+    callers back off together instead of hammering the API.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, num_tokens=0):
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None and num_tokens > 0:
+            wait = max(wait, self.token_bucket.reserve(num_tokens))
+        with self.lock:
+            wait = max(wait, self.paused_until - time.monotonic())
+        if wait > 0:
+            logger.debug('Rate limiter: waiting %.2f seconds.' % wait)
+            sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def update(self, headers):
+        """Follow the rate limit headers of a provider response: the buckets are set to the remaining budgets, and 
+        callers pause until the reset time once a budget is used up."""
+        for kind, (remaining, reset) in parse_rate_limit_headers(headers).items():
+            bucket = self.request_bucket if kind == 'requests' else self.token_bucket
+            if bucket is not None:
+                bucket.sync(remaining)
+            if remaining <= 0 and reset is not None:
+                logger.debug('Rate limiter: %s budget used up, pausing %.2f seconds.' % (kind, reset))
+                self.pause(reset)
+
+
+RATE_LIMITS = {}
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def configure_rate_limit(model, requests_per_minute=None, tokens_per_minute=None):
+    """Set the limits of `model` for this process. Replaces the existing limiter of the model."""
+    RATE_LIMITS[model] = (requests_per_minute, tokens_per_minute)
+    with _lock:
+        _limiters[model] = RateLimiter(requests_per_minute, tokens_per_minute)
+
+
+def get_rate_limiter(model):
+    with _lock:
+        limiter = _limiters.get(model)
+        if limiter is None:
+            requests_per_minute, tokens_per_minute = RATE_LIMITS.get(model, (None, None))
+            limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+            _limiters[model] = limiter
+    return limiter
+
+
+def estimate_tokens(conversation):
+    """A rough token estimate (4 characters per token) of a conversation, used for the tokens-per-minute limit."""
+    num_chars = 0
+    for item in conversation:
+        content = item['content']
+        if isinstance(content, str):
+            num_chars += len(content)
+        else:
+            num_chars += sum(len(block.get('text', '')) for block in content)
+    return num_chars // 4 + 1
+
+
+def parse_retry_after(headers):
+    """Seconds to wait as requested by the provider headers, or None."""
+    if headers is None:
+        return None
+    value = headers.get('retry-after-ms')
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            from email.utils import parsedate_to_datetime
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return None
+
+
+RATE_LIMIT_HEADERS = {
+    # kind: ((remaining header, reset header) of OpenAI, (remaining header, reset header) of Anthropic)
+    'requests': (('x-ratelimit-remaining-requests', 'x-ratelimit-reset-requests'), 
+                 ('anthropic-ratelimit-requests-remaining', 'anthropic-ratelimit-requests-reset')),
+    'tokens': (('x-ratelimit-remaining-tokens', 'x-ratelimit-reset-tokens'), 
+               ('anthropic-ratelimit-tokens-remaining', 'anthropic-ratelimit-tokens-reset')),
+}
+
+_DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+_DURATIONS_PATTERN = re.compile(r'(?:\d+(?:\.\d+)?(?:ms|h|m|s))+')
+_DURATION_UNITS = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+
+
+def _parse_reset(value):
+    """Seconds until a reset given either as a duration (OpenAI, e.g. '6m0s' or '20ms') or as an RFC 3339 time 
+    (Anthropic), or None."""
+    value = value.strip()
+    if _DURATIONS_PATTERN.fullmatch(value):
+        return sum(float(number) * _DURATION_UNITS[unit] for number, unit in _DURATION_PATTERN.findall(value))
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    from datetime import datetime
+    try:
+        return max(0.0, datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() - time.time())
+    except ValueError:
+        return None
+
+
+def parse_rate_limit_headers(headers):
+    """The remaining budgets given by the provider headers, as {kind: (remaining, seconds until reset or None)} for 
+    the kinds 'requests' and 'tokens' that are reported."""
+    limits = {}
+    if headers is None:
+        return limits
+    for kind, header_names in RATE_LIMIT_HEADERS.items():
+        for remaining_header, reset_header in header_names:
+            value = headers.get(remaining_header)
+            if value is None:
+                continue
+            try:
+                remaining = float(value)
+            except ValueError:
+                continue
+            reset = headers.get(reset_header)
+            limits[kind] = (remaining, _parse_reset(reset) if reset is not None else None)
+            break
+    return limits
@@ -1,12 +1,194 @@
+import threading
+import random
+import logging
 from abc import ABC, abstractmethod
 
+from chemagent.utils.deadline import remaining, sleep
+from .rate_limit import get_rate_limiter, parse_retry_after
+from .cache import make_cache_key, get_response_cache
+from .cassette import get_active_cassette
+
+
+logger = logging.getLogger(__name__)
+
+
 class LLMRequester(ABC):
-    def __init__(self, api_code, model_name, trial_time=1, sleep_time=5):
+    def __init__(self, api_code, model_name, trial_time=1, sleep_time=5, max_sleep_time=60, cache=None, cassette=None):
         self.model_name = model_name
         self.api_code = api_code
         self.trial_time = int(trial_time)
         self.sleep_time = int(sleep_time)
+        self.max_sleep_time = max_sleep_time
+        self.cache = get_response_cache(cache)
+        self.cassette = cassette
+        self._local = threading.local()
 
     @abstractmethod
     def request(self, conversation, num_return=1, prefix=None):
         pass
+
+    def request_stream(self, conversation, prefix=None, stop_sequences=None):
+        """Yield the text of one completion chunk by chunk. Closing the generator cuts the stream."""
+        raise NotImplementedError("Streaming is not supported by %s." % self.__class__.__name__)
+
+    @property
+    def last_usage(self):
+        """Token usage of the latest request made from the current thread, or None if not reported."""
+        return getattr(self._local, 'usage', None)
+
+    @property
+    def last_stop_reason(self):
+        """Provider stop reason (e.g., 'stop_sequence' or 'length') of the latest request made from the current thread, or None if not reported."""
+        return getattr(self._local, 'stop_reason', None)
+
+    def _stream_opened(self, stream):
+        """Called by `request_stream` with the provider stream once it is open, so that the caller can close it from 
+        another thread (see chemagent/llms/hedge.py)."""
+        callback = getattr(self._local, 'on_stream_open', None)
+        if callback is not None:
+            callback(stream)
+
+    def _record_usage(self, usage, stop_reason=None):
+        self._local.usage = usage
+        self._local.stop_reason = stop_reason
+
+    def _response_key(self, conversation, **params):
+        if self.cache is None and self._cassette() is None:
+            return None
+        return make_cache_key(self.model_name, conversation, **params)
+
+    def _cassette(self):
+        return self.cassette if self.cassette is not None else get_active_cassette()
+
+    def _lookup_response(self, key, conversation=None):
+        """Return the recorded or cached output list for the request `key`, or None to send the request. Cache hits 
+        are recorded too when a cassette is recording, so that the cassette can replay the whole run."""
+        if key is None:
+            return None
+        cassette = self._cassette()
+        if cassette is not None and cassette.replaying:
+            self._record_usage(None)
+            return cassette.replay(key, model=self.model_name)
+        if self.cache is None:
+            return None
+        output_list = self.cache.get(key)
+        if output_list is not None:
+            logger.debug('Response cache hit for %s.' % self.model_name)
+            self._record_usage(None)
+            if cassette is not None:
+                cassette.record(key, output_list, model=self.model_name, request=conversation)
+        return output_list
+
+    def _store_response(self, key, output_list, conversation=None):
+        if key is None:
+            return
+        if self.cache is not None:
+            self.cache.set(key, output_list)
+        cassette = self._cassette()
+        if cassette is not None and not cassette.replaying:
+            cassette.record(key, output_list, model=self.model_name, request=conversation)
+
+    def _call_with_retry(self, func, num_tokens=0):
+        """Call `func` under the model's shared rate limiter, retrying up to `trial_time` times on retryable errors.
+
+        The delay follows the provider's Retry-After headers when given, and is otherwise an exponential backoff 
+        with jitter. A rate-limit error also pauses the shared limiter so that all requesters of the model back off. 
+        Waiting stops with ChemAgentTimeoutError at the deadline of the calling thread, if any.
+
+        When `func` returns a raw SDK response (`with_raw_response`), the limiter follows its rate limit headers and 
+        the parsed response is returned.
+        """
+        limiter = get_rate_limiter(self.model_name)
+        k = 0
+        while True:
+            limiter.acquire(num_tokens)
+            try:
+                response = func()
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                headers = self._error_headers(e)
+                limiter.update(headers)
+                if k >= self.trial_time or not self._is_retryable(e):
+                    raise
+                status_code = self._error_status_code(e)
+                delay = parse_retry_after(headers)
+                if delay is None:
+                    delay = min(self.max_sleep_time, self.sleep_time * 2 ** k) * random.uniform(0.5, 1.0)
+                if status_code == 429:
+                    limiter.pause(delay)
+                k += 1
+                logger.info('Request to %s failed (%s: %s). Retrying in %.1f seconds (%d/%d).' % (self.model_name, e.__class__.__name__, status_code, delay, k, self.trial_time))
+                sleep(delay)
+                continue
+            headers = getattr(response, 'headers', None)
+            if headers is not None and callable(getattr(response, 'parse', None)):
+                limiter.update(headers)
+                return response.parse()
+            return response
+
+    @staticmethod
+    def _timeout_kwargs(name='timeout'):
+        """The timeout argument of a provider SDK call: the time left before the deadline of this thread (see 
+        chemagent/utils/deadline.py), or nothing to keep the SDK default."""
+        timeout = remaining()
+        return {} if timeout is None else {name: timeout}
+
+    def _is_retryable(self, e):
+        status_code = self._error_status_code(e)
+        return status_code is not None and (status_code in (408, 409, 429) or status_code >= 500)
+
+    @staticmethod
+    def _error_status_code(e):
+        status_code = getattr(e, 'status_code', None)
+        if status_code is None:
+            status_code = getattr(e, 'http_status', None)
+        return status_code
+
+    @staticmethod
+    def _error_headers(e):
+        response = getattr(e, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if headers is None:
+            headers = getattr(e, 'headers', None)
+        return headers
+
+
+def make_usage(input_tokens=0, output_tokens=0, cached_input_tokens=0, cache_creation_input_tokens=0):
+    """Normalize token counts across providers. `input_tokens` includes the cached ones."""
+    return {
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'cached_input_tokens': cached_input_tokens,
+        'uncached_input_tokens': input_tokens - cached_input_tokens,
+        'cache_creation_input_tokens': cache_creation_input_tokens,
+    }
+
+
+def prepare_messages(conversation, prefix=None, split_system=False, merge_system=False):
+    """Build the provider message list from `conversation` without copying it.
+
+    The returned list references the original message dicts. Only the messages that need a change (the first user 
+    message when merging the system prompt into it, and the assistant prefix) are new objects, so the cost does not 
+    grow with the length of the message contents. `conversation` itself is never modified.
+
+    Returns (system_prompt, messages, prefix). The system prompt is split out of the messages if `split_system` 
+    or `merge_system` is set, and in the latter case prepended to the first user message and returned as None.
+    """
+    messages = list(conversation)
+    if prefix is not None:
+        assert messages[-1]['role'] == 'user'
+        prefix = prefix.rstrip()
+        messages.append({'role': 'assistant', 'content': prefix})
+
+    system_prompt = None
+    if (split_system or merge_system) and messages[0]['role'] == 'system':
+        system_prompt = messages[0]['content']
+        messages = messages[1:]
+
+    if system_prompt is not None and merge_system:
+        assert messages[0]['role'] == 'user'
+        messages[0] = {'role': 'user', 'content': system_prompt + '\n\n' + messages[0]['content']}
+        system_prompt = None
+
+    return system_prompt, messages, prefix
@@ -0,0 +1,498 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import argparse
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import tornado.ioloop
+import tornado.locks
+import tornado.web
+import tornado.httpserver
+import tornado.iostream
+
+
+logger = logging.getLogger(__name__)
+
+# Tenant IDs name the trajectory directories, so they cannot be '.' or '..'
+TENANT_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$')
+RUN_OPTIONS = ('do_rephrasing', 'format')
+KEEP_ALIVE_INTERVAL = 15
+
+
+def percentile(values, q):
+    """The `q`-th percentile (0-100) of `values` by linear interpolation, or None if there are no values."""
+    values = sorted(values)
+    if len(values) == 0:
+        return None
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def latency_stats(values):
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) if len(values) > 0 else None,
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values, default=None),
+    }
+
+
+class Rejected(Exception):
+    """A question that is not accepted, with the HTTP status and the seconds after which the client may retry."""
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AgentJob(object):
+    """One question submitted to the service. Its events are only published from the IOLoop thread.
+
+    The latest `max_events` events are kept for replay, and the answer_delta events are dropped once the run is 
+    finished, since the final event has the whole answer."""
+
+    max_events = 1000
+
+    def __init__(self, tenant, question, options):
+        self.run_id = uuid.uuid4().hex
+        self.tenant = tenant
+        self.question = question
+        self.options = options
+        self.status = 'queued'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.record = None
+        self.events = deque(maxlen=self.max_events)
+        self.num_events = 0
+        self._changed = tornado.locks.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    def publish(self, event, data):
+        self.events.append((self.num_events, event, data))
+        self.num_events += 1
+        self._changed.notify_all()
+
+    def events_since(self, event_id):
+        """The kept events from `event_id` on."""
+        return [item for item in self.events if item[0] >= event_id]
+
+    def compact(self):
+        self.events = deque((item for item in self.events if item[1] != 'answer_delta'), maxlen=self.max_events)
+
+    def wait(self, timeout):
+        return self._changed.wait(timeout=timedelta(seconds=timeout))
+
+    def info(self):
+        info = {
+            'run_id': self.run_id,
+            'tenant': self.tenant,
+            'question': self.question,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        if self.record is not None:
+            for key in ('answer', 'error', 'num_steps', 'summary'):
+                info[key] = self.record.get(key)
+        return info
+
+
+def step_event(item):
+    """The data of the step event of a tool use chain entry."""
+    return {key: item.get(key) for key in ('thought', 'tool', 'input', 'output', 'success', 'llm_latency', 'tool_latency', 'memo_hit', 'timed_out')}
+
+
+class AgentService(object):
+    """Run the questions of many tenants with one agent (e.g., a ChemAgent) on `num_workers` threads.
+
+    A tenant has at most `tenant_concurrency` questions running and `tenant_queue` waiting; more are rejected with
+    429. Beyond `max_queue` waiting questions in total, questions are rejected with 503. Free workers take the next
+    question of the tenants in turn, so that a busy tenant does not delay the others. Finished runs are written to
+    `trajectory_dir/<tenant>/<run_id>.json`, and the latest `max_jobs` are also kept in memory.
+
+    All methods except `_run_job` must be called from the IOLoop thread.
+    """
+
+    def __init__(self, agent, num_workers=8, tenant_concurrency=2, tenant_queue=16, max_queue=256, trajectory_dir='runs/service', max_jobs=1000):
+        self.agent = agent
+        self.num_workers = num_workers
+        self.tenant_concurrency = tenant_concurrency
+        self.tenant_queue = tenant_queue
+        self.max_queue = max_queue
+        self.trajectory_dir = trajectory_dir
+        self.max_jobs = max_jobs
+
+        self.executor = ThreadPoolExecutor(num_workers, thread_name_prefix='agent-worker')
+        self.jobs = OrderedDict()
+        self.tenants = {}
+        # Tenants with waiting questions, in the order they get a free worker
+        self._ready = deque()
+        self.num_running = 0
+        self.num_queued = 0
+        self.counts = {'submitted': 0, 'succeeded': 0, 'failed': 0, 'rejected_tenant': 0, 'rejected_overloaded': 0}
+        self.latencies = deque(maxlen=1000)
+        self.queue_times = deque(maxlen=1000)
+        self._loop = None
+
+    def _tenant(self, tenant):
+        if tenant not in self.tenants:
+            self.tenants[tenant] = {'queue': deque(), 'running': 0, 'submitted': 0, 'rejected': 0, 'succeeded': 0, 'failed': 0}
+        return self.tenants[tenant]
+
+    def _retry_after(self):
+        # The time for the workers to get through the waiting questions, from the recent run latencies
+        mean_latency = sum(self.latencies) / len(self.latencies) if len(self.latencies) > 0 else 10.0
+        return max(1, int(mean_latency * (self.num_queued + 1) / self.num_workers))
+
+    def submit(self, tenant, question, options=None):
+        """Queue a question. Returns its AgentJob, or raises Rejected."""
+        self._loop = tornado.ioloop.IOLoop.current()
+        state = self._tenant(tenant)
+        if len(state['queue']) >= self.tenant_queue:
+            state['rejected'] += 1
+            self.counts['rejected_tenant'] += 1
+            raise Rejected(429, 'Tenant %s already has %d questions waiting. Please retry later.' % (tenant, len(state['queue'])), self._retry_after())
+        if self.num_queued >= self.max_queue:
+            state['rejected'] += 1
+            self.counts['rejected_overloaded'] += 1
+            raise Rejected(503, 'The service is overloaded. Please retry later.', self._retry_after())
+
+        job = AgentJob(tenant, question, dict(options or {}))
+        self.jobs[job.run_id] = job
+        self._evict_jobs()
+        if len(state['queue']) == 0:
+            self._ready.append(tenant)
+        state['queue'].append(job)
+        state['submitted'] += 1
+        self.counts['submitted'] += 1
+        self.num_queued += 1
+        job.publish('queued', {'run_id': job.run_id, 'position': len(state['queue'])})
+        self._dispatch()
+        return job
+
+    async def get_job(self, tenant, run_id):
+        """The job of a run of `tenant` (in memory, or loaded from its trajectory file), or None."""
+        job = self.jobs.get(run_id)
+        if job is not None:
+            return job if job.tenant == tenant else None
+        if not re.match(r'^[0-9a-f]{32}$', run_id):
+            return None
+        # Read off the IOLoop thread, and not by the agent workers, which may all be busy with long runs
+        record = await tornado.ioloop.IOLoop.current().run_in_executor(None, self._load_record, tenant, run_id)
+        if record is None:
+            return None
+        job = AgentJob(tenant, record['question'], record['options'])
+        job.run_id = run_id
+        job.status = record['status']
+        for key in ('created_at', 'started_at', 'finished_at'):
+            setattr(job, key, record[key])
+        job.record = record
+        job.publish(*self._final_event(job))
+        return job
+
+    def _load_record(self, tenant, run_id):
+        path = self._trajectory_path(tenant, run_id)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def _evict_jobs(self):
+        for run_id in list(self.jobs):
+            if len(self.jobs) <= self.max_jobs:
+                break
+            if self.jobs[run_id].finished:
+                del self.jobs[run_id]
+
+    def _next_job(self):
+        for _ in range(len(self._ready)):
+            tenant = self._ready.popleft()
+            state = self.tenants[tenant]
+            if state['running'] >= self.tenant_concurrency:
+                self._ready.append(tenant)
+                continue
+            job = state['queue'].popleft()
+            if len(state['queue']) > 0:
+                self._ready.append(tenant)
+            return job
+        return None
+
+    def _dispatch(self):
+        while self.num_running < self.num_workers:
+            job = self._next_job()
+            if job is None:
+                return
+            self._start(job)
+
+    def _start(self, job):
+        self.tenants[job.tenant]['running'] += 1
+        self.num_running += 1
+        self.num_queued -= 1
+        job.status = 'running'
+        job.started_at = time.time()
+        self.queue_times.append(job.started_at - job.created_at)
+        job.publish('started', {'queue_time': job.started_at - job.created_at})
+        future = self._loop.run_in_executor(self.executor, self._run_job, job)
+        self._loop.add_future(future, lambda future: self._finish(job, future))
+
+    def _run_job(self, job):
+        """Run the question in a worker thread. The step events are handed over to the IOLoop thread."""
+        loop = self._loop
+        record = {
+            'run_id': job.run_id,
+            'tenant': job.tenant,
+            'question': job.question,
+            'options': job.options,
+            'created_at': job.created_at,
+            'started_at': job.started_at,
+        }
+        try:
+            answer, tool_use_chain, conversation, _, summary = self.agent.run(
+                job.question,
+                verbose=False,
+                conv_id=job.run_id,
+                return_summary=True,
+                step_callback=lambda item: loop.add_callback(job.publish, 'step', step_event(item)),
+                answer_callback=lambda text: loop.add_callback(job.publish, 'answer_delta', {'text': text}),
+                **job.options
+            )
+        except Exception as e:
+            logger.exception('Run %s of tenant %s failed.' % (job.run_id, job.tenant))
+            record.update({'status': 'failed', 'error': '%s: %s' % (e.__class__.__name__, e)})
+        else:
+            record.update({
+                'status': 'succeeded',
+                'answer': answer,
+                'num_steps': len(tool_use_chain),
+                'summary': summary,
+                'tool_use_chain': tool_use_chain,
+                'conversation': conversation,
+            })
+        record['finished_at'] = time.time()
+        try:
+            self._persist(record)
+        except OSError:
+            logger.exception('Cannot write the trajectory of run %s.' % job.run_id)
+        return record
+
+    def _trajectory_path(self, tenant, run_id):
+        return os.path.join(self.trajectory_dir, tenant, run_id + '.json')
+
+    def _persist(self, record):
+        path = self._trajectory_path(record['tenant'], record['run_id'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(record, f, ensure_ascii=False, default=str)
+        os.replace(path + '.tmp', path)
+
+    def _final_event(self, job):
+        if job.status == 'succeeded':
+            return 'final', {'answer': job.record['answer'], 'num_steps': job.record['num_steps'], 'summary': job.record['summary']}
+        return 'error', {'error': job.record['error']}
+
+    def _finish(self, job, future):
+        state = self.tenants[job.tenant]
+        state['running'] -= 1
+        self.num_running -= 1
+        job.record = future.result()
+        job.status = job.record['status']
+        job.finished_at = job.record['finished_at']
+        state[job.status] += 1
+        self.counts[job.status] += 1
+        self.latencies.append(job.finished_at - job.started_at)
+        job.publish(*self._final_event(job))
+        job.compact()
+        self._dispatch()
+
+    def metrics(self):
+        return {
+            'workers': self.num_workers,
+            'running': self.num_running,
+            'queued': self.num_queued,
+            'counts': dict(self.counts),
+            'run_latency': latency_stats(list(self.latencies)),
+            'queue_time': latency_stats(list(self.queue_times)),
+            'tenants': {
+                tenant: {key: (len(value) if key == 'queue' else value) for key, value in state.items()}
+                for tenant, state in self.tenants.items()
+            },
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class _BaseHandler(tornado.web.RequestHandler):
+    @property
+    def service(self):
+        return self.application.service
+
+    def get_tenant(self):
+        tenant = self.request.headers.get('X-Tenant-ID', 'default')
+        if not TENANT_PATTERN.match(tenant):
+            raise tornado.web.HTTPError(400, reason='Invalid X-Tenant-ID header.')
+        return tenant
+
+    async def get_job(self, run_id):
+        job = await self.service.get_job(self.get_tenant(), run_id)
+        if job is None:
+            raise tornado.web.HTTPError(404, reason='Run %s not found.' % run_id)
+        return job
+
+    def write_json(self, status, data):
+        self.set_status(status)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps(data, ensure_ascii=False, default=str))
+
+    def write_error(self, status_code, **kwargs):
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({'error': self._reason}))
+
+
+class RunsHandler(_BaseHandler):
+    def post(self):
+        tenant = self.get_tenant()
+        try:
+            data = json.loads(self.request.body)
+            question = data['question'].strip()
+        except (ValueError, KeyError, AttributeError, TypeError):
+            raise tornado.web.HTTPError(400, reason='The body must be a JSON object with a "question".')
+        options = {key: data[key] for key in RUN_OPTIONS if key in data}
+        try:
+            job = self.service.submit(tenant, question, options)
+        except Rejected as e:
+            self.set_header('Retry-After', str(e.retry_after))
+            self.write_json(e.status, {'error': str(e), 'retry_after': e.retry_after})
+            return
+        self.write_json(202, {
+            'run_id': job.run_id,
+            'status': job.status,
+            'status_url': '/v1/runs/%s' % job.run_id,
+            'events_url': '/v1/runs/%s/events' % job.run_id,
+        })
+
+
+class RunHandler(_BaseHandler):
+    async def get(self, run_id):
+        job = await self.get_job(run_id)
+        info = job.info()
+        if self.get_argument('trajectory', None) is not None and job.record is not None:
+            info['tool_use_chain'] = job.record.get('tool_use_chain')
+            info['conversation'] = job.record.get('conversation')
+        self.write_json(200, info)
+
+
+class RunEventsHandler(_BaseHandler):
+    """Server-Sent Events of a run: queued, started, step (one per tool use chain entry), answer_delta (with a
+    streaming agent), and finally final or error. Earlier events are replayed from `Last-Event-ID` or the start, as far
+    as they are kept (see AgentJob)."""
+
+    async def get(self, run_id):
+        job = await self.get_job(run_id)
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('X-Accel-Buffering', 'no')
+        try:
+            next_id = int(self.request.headers.get('Last-Event-ID', -1)) + 1
+        except ValueError:
+            next_id = 0
+        try:
+            while True:
+                for event_id, event, data in job.events_since(next_id):
+                    self.write('id: %d\nevent: %s\ndata: %s\n\n' % (event_id, event, json.dumps(data, ensure_ascii=False, default=str)))
+                    next_id = event_id + 1
+                await self.flush()
+                if len(job.events) > 0 and next_id <= job.events[-1][0]:
+                    # Published while flushing, which a wait would miss
+                    continue
+                if job.finished:
+                    break
+                if not await job.wait(KEEP_ALIVE_INTERVAL):
+                    self.write(': keep-alive\n\n')
+        except tornado.iostream.StreamClosedError:
+            return
+        self.finish()
+
+
+class MetricsHandler(_BaseHandler):
+    def get(self):
+        self.write_json(200, self.service.metrics())
+
+
+class HealthHandler(_BaseHandler):
+    def get(self):
+        self.write_json(200, {'status': 'ok'})
+
+
+def make_app(service):
+    app = tornado.web.Application([
+        (r'/v1/runs', RunsHandler),
+        (r'/v1/runs/([0-9a-f]+)', RunHandler),
+        (r'/v1/runs/([0-9a-f]+)/events', RunEventsHandler),
+        (r'/v1/metrics', MetricsHandler),
+        (r'/healthz', HealthHandler),
+    ])
+    app.service = service
+    return app
+
+
+if __name__ == '__main__':
+    from chemagent import ChemAgent
+
+    parser = argparse.ArgumentParser(description='Serve ChemAgent over HTTP. Use a mock- model (see python_server/mock_llm.py) to test it locally.')
+    parser.add_argument('--port', type=int, default=8920)
+    parser.add_argument('--model', type=str, default='gpt-4o-2024-08-06')
+    parser.add_argument('--include-tools', type=str, nargs='*', default=None)
+    parser.add_argument('--tool-server-url', type=str, default=None, help='Use the tools of a tool server (see chemagent/tools/tool_server.py).')
+    parser.add_argument('--tool-cache', type=str, default=None)
+    parser.add_argument('--run-timeout', type=float, default=None, help='Seconds after which a run is stopped.')
+    parser.add_argument('--workers', type=int, default=8, help='Questions run concurrently.')
+    parser.add_argument('--tenant-concurrency', type=int, default=2, help='Questions of one tenant run concurrently.')
+    parser.add_argument('--tenant-queue', type=int, default=16, help='Waiting questions of one tenant beyond which they are rejected with 429.')
+    parser.add_argument('--max-queue', type=int, default=256, help='Waiting questions beyond which they are rejected with 503.')
+    parser.add_argument('--trajectory-dir', type=str, default='runs/service')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    api_keys = {}
+    if not args.model.startswith('mock-'):
+        from api_keys import api_keys
+    agent = ChemAgent(
+        model=args.model,
+        api_keys=api_keys,
+        include_tools=args.include_tools,
+        tool_cache=args.tool_cache,
+        run_timeout=args.run_timeout,
+        tool_server_url=args.tool_server_url,
+    )
+    service = AgentService(
+        agent,
+        num_workers=args.workers,
+        tenant_concurrency=args.tenant_concurrency,
+        tenant_queue=args.tenant_queue,
+        max_queue=args.max_queue,
+        trajectory_dir=args.trajectory_dir,
+    )
+    server = tornado.httpserver.HTTPServer(make_app(service))
+    server.listen(args.port)
+    logger.info('ChemAgent service listening on port %d' % args.port)
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    finally:
+        service.close()
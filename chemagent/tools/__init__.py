@@ -1,4 +1,5 @@
 from .base import BaseTool
+from .cache import ToolCache, MemoryToolCache, SQLiteToolCache, LMDBToolCache, get_tool_cache, set_active_tool_cache, get_active_tool_cache
 
 from .chemspace import ChemSpace, GetMoleculePrice
 from .name_conversion import SMILES2IUPAC, IUPAC2SMILES, SMILES2Formula, SMILES2SELFIES, SELFIES2SMILES, Name2SMILES
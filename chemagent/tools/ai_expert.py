@@ -15,9 +15,9 @@ class AiExpert(BaseTool):
         {'input': 'What is the boiling point of water?', 'output': 'The boiling point of water at standard atmospheric pressure (1 atmosphere or 101.325 kPa) is 100°C (212°F). However, the boiling point can vary depending on the surrounding atmospheric pressure. For example, at higher altitudes where the atmospheric pressure is lower, water boils at a temperature lower than 100°C.'},
     ]
 
-    def __init__(self, api_keys, model="gpt-4-turbo-2024-04-09", init=True, interface='text'):
+    def __init__(self, api_keys, model="gpt-4-turbo-2024-04-09", init=True, interface='text', llm_cache=None):
         super().__init__(init, interface=interface)
-        self.llm = make_llm(model, api_keys)
+        self.llm = make_llm(model, api_keys, cache=llm_cache)
 
     def _run_base(self, query: str, *args, **kwargs) -> str:
         conv = [
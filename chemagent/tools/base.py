@@ -1,5 +1,12 @@
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import logging
+import threading
+
+from chemagent.utils.error import ChemAgentTimeoutError
+from chemagent.utils.deadline import remaining
+from .cache import CACHE_POLICIES, make_tool_cache_key, get_active_tool_cache
+from .single_flight import tool_calls
 
 
 logger = logging.getLogger(__name__)
@@ -13,9 +20,30 @@ class BaseTool(ABC):
     func_description: str
     examples: list
 
-    def __init__(self, init=True, interface='text') -> None:
+    # Result caching across runs (see chemagent/tools/cache.py): 'never', 'forever', or 'ttl' for `cache_ttl` seconds.
+    # Bump `version` when a change to the tool changes its outputs, so that earlier cached results are not used.
+    cache_policy = 'never'
+    cache_ttl = None
+    version = '1'
+    # Instance settings that change the outputs, e.g., the model of an LLM-backed tool, as part of the cache key
+    cache_key_extra = None
+    # Concurrent identical calls share one execution (see chemagent/tools/single_flight.py). Disable it for tools 
+    # whose output depends on state beyond the call arguments.
+    single_flight = True
+    # Set it to False for tools whose calls must not overlap, e.g., because they share model state or temporary paths 
+    # between calls. Their calls then run one at a time, and the agent and the tool server schedule them in order.
+    thread_safe = True
+    # The tool server (see chemagent/tools/tool_server.py) runs up to this many single-input calls together in 
+    # `_run_base_batch`, for tools that implement it.
+    max_batch_size = 1
+
+    def __init__(self, init=True, interface='text', cache=None) -> None:
         assert interface in ('text', 'code'), "Interface '%s' is not supported. Please use 'text' or 'code'." % interface
+        assert self.cache_policy in CACHE_POLICIES, "Cache policy '%s' is not supported. Please use one of %s." % (self.cache_policy, ', '.join(CACHE_POLICIES))
         self.interface = interface
+        self.cache = cache
+        self._call_lock = threading.Lock()
+        self._call_state = threading.local()
         super().__init__()
         if init:
             self._init_modules()
@@ -24,16 +52,58 @@ class BaseTool(ABC):
         pass
 
     def __call__(self, *args, **kwargs):
+        cache = self._result_cache()
+        if cache is None and not self.single_flight:
+            return self._call(None, None, *args, **kwargs)
+        key = make_tool_cache_key(self, self.interface, args[:1] if self.interface == 'text' else args, {} if self.interface == 'text' else kwargs)
+        if not self.single_flight:
+            return self._call(cache, key, *args, **kwargs)
+        return tool_calls.do(key, lambda: self._call(cache, key, *args, **kwargs))
+
+    def _call(self, cache, key, *args, **kwargs):
         logger.debug("===== Starting tool {} =====".format(self.__class__.name))
-        if self.interface == 'text':
-            r = self.run_text(args[0])
-        elif self.interface == 'code':
-            r = self.run_code(*args, **kwargs)
-        else:
-            raise NotImplementedError("Interface '%s' is not supported. Please use 'text' or 'code'." % self.interface)
+        if cache is not None:
+            r = cache.get(key)
+            if r is not None:
+                logger.debug("----- Ending tool {} (cached) -----".format(self.__class__.name))
+                return r
+        self._call_state.skip_cache = False
+        with self._exclusive():
+            if self.interface == 'text':
+                r = self.run_text(args[0], **kwargs)
+            elif self.interface == 'code':
+                r = self.run_code(*args, **kwargs)
+            else:
+                raise NotImplementedError("Interface '%s' is not supported. Please use 'text' or 'code'." % self.interface)
+        if cache is not None and not self._call_state.skip_cache:
+            cache.set(key, r, ttl=self.cache_ttl if self.cache_policy == 'ttl' else None)
         logger.debug("----- Ending tool {} -----".format(self.__class__.name))
         return r
 
+    def _skip_result_cache(self):
+        """Keep the result of the running call out of the cache, e.g., a neural network guess made because the lookup 
+        failed, which could be answered properly later."""
+        self._call_state.skip_cache = True
+
+    @contextmanager
+    def _exclusive(self):
+        """Hold the call lock of a tool that is not `thread_safe`, waiting no longer than the deadline of the call."""
+        if self.thread_safe:
+            yield
+            return
+        timeout = remaining()
+        if not self._call_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise ChemAgentTimeoutError("%s was busy with another call until the time limit." % self.name)
+        try:
+            yield
+        finally:
+            self._call_lock.release()
+
+    def _result_cache(self):
+        if self.cache_policy == 'never':
+            return None
+        return self.cache if self.cache is not None else get_active_tool_cache()
+
     def run_text(self, query, *args, **kwargs):
         return self._run_text(query, *args, **kwargs)
     
@@ -50,5 +120,33 @@ class BaseTool(ABC):
     def _run_base(self, *args, **kwargs):
         raise NotImplementedError
 
+    def _run_base_batch(self, queries):
+        """Run `_run_base` on several inputs at once. Returns one result or exception per input."""
+        raise NotImplementedError
+
+    def run_batch(self, queries, interface='text'):
+        """Run the tool on several single inputs, e.g., SMILES, in one `_run_base_batch` call. Returns one 
+        (success, result or exception) pair per input. If the batch call itself fails, the inputs are run one by one."""
+        with self._exclusive():
+            try:
+                results = self._run_base_batch(list(queries))
+                assert len(results) == len(queries), "_run_base_batch must return one result per input."
+            except (KeyboardInterrupt, ChemAgentTimeoutError):
+                raise
+            except Exception as e:
+                logger.debug("Batch call of tool %s failed: %s. Running the inputs one by one." % (self.name, e))
+                results = []
+                for query in queries:
+                    try:
+                        results.append(self._run_base(query))
+                    except KeyboardInterrupt:
+                        raise
+                    except Exception as e:
+                        results.append(e)
+        return [
+            (False, r) if isinstance(r, BaseException) else (True, str(r) if interface == 'text' else r)
+            for r in results
+        ]
+
     def run(self, query, *args, **kwargs):
         raise DeprecationWarning("The run function is deprecated. Please modify the implementation.")
@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+CACHE_POLICIES = ('never', 'forever', 'ttl')
+
+
+def make_tool_cache_key(tool, interface, args, kwargs):
+    """A stable hash of a tool call: the tool name, version and `cache_key_extra`, the interface, and the arguments."""
+    data = {
+        'tool': tool.name,
+        'version': tool.version,
+        'extra': getattr(tool, 'cache_key_extra', None),
+        'interface': interface,
+        'args': args,
+        'kwargs': kwargs,
+    }
+    text = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=repr)
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ToolCache(object):
+    """Base class of tool result caches. Values are stored as JSON with an optional expiry time."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the cached value of `key`, or None if it is missing or expired."""
+        item = self._get(key)
+        if item is not None and item[1] is not None and item[1] < time.time():
+            self._delete(key)
+            item = None
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(item[0])
+
+    def set(self, key, value, ttl=None):
+        try:
+            text = json.dumps(value, ensure_ascii=False)
+        except (TypeError, ValueError):
+            logger.debug('Tool result of type %s is not cached since it is not JSON serializable.' % type(value).__name__)
+            return
+        self._set(key, text, time.time() + ttl if ttl is not None else None)
+
+    def _get(self, key):
+        """Return (value_text, expires_at) or None."""
+        raise NotImplementedError
+
+    def _set(self, key, text, expires_at):
+        raise NotImplementedError
+
+    def _delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemoryToolCache(ToolCache):
+    """In-process LRU cache holding up to `max_entries` results."""
+
+    def __init__(self, max_entries=10000):
+        super().__init__()
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+            return item
+
+    def _set(self, key, text, expires_at):
+        with self._lock:
+            self._items[key] = (text, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def _delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class SQLiteToolCache(ToolCache):
+    """Cache stored in a SQLite file shared by threads and processes."""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._lock = threading.Lock()
+
+        dir_name = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dir_name, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS tool_results (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)')
+            self._conn.commit()
+
+    def _get(self, key):
+        with self._lock:
+            return self._conn.execute('SELECT value, expires_at FROM tool_results WHERE key = ?', (key,)).fetchone()
+
+    def _set(self, key, text, expires_at):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO tool_results (key, value, expires_at) VALUES (?, ?, ?)', (key, text, expires_at))
+            self._conn.commit()
+
+    def _delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM tool_results WHERE key = ?', (key,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM tool_results')
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM tool_results').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LMDBToolCache(ToolCache):
+    """Cache stored in an LMDB file, suited to many concurrent readers across processes."""
+
+    def __init__(self, path, map_size=1 << 32):
+        import lmdb
+
+        super().__init__()
+        self.path = path
+        dir_name = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dir_name, exist_ok=True)
+        self._env = lmdb.open(path, subdir=False, map_size=map_size, max_readers=256, lock=True)
+
+    def _get(self, key):
+        with self._env.begin() as txn:
+            data = txn.get(key.encode('utf-8'))
+        if data is None:
+            return None
+        item = json.loads(data.decode('utf-8'))
+        return item['value'], item['expires_at']
+
+    def _set(self, key, text, expires_at):
+        data = json.dumps({'value': text, 'expires_at': expires_at}, ensure_ascii=False).encode('utf-8')
+        with self._env.begin(write=True) as txn:
+            txn.put(key.encode('utf-8'), data)
+
+    def _delete(self, key):
+        with self._env.begin(write=True) as txn:
+            txn.delete(key.encode('utf-8'))
+
+    def clear(self):
+        with self._env.begin(write=True) as txn:
+            txn.drop(self._env.open_db(), delete=False)
+
+    def __len__(self):
+        return self._env.stat()['entries']
+
+    def close(self):
+        self._env.close()
+
+
+_caches = {}
+_active_cache = None
+_lock = threading.Lock()
+
+
+def get_tool_cache(cache):
+    """Return `cache` itself if it is a ToolCache, a new in-memory cache for 'memory', or the process-wide cache stored
+    at the path `cache` (LMDB for a '.lmdb' path, SQLite otherwise)."""
+    if cache is None or isinstance(cache, ToolCache):
+        return cache
+    if cache == 'memory':
+        return MemoryToolCache()
+    path = os.path.abspath(cache)
+    with _lock:
+        if path not in _caches:
+            _caches[path] = LMDBToolCache(path) if path.endswith('.lmdb') else SQLiteToolCache(path)
+        return _caches[path]
+
+
+def set_active_tool_cache(cache):
+    """Set the cache used by tools without a cache of their own. Accepts the same values as `get_tool_cache`."""
+    global _active_cache
+    _active_cache = get_tool_cache(cache)
+    return _active_cache
+
+
+def get_active_tool_cache():
+    return _active_cache
@@ -4,6 +4,8 @@ import requests
 
 from chemagent.tools import BaseTool
 from chemagent.utils import is_smiles
+from chemagent.utils.deadline import remaining
+from chemagent.utils.circuit_breaker import get_circuit_breaker
 
 
 class ChemSpace:
@@ -12,13 +14,15 @@ class ChemSpace:
         self._renew_token()  # Create token
 
     def _renew_token(self):
-        self.chemspace_token = requests.get(
-            url="https://api.chem-space.com/auth/token",
-            headers={
-                "Accept": "application/json",
-                "Authorization": f"Bearer {self.chemspace_api_key}",
-            },
-        ).json()["access_token"]
+        with get_circuit_breaker('ChemSpace').guard():
+            self.chemspace_token = requests.get(
+                url="https://api.chem-space.com/auth/token",
+                headers={
+                    "Accept": "application/json",
+                    "Authorization": f"Bearer {self.chemspace_api_key}",
+                },
+                timeout=remaining(),
+            ).json()["access_token"]
 
     def _make_api_request(
         self,
@@ -39,15 +43,17 @@ class ChemSpace:
         """
 
         def _do_request():
-            data = requests.request(
-                "POST",
-                url=f"https://api.chem-space.com/v3/search/{request_type}?count={count}&page=1&categories={categories}",
-                headers={
-                    "Accept": "application/json; version=3.1",
-                    "Authorization": f"Bearer {self.chemspace_token}",
-                },
-                data={"SMILES": f"{query}"},
-            ).json()
+            with get_circuit_breaker('ChemSpace').guard():
+                data = requests.request(
+                    "POST",
+                    url=f"https://api.chem-space.com/v3/search/{request_type}?count={count}&page=1&categories={categories}",
+                    headers={
+                        "Accept": "application/json; version=3.1",
+                        "Authorization": f"Bearer {self.chemspace_token}",
+                    },
+                    data={"SMILES": f"{query}"},
+                    timeout=remaining(),
+                ).json()
             return data
 
         data = _do_request()
@@ -172,6 +178,8 @@ class GetMoleculePrice(BaseTool):
     func_name = 'get_molecule_price'
     description = "Get the cheapest available price of a molecule. Input SMILES of a molecule, it returns the price (if purchasable)."
     func_doc = ("smiles: str", "str")
+    cache_policy = 'ttl'
+    cache_ttl = 24 * 3600
     func_description = description
     examples = [
         {'input': 'CCO', 'output': '25g of this molecule cost 143 USD and can be purchased at A2B Chem.'},
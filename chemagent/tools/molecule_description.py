@@ -1,8 +1,17 @@
-from transformers import T5Tokenizer, T5ForConditionalGeneration
+import torch
+from transformers import T5Tokenizer, T5ForConditionalGeneration, StoppingCriteria, StoppingCriteriaList
 
 from .base import BaseTool
 from chemagent.utils.smiles import is_smiles
 from chemagent.utils.error import *
+from chemagent.utils.deadline import expired, check_deadline
+
+
+class DeadlineStoppingCriteria(StoppingCriteria):
+    """Stop the generation once the tool call has timed out (see chemagent/utils/deadline.py)."""
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), expired(), dtype=torch.bool, device=input_ids.device)
 
 
 class MoleculeCaptioner(BaseTool):
@@ -11,6 +20,9 @@ class MoleculeCaptioner(BaseTool):
     description = "Input the SMILES of a molecule/compound, returns the textual description of the molecule/compound. This tool uses neural networks to generate descriptions, which may not be accurate or correct. You should try the PubchemSearch or WebSearch tool first, which provide accurate and authoritative information, and only use this one when other tools cannot provides useful information."
     func_doc = ("smiles: str", "str")
     func_description = description
+    max_batch_size = 8
+    # One model instance, whose generation is not safe to run from several threads
+    thread_safe = False
     examples = [
         {'input': 'CCO', 'output': 'The molecule is an ether in which the oxygen atom is linked to two ethyl groups. It has a role as an inhalation anaesthetic, a non-polar solvent and a refrigerant. It is a volatile organic compound and an ether.'},
     ]
@@ -31,9 +43,18 @@ class MoleculeCaptioner(BaseTool):
         if self.tokenizer is None or self.model is None:
             self._init_modules()
         input_ids = self.tokenizer(smiles, return_tensors="pt").input_ids
-        outputs = self.model.generate(input_ids, num_beams=5, max_length=1024)
+        outputs = self.model.generate(input_ids, num_beams=5, max_length=1024, stopping_criteria=StoppingCriteriaList([DeadlineStoppingCriteria()]))
+        check_deadline()
         text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
         return text
+
+    def _run_molt5_batch(self, smiles_list):
+        if self.tokenizer is None or self.model is None:
+            self._init_modules()
+        inputs = self.tokenizer(smiles_list, return_tensors="pt", padding=True)
+        outputs = self.model.generate(inputs.input_ids, attention_mask=inputs.attention_mask, num_beams=5, max_length=1024, stopping_criteria=StoppingCriteriaList([DeadlineStoppingCriteria()]))
+        check_deadline()
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
     
     def _run_base(self, smiles, *args, **kwargs):
         if not is_smiles(smiles):
@@ -41,6 +62,14 @@ class MoleculeCaptioner(BaseTool):
         
         return self._run_molt5(smiles)
 
+    def _run_base_batch(self, smiles_list):
+        results = [None if is_smiles(smiles) else ChemAgentInputError("The input is not a valid SMILES. Please double check.") for smiles in smiles_list]
+        valid = [idx for idx, r in enumerate(results) if r is None]
+        if len(valid) > 0:
+            for idx, text in zip(valid, self._run_molt5_batch([smiles_list[idx] for idx in valid])):
+                results[idx] = text
+        return results
+
 
 class MoleculeGenerator(BaseTool):
     name = "MoleculeGenerator"
@@ -48,6 +77,9 @@ class MoleculeGenerator(BaseTool):
     description = "Input a description of a molecule/compound, returns the SMILES representation of the molecule/compound. This tool uses neural networks to generate molecules, which may not be accurate or correct."
     func_doc = ("description: str", "str")
     func_description = description
+    max_batch_size = 8
+    # One model instance, whose generation is not safe to run from several threads
+    thread_safe = False
     examples = [
         {'input': 'The molecule is an ether in which the oxygen atom is linked to two ethyl groups. It has a role as an inhalation anaesthetic, a non-polar solvent and a refrigerant. It is a volatile organic compound and an ether.', 'output': 'CCO'},
     ]
@@ -68,9 +100,21 @@ class MoleculeGenerator(BaseTool):
         if self.tokenizer is None or self.model is None:
             self._init_modules()
         input_ids = self.tokenizer(text, return_tensors="pt").input_ids
-        outputs = self.model.generate(input_ids, num_beams=5, max_length=512)
+        outputs = self.model.generate(input_ids, num_beams=5, max_length=512, stopping_criteria=StoppingCriteriaList([DeadlineStoppingCriteria()]))
+        check_deadline()
         smiles = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
         return smiles
+
+    def _run_molt5_batch(self, texts):
+        if self.tokenizer is None or self.model is None:
+            self._init_modules()
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True)
+        outputs = self.model.generate(inputs.input_ids, attention_mask=inputs.attention_mask, num_beams=5, max_length=512, stopping_criteria=StoppingCriteriaList([DeadlineStoppingCriteria()]))
+        check_deadline()
+        return self.tokenizer.batch_decode(outputs, skip_special_tokens=True)
     
     def _run_base(self, description, *args, **kwargs):
         return self._run_molt5(description)
+
+    def _run_base_batch(self, descriptions):
+        return self._run_molt5_batch(descriptions)
@@ -6,6 +6,7 @@ from rdkit import Chem
 import rdkit.Chem.rdMolDescriptors as molD
 
 from chemagent.utils.error import *
+from chemagent.utils.circuit_breaker import get_circuit_breaker
 from chemagent.tools import BaseTool, ChemSpace
 from chemagent.utils import (
     # canonicalize_molecule_smiles,
@@ -20,6 +21,11 @@ from chemagent.utils import (
 logger = logging.getLogger(__name__)
 
 
+def pubchem_breaker():
+    # Not found and bad requests mean the service is working
+    return get_circuit_breaker('PubChem').guard(ignore=(pcp.BadRequestError, pcp.NotFoundError))
+
+
 def pubchem_iupac2smiles(
     query: str,
 ) -> str:
@@ -28,7 +34,8 @@ def pubchem_iupac2smiles(
         cid = (cid,)
     smiles = []
     for single_cid in cid:
-        c = pcp.Compound.from_cid(single_cid)
+        with pubchem_breaker():
+            c = pcp.Compound.from_cid(single_cid)
         r = c.isomeric_smiles
         smiles.append(r)
     r = '.'.join(smiles)
@@ -40,7 +47,8 @@ def pubchem_name2smiles(
     query: str,
 ) -> str:
     cid = pubchem_name2cid(query)
-    c = pcp.Compound.from_cid(cid)
+    with pubchem_breaker():
+        c = pcp.Compound.from_cid(cid)
     r = c.isomeric_smiles
 
     return r
@@ -49,7 +57,8 @@ def pubchem_name2smiles(
 def pubchem_smiles2iupac(smi):
     """This function queries the given molecule smiles and returns iupac"""
 
-    c = pcp.get_compounds(smi, 'smiles')
+    with pubchem_breaker():
+        c = pcp.get_compounds(smi, 'smiles')
     
     if len(c) == 0:
         parts = smi.split('.')
@@ -99,6 +108,8 @@ class IUPAC2SMILES(BaseTool):
     func_name = 'convert_iupac_to_smiles'
     description = "Input IUPAC name of molecule/compound (one at a time), returns SMILES. To get SMILES from IUPAC name, you must use this tool."
     func_doc = ("iupac: str", "str")
+    cache_policy = 'ttl'
+    cache_ttl = 7 * 24 * 3600
     func_description = description
     examples = [
         {'input': 'ethanol', 'output': 'CCO'},
@@ -118,7 +129,7 @@ class IUPAC2SMILES(BaseTool):
             try:
                 smi = pubchem_iupac2smiles(query)
                 logger.debug("Looking up PubChem succeeded.")
-            except ChemAgentSearchError as e:
+            except (ChemAgentSearchError, ChemAgentCircuitOpenError) as e:
                 logger.debug("Looking up PubChem failed.")
                 if self.chemspace_api_key:
                     chemspace = ChemSpace(self.chemspace_api_key)
@@ -135,12 +146,13 @@ class IUPAC2SMILES(BaseTool):
                 else:
                     logger.debug("Looking up ChemSpace failed, because ChemSpace API is not set.")
                     raise
-        except ChemAgentSearchError:
+        except (ChemAgentSearchError, ChemAgentCircuitOpenError):
             try:
                 if self.translate_reverse is None:
                     self._init_modules()
                 smi = self.translate_reverse(query)
                 smi = smi + '\nNote: The result is predicted by neural networks and is possibly incorrect or inaccurate.'
+                self._skip_result_cache()
             except:
                 logger.debug("Using STOUT failed.")
                 raise ChemAgentToolProcessError("Error: Cannot get the SMILES of the input IUPAC name.")
@@ -156,6 +168,8 @@ class SMILES2IUPAC(BaseTool):
     func_name = 'convert_smiles_to_iupac'
     description = "Input SMILES of a molecule/compound (one at a time), returns IUPAC name. To get IUPAC name from SMILES, you must use this tool."
     func_doc = ("smiles: str", "str")
+    cache_policy = 'ttl'
+    cache_ttl = 7 * 24 * 3600
     func_description = description
     examples = [
         {'input': 'CCO', 'output': 'ethanol'},
@@ -194,6 +208,7 @@ class SMILES2IUPAC(BaseTool):
                     self._init_modules()
                 name = self.translate_forward(query)
                 name = name + '\nNote: The result is predicted by neural networks and is possibly incorrect or inaccurate.'
+                self._skip_result_cache()
                 logger.debug("Using STOUT succeeded.")
             except (KeyboardInterrupt, ImportError):
                 raise
@@ -209,6 +224,7 @@ class SMILES2Formula(BaseTool):
     func_name = 'convert_smiles_to_molecular_formula'
     description = "Input SMILES of a molecule/compound (one at a time), returns molecular formula. To get molecular formula from SMILES, you must use this tool."
     func_doc = ("smiles: str", "str")
+    cache_policy = 'forever'
     func_description = description
     examples = [
         {'input': 'CCO', 'output': 'C2H6O'},
@@ -231,6 +247,8 @@ class Name2SMILES(BaseTool):
     func_name = 'convert_chemical_name_to_smiles'
     description = "Input common name of molecule/compound (one at a time), returns SMILES."
     func_doc = ("name: str", "str")
+    cache_policy = 'ttl'
+    cache_ttl = 7 * 24 * 3600
     func_description = description
     examples = [
         {'input': 'aspirin', 'output': 'CC(=O)OC1=CC=CC=C1C(=O)O'},
@@ -252,6 +270,7 @@ class SELFIES2SMILES(BaseTool):
         "Input SELFIES representation, returns SMILES representation."
     )
     func_doc = ("selfies: str", "str")
+    cache_policy = 'forever'
     func_description = description
     examples = [
         {'input': '[C][C][O]', 'output': 'CCO'},
@@ -274,6 +293,7 @@ class SMILES2SELFIES(BaseTool):
         "Input SMILES representation, returns SELFIES representation."
     )
     func_doc = ("smiles: str", "str")
+    cache_policy = 'forever'
     func_description = description
     examples = [
         {'input': 'CCO', 'output': '[C][C][O]'},
@@ -49,6 +49,10 @@ MODEL_ARGS = {
 
 
 class PropertyPredictor(BaseTool):
+    cache_policy = 'forever'
+    # Uni-Mol reads the input and writes the results through the paths in `self.args`
+    thread_safe = False
+
     def __init__(
         self, 
         task_name,
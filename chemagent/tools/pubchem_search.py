@@ -8,7 +8,8 @@ import pubchempy as pcp
 from .base import BaseTool
 from chemagent.utils.error import *
 from chemagent.utils.smiles import is_smiles
-from chemagent.utils.pubchem_utils import pubchem_iupac2cid, pubchem_name2cid
+from chemagent.utils.pubchem_utils import pubchem_iupac2cid, pubchem_name2cid, pubchem_get_json
+from chemagent.utils.circuit_breaker import get_circuit_breaker
 from ..llms import make_llm
 
 
@@ -193,6 +194,8 @@ class PubchemSearch(BaseTool):
     func_name = 'search_pubchem'
     description = "Search for molecule/compound information on PubChem, one of the most comprehensive database of chemical molecules and their activities. Input \"representation name: representation\" (e.g., \"SMILES: <SMILES>\", \"IUPAC: <IUPAC name>\", or \"Name: <common name>\", one at a time), returns the information of the molecule."
     func_doc = ("namespace: str", "identifier: str", "str")
+    cache_policy = 'ttl'
+    cache_ttl = 7 * 24 * 3600
     func_description = "Search for molecule/compound information on PubChem, one of the most comprehensive database of chemical molecules and their activities. namespace can be \"SMILES\", \"IUPAC\", or \"Name\". identifier is the SMILES, IUPAC name, or the common name of the molecule/compound, corresponding to the namespace used."
     examples = [
         {'input': 'SMILES: CCO', 'output': '# 1 Names and Identifiers\nSection Description: Chemical names, synonyms, identifiers, and descriptors.\n\n## 1.1 Record Description\nSection Description: Summary Information\n\nEthanol with a small amount of an adulterant added so as to be unfit for use as a beverage. [...]'},
@@ -248,7 +251,8 @@ class PubchemSearch(BaseTool):
             cid = pubchem_iupac2cid(identifier)
         elif namespace == 'smiles':
             try:
-                c = pcp.get_compounds(identifier, namespace=namespace)
+                with get_circuit_breaker('PubChem').guard(ignore=(pcp.BadRequestError, pcp.NotFoundError)):
+                    c = pcp.get_compounds(identifier, namespace=namespace)
             except pcp.BadRequestError:
                 raise ChemAgentSearchError("Error occurred while searching for the molecule/compound on PubChem. Please try other tools or double check your input.")
             if len(c) >= 1:
@@ -267,7 +271,7 @@ class PubchemSearch(BaseTool):
     @staticmethod
     def get_data(cid):
         url = PubchemSearch.url.format(cid)
-        data = requests.get(url).json()
+        data = pubchem_get_json(url)
         return data
     
     @staticmethod
@@ -311,6 +315,8 @@ class PubchemSearchQA(BaseTool):
     func_name = 'search_pubchem_qa'
     description = "Search for molecule/compound information on PubChem, one of the most comprehensive database of chemical molecules and their activities. Input \"representation name: representation\" (e.g., \"SMILES: <SMILES>\", \"IUPAC: <IUPAC name>\", or \"Name: <common name>\", one at a time), followed by \"Question: <your question about the molecule/compound>\", returns the related information."
     func_doc = ("namespace: str", "identifier: str", "question: str", "str")
+    cache_policy = 'ttl'
+    cache_ttl = 7 * 24 * 3600
     func_description = "Search for molecule/compound information on PubChem, one of the most comprehensive database of chemical molecules and their activities. namespace can be \"SMILES\", \"IUPAC\", or \"Name\". identifier is the SMILES, IUPAC name, or the common name of the molecule/compound, corresponding to the namespace used. question is the question about the molecule/compound."
     examples = [  # TODO
         {'input': 'SMILES: CCO', 'output': '# 1 Names and Identifiers\nSection Description: Chemical names, synonyms, identifiers, and descriptors.\n\n## 1.1 Record Description\nSection Description: Summary Information\n\nEthanol with a small amount of an adulterant added so as to be unfit for use as a beverage. [...]'},
@@ -318,10 +324,12 @@ class PubchemSearchQA(BaseTool):
         {'input': 'Name: alcohol', 'output': '# 1 Names and Identifiers\nSection Description: Chemical names, synonyms, identifiers, and descriptors.\n\n## 1.1 Record Description\nSection Description: Summary Information\n\nEthanol with a small amount of an adulterant added so as to be unfit for use as a beverage. [...]'},
     ]
 
-    def __init__(self, api_keys, llm_model='gpt-4o-2024-08-06', init=True, interface='text') -> None:
+    def __init__(self, api_keys, llm_model='gpt-4o-2024-08-06', init=True, interface='text', llm_cache=None) -> None:
         super().__init__(init, interface)
         self.pubchem_search = PubchemSearch(init=init, interface='code')
-        self.llm = make_llm(llm_model, api_keys)
+        self.llm = make_llm(llm_model, api_keys, cache=llm_cache)
+        # The answers are written by the LLM
+        self.cache_key_extra = llm_model
 
     def _run_text(self, query):
         if 'Question:' not in query:
@@ -2,15 +2,18 @@ import re
 import logging
 import requests
 import json
-import time
 
 from uuid import uuid4
 
 from chemagent.utils.error import *
+from chemagent.utils.deadline import remaining, sleep
 from .base import BaseTool
 
 logger = logging.getLogger(__name__)
 
+# Seconds the client waits for the server beyond the execution timeout, for the reply of an interrupted cell
+REPLY_GRACE_TIME = 5
+
 
 def sanitize_input(query: str) -> str:
     """Sanitize input to the python REPL.
@@ -36,9 +39,18 @@ class ClientJupyterKernel:
     def __init__(self, url):
         self.url = url
 
-    def execute(self, code, conv_id):
+    def execute(self, code, conv_id, setup=None, timeout=None):
+        """Run `code` in the kernel of `conv_id`. With `timeout`, the server interrupts the cell once the time is up, 
+        so that the kernel is free for the next code of the conversation."""
         payload = {"convid": conv_id, "code": code}
-        response = requests.post(self.url, data=json.dumps(payload))
+        if setup is not None:
+            payload["setup"] = setup
+        if timeout is not None:
+            payload["timeout"] = timeout
+        try:
+            response = requests.post(self.url, data=json.dumps(payload), timeout=None if timeout is None else timeout + REPLY_GRACE_TIME)
+        except requests.Timeout:
+            raise ChemAgentTimeoutError("The Python kernel did not reply within %g seconds." % (timeout + REPLY_GRACE_TIME))
         response_data = response.json()
         try:
             if response_data["new_kernel_created"]:
@@ -58,10 +70,16 @@ class PythonShell(BaseTool):
     examples = [
         {'input': 'print("Hello, World!")', 'output': 'Hello, World!'},
     ]
+    # The output depends on the state of the kernel
+    single_flight = False
 
-    def __init__(self, input_sanitize=True, init=True, interface='text', url='http://localhost:8888/execute', max_pool=5) -> None:
+    def __init__(self, input_sanitize=True, init=True, interface='text', url='http://localhost:8888/execute', max_pool=5, setup_code=None, timeout=None) -> None:
         super().__init__(init, interface)
         self.url = url
+        # Seconds after which a code cell is interrupted, also when the call has no deadline (the server default is 60)
+        self.timeout = timeout
+        # Code cells run once in each new kernel before the first input, e.g., to define functions
+        self.setup_code = setup_code
         self.input_sanitize = input_sanitize
         self.client = ClientJupyterKernel(self.url)
 
@@ -77,8 +95,8 @@ class PythonShell(BaseTool):
         k = 0
         while True:
             try:
-                r = self.client.execute(query, conv_id)
-            except KeyboardInterrupt:
+                r = self.client.execute(query, conv_id, setup=self.setup_code, timeout=remaining(self.timeout))
+            except (KeyboardInterrupt, ChemAgentTimeoutError):
                 raise
             except Exception as e:
                 raise ChemAgentFatalError(f"An error occurred while running the python code: {str(e)}")
@@ -90,7 +108,7 @@ class PythonShell(BaseTool):
                 if k > 3:
                     break
                 else:
-                    time.sleep(3)
+                    sleep(3)
                     logger.info('retrying')
                     continue
             
@@ -13,6 +13,7 @@ class MolSimilarity(BaseTool):
         "Input two molecule SMILES (separated by ';'), returns Tanimoto similarity."
     )
     func_doc = ("smiles1: str, smiles2: str", "str")
+    cache_policy = 'forever'
     func_description = description
     examples = [
         {'input': 'CCO;CCN', 'output': 'The Tanimoto similarity between CCO and CCN is 0.3333, indicating that the two molecules are not similar.'},
@@ -55,6 +56,7 @@ class SMILES2Weight(BaseTool):
     func_name = 'cal_molecular_weight'
     description = "Calculate molecular weight. Input SMILES, returns molecular weight."
     func_doc = ("smiles: str", "str")
+    cache_policy = 'forever'
     func_description = description
     examples = [
         {'input': 'CCO', 'output': '46.041864812'},
@@ -73,6 +75,7 @@ class FuncGroups(BaseTool):
     func_name = 'get_functional_groups'
     description = "Get the functional groups in a molecule. Input SMILES, return list of functional groups in the molecule."
     func_doc = ("smiles: str", "str")
+    cache_policy = 'forever'
     func_description = description
     examples = [
         {'input': 'CCO', 'output': 'This molecule contains alcohol groups, and side-chain hydroxyls.'},
@@ -160,6 +163,7 @@ class CompareSMILES(BaseTool):
     func_name = 'check_molecule_identical'
     description = "Input two molecule SMILES (separated by ';'), returns if they are identical. To judge if two molecules are identical, you should always use this tool, instead of directly comparing the SMILES strings."
     func_doc = ("smiles1: str, smiles2: str", "str")
+    cache_policy = 'forever'
     func_description = description
     examples = [
         {'input': 'CCO;CCN', 'output': 'different'},
@@ -197,6 +201,7 @@ class CanonicalizeSMILES(BaseTool):
     func_name = 'canonicalize_smiles'
     description = "Canonicalize SMILES representation. Input SMILES, returns canonicalized SMILES. You should use this tool when asked for canonicalized SMILES."
     func_doc = ("smiles: str", "str")
+    cache_policy = 'forever'
     func_description = description
     examples = [
         {'input': 'OCC', 'output': 'CCO'},
@@ -218,6 +223,7 @@ class CountMolAtoms(BaseTool):
     func_name = 'count_molecule_atoms'
     description = "Count the number of atoms in a molecule. Input SMILES, returns the types of atoms and their numbers."
     func_doc = ("smiles: str", "str")
+    cache_policy = 'forever'
     func_description = description
     examples = [
         {'input': 'CCO', 'output': 'There are altogether 3 atoms (omitting hydrogen atoms). The types and corresponding numbers are: {"C": 2, "O": 1}'},
@@ -3,11 +3,11 @@
 import logging
 import ast
 import re
-from time import sleep
-
 from rxn4chemistry import RXN4ChemistryWrapper  # type: ignore
 
 from chemagent.utils.error import *
+from chemagent.utils.deadline import sleep
+from chemagent.utils.circuit_breaker import get_circuit_breaker
 from chemagent.llms import GptRequester
 from chemagent.utils import is_smiles
 from .base import BaseTool
@@ -27,6 +27,9 @@ class RXN4Chem(BaseTool):
     base_url: str = "https://rxn.res.ibm.com"
     sleep_time: int = 5
 
+    cache_policy = 'ttl'
+    cache_ttl = 7 * 24 * 3600
+
     rxn4chem_chemistry_wrapper = None
 
     def __init__(self, rxn4chem_api_key, init=True, interface='text'):
@@ -49,7 +52,9 @@ class RXN4Chem(BaseTool):
         Retry Decorator.
 
         Retries the wrapped function/method `times` times if the exceptions
-        listed in ``exceptions`` are thrown
+        listed in ``exceptions`` are thrown. Running out of retries counts as
+        a failure of the RXN4Chemistry circuit breaker, and the function fails
+        immediately while the circuit is open.
         :param times: The number of times to repeat the wrapped function/method
         :type times: Int
         :param Exceptions: Lists of exceptions that trigger a retry attempt
@@ -58,18 +63,19 @@ class RXN4Chem(BaseTool):
 
         def decorator(func):
             def newfn(*args, **kwargs):
-                attempt = 0
-                while attempt < times:
-                    try:
-                        sleep(sleep_time)
-                        return func(*args, **kwargs)
-                    except exceptions:
-                        print(
-                            "Exception thrown when attempting to run %s, "
-                            "attempt %d of %d" % (func, attempt, times)
-                        )
-                        attempt += 1
-                return func(*args, **kwargs)
+                with get_circuit_breaker('RXN4Chemistry').guard():
+                    attempt = 0
+                    while attempt < times:
+                        try:
+                            sleep(sleep_time)
+                            return func(*args, **kwargs)
+                        except exceptions:
+                            print(
+                                "Exception thrown when attempting to run %s, "
+                                "attempt %d of %d" % (func, attempt, times)
+                            )
+                            attempt += 1
+                    return func(*args, **kwargs)
 
             return newfn
 
@@ -5,6 +5,7 @@ from tavily import TavilyClient
 from ..utils.error import *
 from ..tools import BaseTool
 from ..utils import is_smiles
+from ..utils.circuit_breaker import get_circuit_breaker
     
 
 class WebSearch(BaseTool):
@@ -12,6 +13,8 @@ class WebSearch(BaseTool):
     func_name = 'search_web'
     description = "Search the web for any questions and knowledge (including both general ones and domain-specific ones) and obtain concise summaries of the most relevant content. Input a specific question, returns a summary of the relevant content that answers the question."
     func_doc = ("question: str", "str")
+    cache_policy = 'ttl'
+    cache_ttl = 24 * 3600
     func_description = description
     examples = [
         {'input': 'What is the boiling point of water?', 'output': 'The boiling point of water at sea level is 100°C (212°F).'},
@@ -23,7 +26,8 @@ class WebSearch(BaseTool):
         super().__init__(init, interface=interface)
 
     def _run_base(self, query: str, *args, **kwargs) -> str:
-        response = self.client.search(query, search_depth='advanced', include_answer=True)
+        with get_circuit_breaker('Tavily').guard():
+            response = self.client.search(query, search_depth='advanced', include_answer=True)
         answer = response['answer']
         return answer
 
@@ -33,6 +37,8 @@ class PatentCheck(BaseTool):
     func_name = 'check_if_patented'
     description = "Input SMILES of a molecule (one at a time), returns if molecule is patented."
     func_doc = ("smiles: str", "str")
+    cache_policy = 'ttl'
+    cache_ttl = 24 * 3600
     func_description = description
     examples = [
         {'input': 'CCO', 'output': 'not patented'},
@@ -62,6 +68,8 @@ class Wikipedia(BaseTool):
     func_name: str = 'search_wikipedia'
     description: str = "Search Wikipedia. Input a search query, returns summaries of related content."
     func_doc = ("query: str", "str")
+    cache_policy = 'ttl'
+    cache_ttl = 24 * 3600
     func_description = description
     examples = [
         {'input': 'Water', 'output': 'Page: Water\nSummary: Water is an inorganic compound with the chemical formula H2O. It is a transparent, tasteless, odorless, and nearly colorless chemical substance, and it is the main constituent of Earth\'s hydrosphere and the fluids of all known living organisms (in which it acts as a solvent). [...]'},
@@ -0,0 +1,122 @@
+import logging
+import threading
+
+from chemagent.utils.error import ChemAgentTimeoutError
+from chemagent.utils.deadline import remaining, check_deadline
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.num_waiters = 0
+
+
+class SingleFlight(object):
+    """Deduplicate concurrent calls: while a call for a key is running, other calls for the same key wait for it and
+    get its result, or its exception, instead of running again.
+
+    Waiters wait no longer than their own deadline (see chemagent/utils/deadline.py). A timeout or an interruption of
+    the running call is not shared: the waiters try again, and one of them runs the call."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.executions = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is not None:
+                    call.num_waiters += 1
+                    self.shared += 1
+                    leader = False
+                else:
+                    call = _Call()
+                    self._calls[key] = call
+                    self.executions += 1
+                    leader = True
+
+            if leader:
+                break
+            if not call.done.wait(remaining()):
+                check_deadline()
+                continue
+            if isinstance(call.error, (ChemAgentTimeoutError, KeyboardInterrupt)):
+                logger.debug('The shared call timed out or was interrupted. Trying again.')
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            if call.num_waiters > 0:
+                logger.debug('Shared one call with %d concurrent callers.' % call.num_waiters)
+            call.done.set()
+        return call.result
+
+    def do_batch(self, keys, func):
+        """`do` for several keys whose calls run together: `func(indices)` runs the calls of `keys` at `indices` at 
+        once and returns one (success, result or exception) pair per index. The keys with a call already running wait 
+        for it as in `do`, and repeated keys share one call. Returns one (success, result or exception) pair per key."""
+        calls = {}
+        with self._lock:
+            for idx, key in enumerate(keys):
+                if key not in calls and key not in self._calls:
+                    calls[key] = (idx, _Call())
+                    self._calls[key] = calls[key][1]
+                    self.executions += 1
+        indices = sorted(idx for idx, _ in calls.values())
+        try:
+            results = func(indices) if len(indices) > 0 else []
+        except BaseException as e:
+            results = [(False, e)] * len(indices)
+            raise
+        finally:
+            for idx, (success, value) in zip(indices, results):
+                call = calls[keys[idx]][1]
+                if success:
+                    call.result = value
+                else:
+                    call.error = value
+            with self._lock:
+                for key in calls:
+                    del self._calls[key]
+            for _, call in calls.values():
+                call.done.set()
+
+        def run_one(idx):
+            success, value = func([idx])[0]
+            if not success:
+                raise value
+            return value
+
+        outputs = []
+        for idx, key in enumerate(keys):
+            if key in calls:
+                call = calls[key][1]
+                outputs.append((True, call.result) if call.error is None else (False, call.error))
+                continue
+            try:
+                outputs.append((True, self.do(key, lambda: run_one(idx))))
+            except (KeyboardInterrupt, ChemAgentTimeoutError):
+                raise
+            except Exception as e:
+                outputs.append((False, e))
+        return outputs
+
+
+tool_calls = SingleFlight()
@@ -0,0 +1,492 @@
+import os
+import json
+import queue
+import socket
+import logging
+import argparse
+import threading
+import time
+import uuid
+import http.client
+import socketserver
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from chemagent.utils import error as error_module
+from chemagent.utils.error import *
+from chemagent.utils.deadline import remaining, call_with_timeout
+from .base import BaseTool
+from .cache import make_tool_cache_key
+from .single_flight import tool_calls
+
+
+logger = logging.getLogger(__name__)
+
+# Tools that the server does not host by default: the Python shell, whose kernels belong to the conversations of each
+# worker, and the LLM-backed tools, which should use the model, LLM cache, and API keys of each worker.
+DEFAULT_LOCAL_TOOLS = frozenset(['PythonREPL', 'AiExpert', 'PubchemSearchQA'])
+
+_STOP = object()
+
+TOOL_SPEC_ATTRS = ('name', 'func_name', 'description', 'func_doc', 'func_description', 'examples', 'cache_policy', 'cache_ttl', 'version', 'cache_key_extra', 'single_flight')
+
+
+def tool_spec(tool):
+    """The class attributes of a tool that a RemoteTool needs to stand in for it."""
+    spec = {attr: getattr(tool, attr, None) for attr in TOOL_SPEC_ATTRS}
+    spec['class_name'] = tool.__class__.__name__
+    return spec
+
+
+class _ToolWorker(object):
+    """The queue of one hosted tool, drained by `concurrency` threads. A thread that takes a single-input call of a
+    tool with `max_batch_size` > 1 waits up to `batch_wait` seconds for more such calls, and runs them together.
+
+    The futures of the latest `max_recent_calls` calls are kept by call id, so that a client resending a call (e.g., 
+    after its connection dropped) gets the result of the first one instead of running the tool twice."""
+
+    max_recent_calls = 4096
+
+    def __init__(self, tool, concurrency=4, max_queue=0, batch_wait=0.01):
+        self.tool = tool
+        self.concurrency = concurrency
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._recent_calls = OrderedDict()
+        # Held by each execution until it actually returns: a call abandoned on timeout keeps its slot, so that no
+        # more than `concurrency` executions of the tool ever overlap
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self.stats = {'calls': 0, 'errors': 0, 'rejected': 0, 'resent': 0, 'batches': 0, 'batched_calls': 0, 'in_flight': 0, 'busy_time': 0.0}
+        self._threads = [
+            threading.Thread(target=self._loop, name='tool-%s-%d' % (tool.name, k), daemon=True)
+            for k in range(concurrency)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, interface, args, kwargs, timeout=None, call_id=None):
+        # The time spent in the queue counts towards the timeout
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            if call_id is not None and call_id in self._recent_calls:
+                self.stats['resent'] += 1
+                return self._recent_calls[call_id]
+            future = Future()
+            try:
+                self._queue.put_nowait((interface, args, kwargs, expires_at, future))
+            except queue.Full:
+                self.stats['rejected'] += 1
+                raise ChemAgentToolNotWorkingError("The tool server is busy: %d calls of %s are waiting. Please try again later." % (self._queue.qsize(), self.tool.name))
+            if call_id is not None:
+                self._recent_calls[call_id] = future
+                while len(self._recent_calls) > self.max_recent_calls:
+                    self._recent_calls.popitem(last=False)
+        return future
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(_STOP)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self.stats)
+        metrics['queued'] = self._queue.qsize()
+        metrics['concurrency'] = self.concurrency
+        return metrics
+
+    def _batchable(self, item, interface):
+        return item is not _STOP and item[0] == interface and len(item[1]) == 1 and len(item[2]) == 0
+
+    def _loop(self):
+        item = None
+        while True:
+            if item is None:
+                item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            item = None
+            if self.tool.max_batch_size > 1 and self._batchable(batch[0], batch[0][0]):
+                batch_deadline = time.monotonic() + self.batch_wait
+                while len(batch) < self.tool.max_batch_size:
+                    try:
+                        next_item = self._queue.get(timeout=max(batch_deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if not self._batchable(next_item, batch[0][0]):
+                        # Run it after the batch
+                        item = next_item
+                        break
+                    batch.append(next_item)
+            self._run(batch)
+
+    def _execute(self, func, expires_at):
+        """Run `func` in a slot of the tool, with the time left before `expires_at`."""
+        timeout = None if expires_at is None else expires_at - time.monotonic()
+        if timeout is not None and timeout <= 0:
+            raise ChemAgentTimeoutError("%s was not started since no time is left." % self.tool.name)
+        if not self._slots.acquire(timeout=-1 if timeout is None else timeout):
+            raise ChemAgentTimeoutError("%s was not started since the earlier calls took all the time left." % self.tool.name)
+        if expires_at is not None:
+            timeout = expires_at - time.monotonic()
+            if timeout <= 0:
+                self._slots.release()
+                raise ChemAgentTimeoutError("%s was not started since no time is left." % self.tool.name)
+
+        def run():
+            try:
+                return func()
+            finally:
+                self._slots.release()
+
+        return call_with_timeout(run, timeout, self.tool.name)
+
+    def _run(self, batch):
+        with self._lock:
+            self.stats['calls'] += len(batch)
+            self.stats['in_flight'] += len(batch)
+            if len(batch) > 1:
+                self.stats['batches'] += 1
+                self.stats['batched_calls'] += len(batch)
+        start_time = time.perf_counter()
+        try:
+            if len(batch) == 1:
+                interface, args, kwargs, expires_at, future = batch[0]
+                try:
+                    future.set_result(self._execute(lambda: self._call(interface, args, kwargs), expires_at))
+                except BaseException as e:
+                    future.set_exception(e)
+                    self._count_errors(1)
+            else:
+                expires = [item[3] for item in batch]
+                expires_at = None if None in expires else max(expires)
+                try:
+                    results = self._execute(lambda: self._call_batch(batch), expires_at)
+                except BaseException as e:
+                    results = [(False, e)] * len(batch)
+                for (success, result), item in zip(results, batch):
+                    if success:
+                        item[4].set_result(result)
+                    else:
+                        item[4].set_exception(result)
+                self._count_errors(sum(1 for success, _ in results if not success))
+        finally:
+            with self._lock:
+                self.stats['in_flight'] -= len(batch)
+                self.stats['busy_time'] += time.perf_counter() - start_time
+
+    def _count_errors(self, num_errors):
+        with self._lock:
+            self.stats['errors'] += num_errors
+
+    def _call(self, interface, args, kwargs):
+        """Returns (result, cacheable), where `cacheable` is False if the tool kept the result out of its cache."""
+        tool = self.tool
+
+        def func():
+            tool._call_state.skip_cache = False
+            if interface == 'text':
+                result = tool.run_text(args[0], **kwargs)
+            else:
+                result = tool.run_code(*args, **kwargs)
+            return result, not tool._call_state.skip_cache
+
+        if not tool.single_flight:
+            return func()
+        # Identical calls from different workers share one execution
+        return tool_calls.do(('tool_server', make_tool_cache_key(tool, interface, args, kwargs)), func)
+
+    def _call_batch(self, batch):
+        """Run the single-input calls of `batch` in one `run_batch` call. Returns one (success, (result, cacheable) or
+        exception) pair per call. With `single_flight`, each input shares the call of the same input that is already 
+        running, as in `_call`."""
+        tool = self.tool
+        interface = batch[0][0]
+
+        def func(indices):
+            results = tool.run_batch([batch[idx][1][0] for idx in indices], interface=interface)
+            return [(True, (result, True)) if success else (False, result) for success, result in results]
+
+        if not tool.single_flight:
+            return func(range(len(batch)))
+        keys = [('tool_server', make_tool_cache_key(tool, interface, item[1], item[2])) for item in batch]
+        return tool_calls.do_batch(keys, func)
+
+
+class _ToolServerHandler(BaseHTTPRequestHandler):
+    # Keep the connections of the workers open between calls
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server.tool_server
+        path = self.path.strip('/')
+        if path == 'tools':
+            self._reply(200, {'tools': [tool_spec(worker.tool) for worker in server.workers.values()]})
+        elif path == 'metrics':
+            self._reply(200, server.metrics())
+        else:
+            self._reply(404, {'error': 'Not found.'})
+
+    def do_POST(self):
+        server = self.server.tool_server
+        parts = self.path.strip('/').split('/')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as e:
+            self._reply(400, {'error': 'Invalid request: %s' % e})
+            return
+        if len(parts) != 2 or parts[0] != 'call' or parts[1] not in server.workers:
+            self._reply(404, {'error': '"%s" is not a tool hosted by this server.' % parts[-1], 'error_type': 'ChemAgentToolNotWorkingError'})
+            return
+        interface = data.get('interface', 'text')
+        if interface not in ('text', 'code'):
+            self._reply(400, {'error': "Interface '%s' is not supported. Please use 'text' or 'code'." % interface})
+            return
+        try:
+            future = server.workers[parts[1]].submit(interface, data.get('args', []), data.get('kwargs', {}), timeout=data.get('timeout'), call_id=data.get('call_id'))
+        except ChemAgentToolNotWorkingError as e:
+            self._reply(503, {'error': str(e), 'error_type': e.__class__.__name__})
+            return
+        try:
+            result, cacheable = future.result()
+        except Exception as e:
+            if not isinstance(e, ChemAgentGeneralError):
+                logger.exception('Tool %s failed on the tool server.' % parts[1])
+            self._reply(200, {'error': str(e), 'error_type': e.__class__.__name__})
+            return
+        self._reply(200, {'result': result, 'cacheable': cacheable})
+
+    def _reply(self, status, data):
+        try:
+            body = json.dumps(data, ensure_ascii=False)
+        except (TypeError, ValueError):
+            body = json.dumps(dict(data, result=str(data['result'])), ensure_ascii=False)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Tool server: ' + format % args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class ToolServer(object):
+    """Host tools for many agent processes, so that the models behind them are loaded once per machine. Workers use the
+    tools through RemoteTool proxies (see `make_remote_tools`), over HTTP at `url`, or over a Unix socket if
+    `unix_socket` (a path) is given.
+
+    Each tool has a queue drained by `concurrency.get(tool.name, default_concurrency)` threads, with the tools that are
+    not `thread_safe` running one call at a time by default. Calls beyond `max_queue` waiting ones are rejected (0 for no limit). Tools
+    with `max_batch_size` > 1 run the single-input calls that arrive within `batch_wait` seconds together.
+    """
+
+    def __init__(self, tools, host='127.0.0.1', port=8910, unix_socket=None, default_concurrency=4, concurrency=None, max_queue=0, batch_wait=0.01):
+        concurrency = {} if concurrency is None else dict(concurrency)
+        self.workers = {}
+        for tool in tools:
+            num_threads = concurrency.get(tool.name, default_concurrency if tool.thread_safe else 1)
+            self.workers[tool.name] = _ToolWorker(tool, concurrency=num_threads, max_queue=max_queue, batch_wait=batch_wait)
+
+        self.unix_socket = unix_socket
+        if unix_socket is not None:
+            self._server = _UnixHTTPServer(unix_socket, _ToolServerHandler)
+        else:
+            self._server = ThreadingHTTPServer((host, port), _ToolServerHandler)
+            self._server.daemon_threads = True
+        self._server.tool_server = self
+        self._thread = None
+
+    @property
+    def url(self):
+        if self.unix_socket is not None:
+            return 'unix://' + self.unix_socket
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def serve_forever(self):
+        logger.info('Tool server hosting %d tools at %s' % (len(self.workers), self.url))
+        self._server.serve_forever()
+
+    def start(self):
+        """Serve in a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.serve_forever, name='tool-server', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread = None
+        self._server.server_close()
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
+        for worker in self.workers.values():
+            worker.stop()
+
+    def metrics(self):
+        return {'tools': {name: worker.metrics() for name, worker in self.workers.items()}}
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class ToolServerClient(object):
+    """A client of a ToolServer at `url` ('http://host:port' or 'unix:///path/to/socket'), with one kept-alive
+    connection per thread."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self._parsed = urlparse(self.url)
+        assert self._parsed.scheme in ('http', 'unix'), "Tool server URL '%s' is not supported. Please use http://host:port or unix:///path." % url
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self._parsed.scheme == 'unix':
+                conn = _UnixHTTPConnection(self._parsed.path)
+            else:
+                conn = http.client.HTTPConnection(self._parsed.hostname, self._parsed.port)
+            self._local.conn = conn
+        return conn
+
+    def request(self, method, path, data=None, timeout=None, idempotent=None):
+        """Send a request and return (status, data). A request dropped by a closed kept-alive connection is sent once
+        more if it was not sent completely, or if it is `idempotent` (by default, GET requests are)."""
+        if idempotent is None:
+            idempotent = method == 'GET'
+        body = None if data is None else json.dumps(data, ensure_ascii=False).encode('utf-8')
+        for attempt in range(2):
+            conn = self._connection()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            sent = False
+            try:
+                conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+                sent = True
+                response = conn.getresponse()
+                return response.status, json.loads(response.read().decode('utf-8'))
+            except socket.timeout:
+                self._reset()
+                raise ChemAgentTimeoutError("The tool server did not reply within %g seconds." % timeout)
+            except (http.client.HTTPException, ConnectionError) as e:
+                # The kept-alive connection may have been closed by the server. Once sent, the request may have
+                # reached the server, and is sent again only if that is harmless.
+                self._reset()
+                retryable = isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)) and (idempotent or not sent)
+                if attempt == 1 or not retryable:
+                    raise ChemAgentToolNotWorkingError("Cannot reach the tool server at %s: %s" % (self.url, e))
+            except OSError as e:
+                self._reset()
+                raise ChemAgentToolNotWorkingError("Cannot reach the tool server at %s: %s" % (self.url, e))
+
+    def _reset(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def list_tools(self):
+        status, data = self.request('GET', '/tools', timeout=30)
+        return data['tools']
+
+    def metrics(self):
+        return self.request('GET', '/metrics', timeout=30)[1]
+
+    def call(self, tool_name, interface, args, kwargs, timeout=None):
+        """Returns (result, cacheable). Results that are not cacheable must not be cached by the caller either."""
+        # The call id lets the server answer a resent call with the result of the first one
+        data = {'interface': interface, 'args': args, 'kwargs': kwargs, 'timeout': timeout, 'call_id': uuid.uuid4().hex}
+        _, data = self.request('POST', '/call/%s' % tool_name, data, timeout=None if timeout is None else timeout + 5, idempotent=True)
+        if 'error' in data:
+            error_class = getattr(error_module, data.get('error_type', ''), None)
+            if isinstance(error_class, type) and issubclass(error_class, ChemAgentGeneralError):
+                raise error_class(data['error'])
+            raise ChemAgentToolProcessError('%s: %s' % (data.get('error_type', 'Error'), data['error']))
+        return data['result'], data.get('cacheable', True)
+
+
+class RemoteTool(BaseTool):
+    """A proxy of a tool hosted by a ToolServer. It has the same name, descriptions, and cache policy as the tool, and
+    caches and deduplicates calls locally like any other tool. Use `make_remote_tools` to create them."""
+
+    client = None
+
+    def __init__(self, init=True, interface='text', cache=None):
+        super().__init__(init=False, interface=interface, cache=cache)
+
+    def run_text(self, query, *args, **kwargs):
+        return self._remote_call('text', [query], kwargs)
+
+    def run_code(self, *args, **kwargs):
+        return self._remote_call('code', list(args), kwargs)
+
+    def _remote_call(self, interface, args, kwargs):
+        result, cacheable = self.client.call(self.name, interface, args, kwargs, timeout=remaining())
+        if not cacheable:
+            self._skip_result_cache()
+        return result
+
+    def _run_base(self, *args, **kwargs):
+        raise NotImplementedError
+
+
+def make_remote_tools(url, interface='text', include_tools=None):
+    """RemoteTool proxies of the tools hosted by the ToolServer at `url`, or of those in `include_tools`."""
+    client = ToolServerClient(url)
+    tools = []
+    for spec in client.list_tools():
+        if include_tools is not None and spec['name'] not in include_tools:
+            continue
+        attrs = {attr: spec[attr] for attr in TOOL_SPEC_ATTRS}
+        attrs['func_doc'] = tuple(attrs['func_doc'])
+        attrs['client'] = client
+        tool_class = type(spec['class_name'], (RemoteTool,), attrs)
+        tools.append(tool_class(interface=interface))
+    return tools
+
+
+if __name__ == '__main__':
+    from chemagent.agent.tools import make_tools
+
+    parser = argparse.ArgumentParser(description='Host ChemAgent tools for the agent processes on this machine.')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8910)
+    parser.add_argument('--unix-socket', type=str, default=None, help='Listen on this Unix socket path instead of HTTP.')
+    parser.add_argument('--model', type=str, default='gpt-4o-2024-08-06', help='Model of the LLM-backed tools, if they are hosted.')
+    parser.add_argument('--include-tools', type=str, nargs='*', default=None)
+    parser.add_argument('--exclude-tools', type=str, nargs='*', default=None, help='Default: %s.' % ', '.join(sorted(DEFAULT_LOCAL_TOOLS)))
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent calls per tool, except for the model-backed tools.')
+    parser.add_argument('--max-queue', type=int, default=256, help='Waiting calls per tool beyond which calls are rejected.')
+    parser.add_argument('--batch-wait', type=float, default=0.01, help='Seconds to wait for more inputs of batched tools.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.include_tools is None and args.exclude_tools is None:
+        args.exclude_tools = sorted(DEFAULT_LOCAL_TOOLS)
+    tools = make_tools(args.model, init=True, include_tools=args.include_tools, exclude_tools=args.exclude_tools)
+    server = ToolServer(tools, host=args.host, port=args.port, unix_socket=args.unix_socket, default_concurrency=args.concurrency, max_queue=args.max_queue, batch_wait=args.batch_wait)
+    try:
+        server.serve_forever()
+    finally:
+        server.stop()
@@ -1,3 +1,3 @@
 from .smiles import is_smiles, is_multiple_smiles, split_smiles, largest_mol, tanimoto
 from .smiles_canonicalization import canonicalize_molecule_smiles, canonicalize_reaction_smiles, get_molecule_id
-from .pubchem_utils import pubchem_iupac2cid, pubchem_name2cid
+from .pubchem_utils import pubchem_iupac2cid, pubchem_name2cid, pubchem_get_json
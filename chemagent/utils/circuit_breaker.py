@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from chemagent.utils.deadline import expired
+from chemagent.utils.error import *
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Errors meaning that the service answered, but the input is invalid or has no match
+IGNORED_ERRORS = (ChemAgentInputError, ChemAgentSearchError)
+
+
+class CircuitBreaker(object):
+    """A circuit breaker for an external service, shared by all the threads of the process.
+
+    The circuit opens after `failure_threshold` consecutive failures, or when at least `error_rate_threshold` of the
+    latest `window` calls failed (with at least `min_calls` calls). While it is open, calls fail immediately with
+    ChemAgentCircuitOpenError. After `reset_timeout` seconds, one probe call is let through (half-open): the circuit
+    closes if it succeeds, and opens again otherwise.
+    """
+
+    def __init__(self, name, failure_threshold=5, error_rate_threshold=0.5, window=20, min_calls=10, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._opened_at = None
+        self._probing = False
+        self._consecutive_failures = 0
+        self._counts = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow(self):
+        """Raise ChemAgentCircuitOpenError if a call must not be made now. Returns True for the half-open probe."""
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._state = HALF_OPEN
+                logger.info('Circuit of %s is half-open. Probing the service.' % self.name)
+            if self._state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            if self._state != CLOSED:
+                self._counts['rejected'] += 1
+                retry_in = max(self.reset_timeout - (time.monotonic() - self._opened_at), 0)
+                raise ChemAgentCircuitOpenError("%s is temporarily unavailable after repeated failures, so the request was not sent. Please use other tools, or try again in %d seconds." % (self.name, retry_in + 1))
+            return False
+
+    def record_success(self, probe=False):
+        with self._lock:
+            self._counts['calls'] += 1
+            self._outcomes.append(True)
+            self._consecutive_failures = 0
+            if probe:
+                self._probing = False
+                self._state = CLOSED
+                self._outcomes.clear()
+                logger.info('Circuit of %s is closed.' % self.name)
+
+    def record_failure(self, probe=False):
+        with self._lock:
+            self._counts['calls'] += 1
+            self._counts['failures'] += 1
+            self._outcomes.append(False)
+            self._consecutive_failures += 1
+            if probe:
+                self._probing = False
+                self._open()
+            elif self._state == CLOSED and self._should_open():
+                self._open()
+
+    def _should_open(self):
+        if self._consecutive_failures >= self.failure_threshold:
+            return True
+        num_failures = self._outcomes.count(False)
+        return len(self._outcomes) >= self.min_calls and num_failures / len(self._outcomes) >= self.error_rate_threshold
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._counts['opened'] += 1
+        logger.warning('Circuit of %s is open for %g seconds after %d consecutive failures.' % (self.name, self.reset_timeout, self._consecutive_failures))
+
+    def _release_probe(self, probe):
+        if probe:
+            with self._lock:
+                self._probing = False
+
+    @contextmanager
+    def guard(self, ignore=()):
+        """Run the block as a call to the service. Exceptions count as failures, except IGNORED_ERRORS and `ignore`.
+        Calls cut short by the deadline of the caller (see chemagent/utils/deadline.py) are not counted at all."""
+        probe = self.allow()
+        try:
+            yield
+        except (KeyboardInterrupt, ChemAgentTimeoutError):
+            self._release_probe(probe)
+            raise
+        except IGNORED_ERRORS + tuple(ignore):
+            self.record_success(probe=probe)
+            raise
+        except BaseException:
+            if expired():
+                # E.g., a request whose timeout was the time left to the caller
+                self._release_probe(probe)
+            else:
+                self.record_failure(probe=probe)
+            raise
+        self.record_success(probe=probe)
+
+    def metrics(self):
+        with self._lock:
+            metrics = {
+                'state': self._state,
+                'consecutive_failures': self._consecutive_failures,
+                'error_rate': self._outcomes.count(False) / len(self._outcomes) if len(self._outcomes) > 0 else 0.0,
+            }
+            metrics.update(self._counts)
+        return metrics
+
+
+_breakers = {}
+_config = {}
+_lock = threading.Lock()
+
+
+def get_circuit_breaker(name):
+    """The process-wide circuit breaker of a service, e.g., 'PubChem', 'ChemSpace', 'RXN4Chemistry' or 'Tavily'."""
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name, **_config)
+        return _breakers[name]
+
+
+def configure_circuit_breakers(**config):
+    """Set the CircuitBreaker arguments of all the breakers, including the ones created later."""
+    with _lock:
+        _config.update(config)
+        for name in list(_breakers):
+            _breakers[name] = CircuitBreaker(name, **_config)
+
+
+def circuit_breaker_metrics():
+    with _lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.metrics() for breaker in breakers}
@@ -0,0 +1,96 @@
+import threading
+import time
+
+from chemagent.utils.error import ChemAgentTimeoutError
+
+
+_local = threading.local()
+
+
+class _Deadline(object):
+    def __init__(self, timeout, name):
+        self.expires_at = time.monotonic() + timeout
+        self.timeout = timeout
+        self.name = name
+        self.cancelled = threading.Event()
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def expired(self):
+        return self.cancelled.is_set() or self.remaining() <= 0
+
+
+def _current():
+    return getattr(_local, 'deadline', None)
+
+
+def remaining(default=None):
+    """Seconds left before the deadline of the tool call running in this thread, or `default` without a deadline.
+    Use it as the timeout of blocking I/O in tools, e.g., `requests.get(url, timeout=remaining(30))`."""
+    deadline = _current()
+    if deadline is None:
+        return default
+    left = max(deadline.remaining(), 0.001)
+    return left if default is None else min(left, default)
+
+
+def expired():
+    """Whether the tool call running in this thread has timed out."""
+    deadline = _current()
+    return deadline is not None and deadline.expired()
+
+
+def check_deadline():
+    """Raise ChemAgentTimeoutError if the tool call running in this thread has timed out. Tools call this between
+    steps of long loops, so that an abandoned call stops instead of running in the background."""
+    deadline = _current()
+    if deadline is not None and deadline.expired():
+        raise ChemAgentTimeoutError("%s did not finish within %g seconds." % (deadline.name, deadline.timeout))
+
+
+def sleep(seconds):
+    """`time.sleep` that wakes up and raises ChemAgentTimeoutError when the deadline of this thread passes."""
+    deadline = _current()
+    if deadline is None:
+        time.sleep(seconds)
+        return
+    check_deadline()
+    if seconds >= deadline.remaining():
+        # Fail now rather than sleep past the deadline
+        raise ChemAgentTimeoutError("%s would not finish within %g seconds." % (deadline.name, deadline.timeout))
+    deadline.cancelled.wait(seconds)
+    check_deadline()
+
+
+def call_with_timeout(func, timeout, name='The call'):
+    """Run `func()` in a worker thread and return its result, or raise ChemAgentTimeoutError after `timeout` seconds.
+
+    Python threads cannot be killed, so on timeout the worker is abandoned and marked as cancelled: code using
+    `remaining`, `check_deadline` or `sleep` from this module stops at its next check, and anything else finishes
+    in the background with its result discarded. Without a timeout, `func` runs in the calling thread.
+    """
+    if timeout is None:
+        return func()
+    if timeout <= 0:
+        raise ChemAgentTimeoutError("%s was not started since no time is left." % name)
+
+    deadline = _Deadline(timeout, name)
+    outcome = {}
+
+    def worker():
+        _local.deadline = deadline
+        try:
+            outcome['result'] = func()
+        except BaseException as e:
+            outcome['error'] = e
+
+    thread = threading.Thread(target=worker, name='deadline-worker', daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        deadline.cancelled.set()
+        raise ChemAgentTimeoutError("%s did not finish within %g seconds." % (name, timeout))
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
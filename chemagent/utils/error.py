@@ -9,8 +9,14 @@ class ChemAgentToolNotWorkingError(ChemAgentGeneralError): ...
 
 class ChemAgentToolProcessError(ChemAgentGeneralError): ...
 
+class ChemAgentCircuitOpenError(ChemAgentToolNotWorkingError): ...
+
 class ChemAgentInputError(ChemAgentGeneralError): ...
 
 class ChemAgentOutputError(ChemAgentGeneralError): ...
 
 class ChemAgentSearchError(ChemAgentGeneralError): ...
+
+class ChemAgentTimeoutError(ChemAgentGeneralError): ...
+
+class ChemAgentReplayMissError(ChemAgentFatalError): ...
@@ -2,15 +2,26 @@ import requests
 import logging
 
 from chemagent.utils.error import *
+from chemagent.utils.deadline import remaining
+from chemagent.utils.circuit_breaker import get_circuit_breaker
 
 
 logger = logging.getLogger(__name__)
 
 
+def pubchem_get_json(url):
+    """GET a PubChem URL through the PubChem circuit breaker. Server errors raise ChemAgentToolNotWorkingError."""
+    with get_circuit_breaker('PubChem').guard():
+        response = requests.get(url, timeout=remaining())
+        if response.status_code >= 500:
+            raise ChemAgentToolNotWorkingError("PubChem returned HTTP %d. The service may be busy or down." % response.status_code)
+        return response.json()
+
+
 def search_pubchem(keyword):
     keyword = keyword.replace(';', '%3B')
     url = 'https://pubchem.ncbi.nlm.nih.gov/sdq/sdqagent.cgi?infmt=json&outfmt=json&query={%22select%22:%22*%22,%22collection%22:%22compound%22,%22order%22:[%22relevancescore,desc%22],%22start%22:1,%22limit%22:10,%22where%22:{%22ands%22:[{%22*%22:%22' + keyword + '%22}]},%22width%22:1000000,%22listids%22:0}'
-    data = requests.get(url).json()
+    data = pubchem_get_json(url)
     return data
 
 
@@ -78,7 +89,7 @@ def pubchem_name2cid_old(name):
 
 def pubchem_name2cid(name):
     url = 'https://pubchem.ncbi.nlm.nih.gov/rest/pug/compound/name/' + name + '/cids/JSON'
-    data = requests.get(url).json()
+    data = pubchem_get_json(url)
     try:
         cid = data['IdentifierList']['CID'][0]
     except KeyError as e:
@@ -56,6 +56,10 @@ class ExecuteHandler(tornado.web.RequestHandler):
         data = json.loads(self.request.body)
         convid = data.get("convid")
         code = data.get("code")
+        # Code to run once when the kernel of the conversation is created
+        setup = data.get("setup")
+        # The time left to the client. The cell is interrupted after it, so later code of the conversation can run
+        timeout = data.get("timeout", 60)
 
         # Create a new kernel if not exist
         new_kernel = False
@@ -68,7 +72,7 @@ class ExecuteHandler(tornado.web.RequestHandler):
             url_suffix = kernel_wrapper.__enter__()
             logging.info(f"Kernel URL: {url_suffix}")
             kernel = JupyterKernel(url_suffix, convid)
-            await kernel.initialize()
+            await kernel.initialize(tools_to_run=setup)
             conv_id_to_kernel[convid] = JupyterKernelType(
                 kernel_wrapper,
                 kernel,
@@ -85,7 +89,7 @@ class ExecuteHandler(tornado.web.RequestHandler):
 
         # Execute the code
         kernel: JupyterKernel = conv_id_to_kernel[convid].kernel
-        result = await kernel.execute(code)
+        result = await kernel.execute(code, timeout=timeout)
 
         self.write(json.dumps({
             "result": result,
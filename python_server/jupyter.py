@@ -85,12 +85,10 @@ class JupyterKernel:
         self.heartbeat_interval = 10000  # 10 seconds
         self.heartbeat_callback = None
 
-    async def initialize(self):
+    async def initialize(self, tools_to_run=None):
         await self.execute(r"%colors nocolor")
-        # pre-defined tools
-        self.tools_to_run = [
-            # TODO: You can add code for your pre-defined tools here
-        ]
+        # pre-defined tools, e.g., the functions of CodeToolAgent, which call back to the agent process
+        self.tools_to_run = list(tools_to_run or [])
         for tool in self.tools_to_run:
             # logging.info(f"Tool initialized:\n{tool}")
             await self.execute(tool)
@@ -0,0 +1,240 @@
+# A local mock LLM server that speaks the OpenAI chat completions and the Anthropic messages APIs.
+# It returns scripted Thought/Tool/Tool Input outputs for the ToolAgent, with configurable latency, so that
+# ChemAgent can be load tested end to end without a live provider. Use it with a "mock-" model in make_llm.
+
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import logging
+import argparse
+import tornado.ioloop
+import tornado.web
+import tornado.httpserver
+
+logging.basicConfig(level=logging.INFO)
+
+
+DEFAULT_SCRIPT = [
+    "Thought: I need to obtain the information with a tool.\nTool: {tool}\nTool Input: {tool_input}\n<END_INPUT>",
+    "Thought: The tool output contains the information needed to answer the question.\nAnswer: Based on the tool output, the answer is: {observation}",
+]
+
+DEFAULT_REPLY = "This is a mock answer to the question: {question}"
+
+
+class MockLLM:
+    def __init__(self, script, tool, tool_input, latency_dist, latency_mean, latency_std, chunk_size):
+        self.script = script
+        self.tool = tool
+        self.tool_input = tool_input
+        self.latency_dist = latency_dist
+        self.latency_mean = latency_mean
+        self.latency_std = latency_std
+        self.chunk_size = chunk_size
+
+    def sample_latency(self):
+        mean, std = self.latency_mean, self.latency_std
+        if mean <= 0:
+            return 0.0
+        if self.latency_dist == "fixed":
+            return mean
+        if self.latency_dist == "uniform":
+            return random.uniform(max(0.0, mean - std), mean + std)
+        if self.latency_dist == "exponential":
+            return random.expovariate(1.0 / mean)
+        if self.latency_dist == "lognormal":
+            # Parameterized by the mean and standard deviation of the latency itself
+            sigma2 = math.log(1 + (std / mean) ** 2)
+            mu = math.log(mean) - sigma2 / 2
+            return random.lognormvariate(mu, sigma2 ** 0.5)
+        raise ValueError(f"Unknown latency distribution: {self.latency_dist}")
+
+    def generate(self, system_prompt, messages, stop_sequences):
+        """Return the completion text and whether it was cut by a stop sequence."""
+        user_messages = [m for m in messages if m["role"] == "user"]
+        question = _text(user_messages[0]["content"]) if user_messages else ""
+        prefill = _text(messages[-1]["content"]) if messages and messages[-1]["role"] == "assistant" else ""
+
+        if "Tool Input" in (system_prompt or "") + question:
+            # ToolAgent protocol: the step is the number of tool outputs received so far
+            observations = [_text(m["content"]) for m in user_messages if _text(m["content"]).startswith("Tool Output:")]
+            step = len(observations)
+            template = self.script[min(step, len(self.script) - 1)]
+            observation = observations[-1][len("Tool Output:"):].strip() if observations else ""
+            question_text = question.split("Question:", 1)[-1].strip()
+            text = template.format(
+                tool=self.tool, tool_input=self.tool_input, observation=observation[:200], question=question_text, step=step
+            )
+        else:
+            text = DEFAULT_REPLY.format(question=question[-200:].strip())
+            if prefill:
+                text = " " + text
+
+        stopped = False
+        for stop in stop_sequences or []:
+            pos = text.find(stop)
+            if pos != -1:
+                text = text[:pos]
+                stopped = True
+        return text, stopped
+
+    def chunks(self, text):
+        return [text[i: i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or [""]
+
+
+def _text(content):
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+def _num_tokens(text):
+    return len(text) // 4 + 1
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    @property
+    def llm(self) -> MockLLM:
+        return self.application.mock_llm
+
+    async def stream_events(self, events, latency):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        delay = latency / max(1, len(events))
+        for event in events:
+            await asyncio.sleep(delay)
+            self.write(event)
+            await self.flush()
+
+
+class ChatCompletionsHandler(BaseHandler):
+    async def post(self):
+        data = json.loads(self.request.body)
+        messages = data["messages"]
+        system_prompt = "\n".join(_text(m["content"]) for m in messages if m["role"] == "system")
+        stop = data.get("stop")
+        if isinstance(stop, str):
+            stop = [stop]
+        text, stopped = self.llm.generate(system_prompt, [m for m in messages if m["role"] != "system"], stop)
+        latency = self.llm.sample_latency()
+        completion_id = "chatcmpl-mock-" + uuid.uuid4().hex
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": sum(_num_tokens(_text(m["content"])) for m in messages),
+            "completion_tokens": _num_tokens(text),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        if not data.get("stream"):
+            await asyncio.sleep(latency)
+            self.write({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": data["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        def chunk(delta, finish_reason=None, usage=None):
+            item = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": data["model"],
+                "choices": [] if usage is not None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            if usage is not None:
+                item["usage"] = usage
+            return "data: " + json.dumps(item) + "\n\n"
+
+        events = [chunk({"role": "assistant", "content": piece}) for piece in self.llm.chunks(text)]
+        events.append(chunk({}, finish_reason="stop"))
+        if (data.get("stream_options") or {}).get("include_usage"):
+            events.append(chunk({}, usage=usage))
+        events.append("data: [DONE]\n\n")
+        await self.stream_events(events, latency)
+
+
+class MessagesHandler(BaseHandler):
+    async def post(self):
+        data = json.loads(self.request.body)
+        system_prompt = data.get("system")
+        if system_prompt is not None:
+            system_prompt = _text(system_prompt)
+        text, stopped = self.llm.generate(system_prompt, data["messages"], data.get("stop_sequences"))
+        latency = self.llm.sample_latency()
+        message_id = "msg_mock_" + uuid.uuid4().hex
+        stop_reason = "stop_sequence" if stopped else "end_turn"
+        input_tokens = sum(_num_tokens(_text(m["content"])) for m in data["messages"]) + (_num_tokens(system_prompt) if system_prompt else 0)
+        output_tokens = _num_tokens(text)
+
+        if not data.get("stream"):
+            await asyncio.sleep(latency)
+            self.write({
+                "id": message_id,
+                "type": "message",
+                "role": "assistant",
+                "model": data["model"],
+                "content": [{"type": "text", "text": text}],
+                "stop_reason": stop_reason,
+                "stop_sequence": None,
+                "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+            })
+            return
+
+        def event(name, item):
+            return f"event: {name}\ndata: {json.dumps(item)}\n\n"
+
+        events = [
+            event("message_start", {"type": "message_start", "message": {
+                "id": message_id, "type": "message", "role": "assistant", "model": data["model"], "content": [],
+                "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+            }}),
+            event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}),
+        ]
+        for piece in self.llm.chunks(text):
+            events.append(event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": piece}}))
+        events += [
+            event("content_block_stop", {"type": "content_block_stop", "index": 0}),
+            event("message_delta", {"type": "message_delta", "delta": {"stop_reason": stop_reason, "stop_sequence": None}, "usage": {"output_tokens": output_tokens}}),
+            event("message_stop", {"type": "message_stop"}),
+        ]
+        await self.stream_events(events, latency)
+
+
+def make_app(mock_llm):
+    app = tornado.web.Application([
+        (r"/v1/chat/completions", ChatCompletionsHandler),
+        (r"/v1/messages", MessagesHandler),
+    ])
+    app.mock_llm = mock_llm
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--script", type=str, default=None, help="JSON file with a list of output templates, one per ToolAgent step. Available fields: {tool}, {tool_input}, {observation}, {question}, {step}.")
+    parser.add_argument("--tool", type=str, default="SMILES2Weight")
+    parser.add_argument("--tool-input", type=str, default="CCO")
+    parser.add_argument("--latency-dist", type=str, default="lognormal", choices=["fixed", "uniform", "exponential", "lognormal"])
+    parser.add_argument("--latency-mean", type=float, default=1.0, help="Mean latency of a completion in seconds.")
+    parser.add_argument("--latency-std", type=float, default=0.5)
+    parser.add_argument("--chunk-size", type=int, default=8, help="Characters per streamed chunk.")
+    args = parser.parse_args()
+
+    script = DEFAULT_SCRIPT
+    if args.script is not None:
+        with open(args.script) as f:
+            script = json.load(f)
+
+    mock_llm = MockLLM(script, args.tool, args.tool_input, args.latency_dist, args.latency_mean, args.latency_std, args.chunk_size)
+    server = tornado.httpserver.HTTPServer(make_app(mock_llm))
+    server.listen(args.port)
+    logging.info(f"Mock LLM server listening on port {args.port}")
+    tornado.ioloop.IOLoop.current().start()